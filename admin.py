@@ -1,6 +1,9 @@
+from datetime import datetime, timedelta
 from flask import Blueprint, render_template, redirect, url_for, flash, request, abort
 from flask_login import login_required, current_user
-from models.models import User, ParkingSpace, Booking, db
+from models.models import User, ParkingSpace, Booking, ArchivedBooking, db
+from services.sharding import gather, scatter
+from services.audit import TARGET_TYPES, get_audit_log, search_entries
 
 admin = Blueprint('admin', __name__)
 
@@ -16,8 +19,9 @@ def dashboard():
     """Admin dashboard"""
     # Get statistics
     total_users = User.query.count()
-    total_spaces = ParkingSpace.query.count()
-    total_bookings = Booking.query.count()
+    # Spaces and bookings are counted in every region
+    total_spaces = sum(scatter(lambda: ParkingSpace.query.count()))
+    total_bookings = sum(scatter(lambda: Booking.query.count() + ArchivedBooking.query.count()))
     verified_users = User.query.filter_by(is_verified=True).count()
     unverified_users = User.query.filter_by(is_verified=False, is_main_admin=False).count()  # Exclude main admin
     
@@ -101,7 +105,7 @@ def remove_admin(user_id):
 @admin.route('/spaces')
 def list_spaces():
     """List all parking spaces"""
-    spaces = ParkingSpace.query.all()
+    spaces = gather(lambda: ParkingSpace.query.all())
     return render_template('admin/spaces.html', spaces=spaces)
 
 @admin.route('/space/<int:space_id>/deactivate', methods=['POST'])
@@ -120,4 +124,52 @@ def activate_space(space_id):
     space.is_active = True
     db.session.commit()
     flash(f'Parking space "{space.title}" has been activated.', 'success')
-    return redirect(url_for('admin.list_spaces'))
\ No newline at end of file
+    return redirect(url_for('admin.list_spaces'))
+
+@admin.route('/audit')
+def audit_log():
+    """Search the audit log by actor, target and time range"""
+    actor = request.args.get('actor', '').strip()
+    target_type = request.args.get('target_type', '')
+    target_id = request.args.get('target_id', type=int)
+    since = request.args.get('since', '')
+    until = request.args.get('until', '')
+    page = max(request.args.get('page', 1, type=int), 1)
+    
+    filters = {'target_type': target_type if target_type in TARGET_TYPES else None, 'target_id': target_id}
+    try:
+        if since:
+            filters['since'] = datetime.strptime(since, '%Y-%m-%d')
+        if until:
+            # The until day is included
+            filters['until'] = datetime.strptime(until, '%Y-%m-%d') + timedelta(days=1)
+    except ValueError:
+        flash('Dates must be given as YYYY-MM-DD.', 'error')
+    
+    entries, has_more = [], False
+    actor_user = User.query.filter_by(username=actor).first() if actor else None
+    if actor and actor_user is None:
+        flash(f'No user named {actor}.', 'error')
+    else:
+        if actor_user is not None:
+            filters['actor_id'] = actor_user.id
+        entries, has_more = search_entries(page=page, **filters)
+    
+    actor_ids = {entry.actor_id for entry in entries if entry.actor_id is not None}
+    actors = dict(db.session.query(User.id, User.username).filter(User.id.in_(actor_ids)).all()) if actor_ids else {}
+    args = {key: value for key, value in request.args.items() if key != 'page' and value}
+    return render_template('admin/audit.html',
+                         entries=entries,
+                         actors=actors,
+                         target_types=TARGET_TYPES,
+                         args=args,
+                         page=page,
+                         has_more=has_more,
+                         pending=len(get_audit_log()))
+
+@admin.route('/audit/flush', methods=['POST'])
+def flush_audit_log():
+    """Write the audit entries this worker still has queued"""
+    written = get_audit_log().flush()
+    flash(f'{written} queued audit entries written.', 'success')
+    return redirect(url_for('admin.audit_log', **request.args))
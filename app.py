@@ -1,27 +1,91 @@
+import time
+_import_started = time.perf_counter()
+
 from flask import Flask, render_template
 from flask_login import LoginManager
 from models.database import db
 from models.models import User
-import pymysql
+from services import pricing, locations, events, sync, payloads, compression, fragments, snapshot, archive, ranking, ratelimit, uploads, reaper, settlement, sharding, audit, startup
 import os
 
-def create_app():
+IMPORT_SECONDS = time.perf_counter() - _import_started
+
+def create_app(test_config=None):
+    """Create the application
+    
+    In production mode (STARTUP_MODE 'production' or the
+    SMART_PARK_STARTUP_MODE environment variable) no tables are created;
+    run init_db.py when deploying instead. Startup timings are kept in
+    app.extensions['startup'] and logged.
+    """
+    mode = (test_config or {}).get('STARTUP_MODE') or \
+        os.environ.get('SMART_PARK_STARTUP_MODE', startup.DEVELOPMENT)
+    timer = startup.StartupTimer(mode)
+    timer.timings['imports'] = IMPORT_SECONDS
+    
+    with timer.phase('config'):
+        app = create_configured_app(mode, test_config)
+    app.extensions['startup'] = timer
+    
+    with timer.phase('extensions'):
+        init_extensions(app)
+    
+    # Create tables
+    if app.config['CREATE_TABLES']:
+        with timer.phase('create_tables'), app.app_context():
+            # Shards get their tables from create_shard_tables, and other
+            # apps in the process may have registered shard bind keys
+            db.create_all(bind_key=None)
+            sharding.create_shard_tables()
+    
+    with timer.phase('blueprints'):
+        register_blueprints(app)
+    
+    app.logger.info(timer.report())
+    return app
+
+def create_configured_app(mode, test_config=None):
+    """Create the Flask object with its configuration"""
     app = Flask(__name__)
     app.config['SECRET_KEY'] = 'your-secret-key-here'
     # Configure for XAMPP MySQL
-    app.config['SQLALCHEMY_DATABASE_URI'] = 'mysql+pymysql://root:@localhost:3306/smart_park_system'
+    app.config['SQLALCHEMY_DATABASE_URI'] = os.environ.get(
+        'SMART_PARK_DATABASE_URI', 'mysql+pymysql://root:@localhost:3306/smart_park_system'
+    )
     app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
     
     # Configure file upload
     app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024  # 16MB max file size
     app.config['UPLOAD_FOLDER'] = os.path.join(app.root_path, 'static', 'uploads')
     
-    # Create upload folder if it doesn't exist
-    if not os.path.exists(app.config['UPLOAD_FOLDER']):
-        os.makedirs(app.config['UPLOAD_FOLDER'])
+    app.config['STARTUP_MODE'] = mode
+    app.config['CREATE_TABLES'] = mode != startup.PRODUCTION
+    
+    # Override the defaults, e.g. with an SQLite database for tests
+    if test_config is not None:
+        app.config.update(test_config)
     
-    # Initialize extensions
+    return app
+
+def init_extensions(app):
+    """Initialize the database, services and login manager"""
     db.init_app(app)
+    sharding.init_app(app)
+    pricing.init_app(app)
+    locations.init_app(app)
+    events.init_app(app)
+    sync.init_app(app)
+    payloads.init_app(app)
+    compression.init_app(app)
+    fragments.init_app(app)
+    snapshot.init_app(app)
+    archive.init_app(app)
+    ranking.init_app(app)
+    ratelimit.init_app(app)
+    uploads.init_app(app)
+    reaper.init_app(app)
+    settlement.init_app(app)
+    audit.init_app(app)
     
     # Setup Flask-Login
     login_manager = LoginManager()
@@ -32,12 +96,9 @@ def create_app():
     @login_manager.user_loader
     def load_user(user_id):
         return User.query.get(int(user_id))
-    
-    # Create tables
-    with app.app_context():
-        db.create_all()
-    
-    # Register blueprints
+
+def register_blueprints(app):
+    """Register the blueprints and the home page"""
     from auth import auth
     app.register_blueprint(auth, url_prefix='/auth')
     
@@ -51,8 +112,6 @@ def create_app():
     @app.route('/')
     def home():
         return render_template('index.html')
-    
-    return app
 
 if __name__ == '__main__':
     app = create_app()
@@ -0,0 +1,19 @@
+"""ASGI entry point: async JSON endpoints with the Flask pages behind them.
+
+    pip install -r requirements-asgi.txt
+    uvicorn asgi:app --workers 4
+
+Like wsgi.py, the application starts in production mode. See async_api.py
+for which requests are served asynchronously.
+"""
+import os
+
+os.environ.setdefault('SMART_PARK_STARTUP_MODE', 'production')
+
+from app import create_app
+from async_api import create_asgi_app
+from services.startup import warm_up
+
+flask_app = create_app()
+warm_up(flask_app)
+app = create_asgi_app(flask_app)
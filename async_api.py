@@ -0,0 +1,375 @@
+"""Async serving of the JSON API.
+
+create_asgi_app() puts an ASGI application in front of the Flask
+application. Async handlers answer the I/O-bound JSON endpoints of the
+parking blueprint: the spaces listing, location pings and the live event
+stream. They use an async SQLAlchemy engine with its own connection pool,
+so a slow query or an open stream holds a coroutine instead of a thread.
+Every other request, including all HTML pages, goes to the unchanged
+synchronous Flask application, which runs in a thread pool.
+
+Requests to the async handlers are shed and rate limited with the load
+shedder and rules of services.ratelimit, like the Flask routes.
+
+A handler returns None to hand its request to Flask. That happens for
+delta sync requests and for requests whose session does not identify a
+user, so Flask-Login's remember cookie and login redirect still apply.
+With SHARD_REGIONS configured the spaces listing is always handed to
+Flask, which routes it to the shard of its region.
+
+The async engine connects to ASYNC_SQLALCHEMY_DATABASE_URI. When that is
+not set, the URI is derived from SQLALCHEMY_DATABASE_URI by switching to
+the async driver (pymysql -> aiomysql, sqlite -> aiosqlite).
+"""
+import asyncio
+import math
+import time
+
+from a2wsgi import WSGIMiddleware
+from flask import url_for
+from itsdangerous import BadSignature
+from sqlalchemy.engine import make_url
+from sqlalchemy.ext.asyncio import create_async_engine
+from starlette.requests import Request
+from starlette.responses import Response, StreamingResponse
+from werkzeug.datastructures import MultiDict
+from werkzeug.exceptions import ServiceUnavailable, TooManyRequests
+from werkzeug.http import parse_accept_header
+
+from models.models import ParkingSpace, SyncCounter, User, db
+from parking import parse_bbox, parse_location_ping, parse_near_args, snapshot_listing, space_to_dict
+from services import sync
+from services.compression import compress_body
+from services.events import format_sse
+from services.geo import INITIAL_RADIUS_KM, candidate_statement, next_radius, rank_rows
+from services.payloads import encode_compact
+from services.ratelimit import LOAD_SHED_EXEMPT, queue_seconds
+from services.ratings import rating_stats_statement, stats_from_rows
+from services.snapshot import NEAREST_OVERFETCH
+
+ASYNC_DRIVERS = {
+    'mysql': 'mysql+aiomysql',
+    'mysql+pymysql': 'mysql+aiomysql',
+    'sqlite': 'sqlite+aiosqlite',
+    'sqlite+pysqlite': 'sqlite+aiosqlite',
+}
+
+# Columns space_to_dict() needs besides the owner's name and rating
+LISTING_COLUMNS = (
+    ParkingSpace.id, ParkingSpace.title, ParkingSpace.address, ParkingSpace.latitude,
+    ParkingSpace.longitude, ParkingSpace.price_per_hour, ParkingSpace.owner_id,
+)
+
+
+def async_database_uri(config):
+    """Return the URI of the async engine"""
+    uri = config.get('ASYNC_SQLALCHEMY_DATABASE_URI')
+    if uri:
+        return uri
+    url = make_url(config['SQLALCHEMY_DATABASE_URI'])
+    drivername = ASYNC_DRIVERS.get(url.drivername)
+    if drivername is None:
+        raise RuntimeError(f'No async driver known for {url.drivername}, set ASYNC_SQLALCHEMY_DATABASE_URI')
+    return url.set(drivername=drivername).render_as_string(hide_password=False)
+
+
+def create_asgi_app(flask_app):
+    """Wrap the Flask application in an ASGI application with async JSON endpoints"""
+    flask_app.config.setdefault('ASYNC_DB_POOL_SIZE', 20)
+    flask_app.config.setdefault('ASYNC_DB_MAX_OVERFLOW', 10)
+    flask_app.config.setdefault('ASGI_WSGI_THREADS', 10)
+    return AsyncAPI(flask_app)
+
+
+class AsyncAPI:
+    """ASGI application routing the async endpoints and passing the rest to Flask"""
+
+    def __init__(self, flask_app):
+        self.flask_app = flask_app
+        self.config = flask_app.config
+        self.wsgi = WSGIMiddleware(flask_app, workers=self.config['ASGI_WSGI_THREADS'])
+        self._engine = None
+        with flask_app.test_request_context():
+            # (method, path) -> (endpoint, handler)
+            self.routes = {
+                (method, url_for(endpoint)): (endpoint, handler) for method, endpoint, handler in [
+                    ('GET', 'parking.api_parking_spaces', self.parking_spaces),
+                    ('POST', 'parking.update_user_location', self.user_location),
+                    ('GET', 'parking.stream_parking_spaces', self.stream_parking_spaces),
+                ]
+            }
+
+    @property
+    def engine(self):
+        """The async engine, created on first use inside the event loop"""
+        if self._engine is None:
+            uri = async_database_uri(self.config)
+            options = {'pool_pre_ping': True}
+            if not uri.startswith('sqlite'):
+                options.update(pool_size=self.config['ASYNC_DB_POOL_SIZE'],
+                               max_overflow=self.config['ASYNC_DB_MAX_OVERFLOW'],
+                               pool_recycle=3600)
+            self._engine = create_async_engine(uri, **options)
+        return self._engine
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            await self.lifespan(receive, send)
+            return
+        if scope['type'] == 'http':
+            route = self.routes.get((scope['method'], scope['path']))
+            if route is not None:
+                endpoint, handler = route
+                request = Request(scope, receive)
+                response = self.shed(endpoint, request)
+                if response is not None:
+                    await response(scope, receive, send)
+                    return
+                try:
+                    response = self.rate_limit(endpoint, request) or await handler(request)
+                    if response is not None:
+                        await response(scope, receive, send)
+                        return
+                finally:
+                    # Requests handed to Flask are counted again there
+                    if endpoint not in LOAD_SHED_EXEMPT:
+                        self.flask_app.extensions['load_shedder'].leave()
+            if not any(name == b'x-request-start' for name, _ in scope['headers']):
+                # Lets Flask shed requests that waited too long for a thread
+                started = f't={time.time():.3f}'.encode('ascii')
+                scope = dict(scope, headers=[*scope['headers'], (b'x-request-start', started)])
+        await self.wsgi(scope, receive, send)
+
+    async def lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                if self._engine is not None:
+                    await self._engine.dispose()
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    def json_response(self, request, payload, status=200, headers=None):
+        """Serialize like Flask's jsonify and compress like services.compression"""
+        body = self.flask_app.json.dumps(payload).encode('utf-8')
+        headers = dict(headers or {})
+        if status == 200:
+            headers['Vary'] = 'Accept-Encoding'
+            if len(body) >= self.config['COMPRESS_MIN_SIZE']:
+                accept_encodings = parse_accept_header(request.headers.get('accept-encoding'))
+                body, encoding = compress_body(body, accept_encodings, self.config)
+                if encoding is not None:
+                    headers['Content-Encoding'] = encoding
+        return Response(body, status_code=status, headers=headers, media_type='application/json')
+
+    def shed(self, endpoint, request):
+        """Return a 503 response like services.ratelimit does, else count the request in
+
+        A request that is not refused must leave the load shedder when done,
+        unless its endpoint is exempt.
+        """
+        if endpoint in LOAD_SHED_EXEMPT:
+            return None
+        waited = queue_seconds(request.headers.get('x-request-start'))
+        max_wait = self.config['LOAD_SHED_MAX_QUEUE_SECONDS']
+        if (max_wait and waited is not None and waited > max_wait) \
+                or not self.flask_app.extensions['load_shedder'].enter():
+            return self.json_response(request, {'error': ServiceUnavailable.description}, 503,
+                                      {'Retry-After': '1'})
+        return None
+
+    def rate_limit(self, endpoint, request):
+        """Return a 429 response when the client exceeded the endpoint's rate limit"""
+        if not self.config['RATELIMIT_ENABLED']:
+            return None
+
+        def key_for(kind):
+            user_id = self.session_user_id(request) if kind != 'ip' else None
+            if user_id is not None:
+                return f'user:{user_id}'
+            # The client address is unknown e.g. behind a unix socket
+            return f"ip:{request.client.host if request.client else None}"
+
+        retry_after = self.flask_app.extensions['ratelimit'].hit(endpoint, request.method, key_for)
+        if not retry_after:
+            return None
+        return self.json_response(request, {'error': TooManyRequests.description}, 429,
+                                  {'Retry-After': str(max(1, math.ceil(retry_after)))})
+
+    def session_user_id(self, request):
+        """Return the id of the user logged in through the Flask session cookie, if any"""
+        cookie = request.cookies.get(self.config['SESSION_COOKIE_NAME'])
+        if not cookie:
+            return None
+        serializer = self.flask_app.session_interface.get_signing_serializer(self.flask_app)
+        if serializer is None:
+            return None
+        try:
+            session = serializer.loads(
+                cookie, max_age=int(self.flask_app.permanent_session_lifetime.total_seconds())
+            )
+        except BadSignature:
+            return None
+        try:
+            return int(session['_user_id'])
+        except (KeyError, TypeError, ValueError):
+            return None
+
+    async def spaces_to_dicts(self, connection, rows):
+        """Async version of parking.spaces_to_dicts() for rows of LISTING_COLUMNS"""
+        owner_ids = {row.owner_id for row in rows}
+        if not owner_ids:
+            return []
+        usernames = dict((await connection.execute(
+            db.select(User.id, User.username).where(User.id.in_(owner_ids))
+        )).all())
+        stats = stats_from_rows((await connection.execute(rating_stats_statement(owner_ids))).all())
+        return [
+            space_to_dict(row, usernames[row.owner_id], stats.get(row.owner_id, (None, 0)))
+            for row in rows
+        ]
+
+    def snapshot(self):
+        store = self.flask_app.extensions.get('snapshot')
+        return store.get() if store is not None else None
+
+    async def rows_by_rank(self, connection, ids, distances, filters=()):
+        """Async version of geo.spaces_by_rank() for rows of LISTING_COLUMNS"""
+        rows = (await connection.execute(
+            db.select(*LISTING_COLUMNS).where(ParkingSpace.id.in_(ids.tolist()), *filters)
+        )).all()
+        by_id = {row.id: row for row in rows}
+        return [(by_id[space_id], float(distance))
+                for space_id, distance in zip(ids.tolist(), distances) if space_id in by_id]
+
+    async def nearest(self, connection, latitude, longitude, k, max_km):
+        """Return [(row, distance_km)] of the k nearest spaces, like snapshot.snapshot_nearest()"""
+        snapshot = self.snapshot()
+        if snapshot is not None:
+            ids, distances = snapshot.nearest(latitude, longitude, k * NEAREST_OVERFETCH, max_km)
+            nearest = await self.rows_by_rank(connection, ids, distances, [ParkingSpace.is_active == True])
+            if len(nearest) >= min(k, len(ids)):
+                return nearest[:k]
+
+        radius = min(INITIAL_RADIUS_KM, max_km)
+        while radius is not None:
+            candidates = (await connection.execute(
+                candidate_statement(latitude, longitude, radius)
+            )).all()
+            ids, distances = rank_rows(latitude, longitude, candidates, k, radius)
+            radius = next_radius(radius, len(ids), k, max_km)
+        return await self.rows_by_rank(connection, ids, distances)
+
+    async def parking_spaces(self, request):
+        """Async version of parking.api_parking_spaces"""
+        args = MultiDict(request.query_params.multi_items())
+        if 'since' in args or self.config['SHARD_REGIONS']:
+            return None
+        try:
+            near = parse_near_args(args)
+        except ValueError as e:
+            return self.json_response(request, {'error': str(e)}, 400)
+
+        headers = {}
+        snapshot = None if near else self.snapshot()
+        if snapshot is not None:
+            # No database query at all, like the Flask view
+            spaces_data = snapshot_listing(snapshot)
+            headers['X-Sync-Cursor'] = str(snapshot.cursor)
+        elif near:
+            async with self.engine.connect() as connection:
+                nearest = await self.nearest(connection, *near)
+                spaces_data = await self.spaces_to_dicts(connection, [row for row, _ in nearest])
+            for space_data, (_, distance) in zip(spaces_data, nearest):
+                space_data['distance_km'] = round(distance, 3)
+        else:
+            async with self.engine.connect() as connection:
+                # Read the cursor first so changes committed meanwhile are sent again later
+                cursor = await connection.scalar(
+                    db.select(SyncCounter.value).where(SyncCounter.name == sync.FEED)
+                )
+                rows = (await connection.execute(db.select(*LISTING_COLUMNS).where(
+                    ParkingSpace.is_active == True,
+                    ParkingSpace.latitude.isnot(None),
+                    ParkingSpace.longitude.isnot(None)
+                ))).all()
+                spaces_data = await self.spaces_to_dicts(connection, rows)
+            headers['X-Sync-Cursor'] = str(cursor or 0)
+
+        if args.get('format') == 'compact':
+            return self.json_response(request, encode_compact(spaces_data), headers=headers)
+        return self.json_response(request, spaces_data, headers=headers)
+
+    async def user_location(self, request):
+        """Async version of parking.update_user_location"""
+        user_id = self.session_user_id(request)
+        if user_id is None:
+            return None
+        async with self.engine.connect() as connection:
+            if await connection.scalar(db.select(User.id).where(User.id == user_id)) is None:
+                return None
+
+        data = {}
+        if request.headers.get('content-type', '').startswith('application/json'):
+            try:
+                data = await request.json()
+            except ValueError:
+                data = {}
+        try:
+            latitude, longitude = parse_location_ping(data if isinstance(data, dict) else {})
+        except ValueError as e:
+            return self.json_response(request, {'error': str(e)}, 400)
+
+        # Buffered and written to the database in batches by a background thread
+        self.flask_app.extensions['locations'].add(user_id, latitude, longitude)
+        return self.json_response(request, {'message': 'Location updated successfully'}, 202)
+
+    async def stream_parking_spaces(self, request):
+        """Async version of parking.stream_parking_spaces; an idle client costs no thread"""
+        bbox = None
+        if request.query_params.get('bbox'):
+            try:
+                bbox = parse_bbox(request.query_params['bbox'])
+            except ValueError as e:
+                return self.json_response(request, {'error': str(e)}, 400)
+
+        broker = self.flask_app.extensions['events']
+        keepalive = self.config['STREAM_KEEPALIVE_SECONDS']
+        # Streams end after a while so clients reconnect, e.g. to another worker after a restart
+        deadline = time.monotonic() + self.config['STREAM_MAX_SECONDS']
+        loop = asyncio.get_running_loop()
+        ready = asyncio.Event()
+
+        def wake():
+            # Called from whichever thread committed the change
+            try:
+                loop.call_soon_threadsafe(ready.set)
+            except RuntimeError:
+                pass  # The event loop has closed
+
+        subscription = broker.subscribe(bbox)
+        subscription.on_push = wake
+
+        async def generate():
+            try:
+                yield 'retry: 5000\n\n'
+                while time.monotonic() < deadline:
+                    try:
+                        await asyncio.wait_for(ready.wait(), keepalive)
+                    except asyncio.TimeoutError:
+                        pass
+                    ready.clear()
+                    events = subscription.get(timeout=0)
+                    if not events:
+                        yield ': keepalive\n\n'
+                    for event in events:
+                        yield format_sse(event)
+            finally:
+                broker.unsubscribe(subscription)
+
+        return StreamingResponse(generate(), media_type='text/event-stream', headers={
+            'Cache-Control': 'no-cache',
+            'X-Accel-Buffering': 'no'
+        })
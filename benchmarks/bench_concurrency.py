@@ -0,0 +1,160 @@
+"""Compare how many concurrent clients the sync and async serving modes sustain.
+
+Seeds an SQLite database with synthetic spaces, then starts each serving
+mode in a subprocess and measures the spaces API at increasing concurrency:
+
+    sync   gunicorn gthread workers (wsgi:app), WORKERS x THREADS threads
+    async  uvicorn workers (asgi:app), one event loop each
+
+With --streams, that many live event streams are held open during the
+run, as open map pages do. The sync mode refuses them, since each would
+occupy a thread, so its maps fall back to polling.
+
+    pip install -r requirements-asgi.txt -r requirements-optional.txt httpx aiosqlite
+    python benchmarks/bench_concurrency.py --concurrency 10 50 200 --streams 40
+"""
+import argparse
+import asyncio
+import os
+import random
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import time as clock
+
+import httpx
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+
+def seed(database_uri, count):
+    """Create the schema and count spaces around one city"""
+    from app import create_app
+    from models.models import ParkingSpace, User, db
+    app = create_app({'SQLALCHEMY_DATABASE_URI': database_uri})
+    rng = random.Random(1)
+    with app.app_context():
+        owner = User(username='owner', email='owner@example.com', password_hash='x')
+        db.session.add(owner)
+        db.session.flush()
+        db.session.add_all([
+            ParkingSpace(title=f'Space {i}', address='Example Road', price_per_hour=rng.choice([20, 30, 40]),
+                         latitude=18.45 + rng.random() * 0.2, longitude=73.75 + rng.random() * 0.2,
+                         availability_start=clock(6), availability_end=clock(22), owner_id=owner.id)
+            for i in range(count)
+        ])
+        db.session.commit()
+
+
+def server_command(mode, port, workers, threads):
+    if mode == 'sync':
+        return [sys.executable, '-m', 'gunicorn', '-c', 'gunicorn.conf.py', '-k', 'gthread',
+                '-w', str(workers), '--threads', str(threads), '-b', f'127.0.0.1:{port}', 'wsgi:app']
+    return [sys.executable, '-m', 'uvicorn', 'asgi:app', '--workers', str(workers),
+            '--host', '127.0.0.1', '--port', str(port), '--log-level', 'warning']
+
+
+def wait_until_up(base_url, timeout=30):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            if httpx.get(base_url + '/', timeout=1).status_code == 200:
+                return
+        except httpx.HTTPError:
+            pass
+        time.sleep(0.2)
+    raise RuntimeError(f'Server at {base_url} did not start')
+
+
+async def hold_stream(client, url, stop):
+    """Keep one event stream open until stop is set"""
+    try:
+        async with client.stream('GET', url, timeout=None) as response:
+            async for _ in response.aiter_raw():
+                if stop.is_set():
+                    return
+    except (httpx.HTTPError, asyncio.CancelledError):
+        pass
+
+
+async def load(base_url, path, concurrency, duration, streams, timeout):
+    """Return (requests per second, latencies in ms, errors) at one concurrency level"""
+    limits = httpx.Limits(max_connections=concurrency + streams + 10)
+    async with httpx.AsyncClient(base_url=base_url, limits=limits) as client:
+        stop = asyncio.Event()
+        holders = [asyncio.create_task(hold_stream(client, '/parking/api/parking-spaces/stream', stop))
+                   for _ in range(streams)]
+        await asyncio.sleep(1 if streams else 0)
+
+        latencies, errors = [], 0
+        deadline = time.monotonic() + duration
+
+        async def worker():
+            nonlocal errors
+            while time.monotonic() < deadline:
+                started = time.perf_counter()
+                try:
+                    response = await client.get(path, timeout=timeout)
+                    response.raise_for_status()
+                    latencies.append((time.perf_counter() - started) * 1000)
+                except httpx.HTTPError:
+                    errors += 1
+
+        await asyncio.gather(*(worker() for _ in range(concurrency)))
+        stop.set()
+        for holder in holders:
+            holder.cancel()
+        await asyncio.gather(*holders, return_exceptions=True)
+    return len(latencies) / duration, latencies, errors
+
+
+def percentile(values, fraction):
+    if not values:
+        return float('nan')
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--modes', nargs='+', default=['sync', 'async'], choices=['sync', 'async'])
+    parser.add_argument('--spaces', type=int, default=2000)
+    parser.add_argument('--concurrency', type=int, nargs='+', default=[10, 50, 200])
+    parser.add_argument('--streams', type=int, default=0, help='event streams held open during the run')
+    parser.add_argument('--duration', type=float, default=10.0, help='seconds per concurrency level')
+    parser.add_argument('--timeout', type=float, default=5.0, help='seconds before a request counts as failed')
+    parser.add_argument('--workers', type=int, default=2)
+    parser.add_argument('--threads', type=int, default=8, help='threads per sync worker')
+    parser.add_argument('--path', default='/parking/api/parking-spaces?near=18.55,73.85&k=20')
+    parser.add_argument('--port', type=int, default=8765)
+    args = parser.parse_args()
+
+    database_uri = f"sqlite:///{os.path.join(tempfile.mkdtemp(), 'bench.db')}"
+    seed(database_uri, args.spaces)
+    env = dict(os.environ, SMART_PARK_DATABASE_URI=database_uri, SMART_PARK_STARTUP_MODE='production')
+    base_url = f'http://127.0.0.1:{args.port}'
+
+    print(f'{args.spaces} spaces, {args.streams} open streams, GET {args.path}')
+    print(f"{'mode':<7}{'clients':>8}{'req/s':>10}{'p50 ms':>10}{'p99 ms':>10}{'errors':>8}")
+    for mode in args.modes:
+        server = subprocess.Popen(server_command(mode, args.port, args.workers, args.threads),
+                                  cwd=ROOT, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        try:
+            wait_until_up(base_url)
+            for concurrency in args.concurrency:
+                rate, latencies, errors = asyncio.run(
+                    load(base_url, args.path, concurrency, args.duration, args.streams, args.timeout)
+                )
+                median = statistics.median(latencies) if latencies else float('nan')
+                print(f'{mode:<7}{concurrency:>8}{rate:>10.1f}{median:>10.1f}'
+                      f'{percentile(latencies, 0.99):>10.1f}{errors:>8}')
+        finally:
+            server.terminate()
+            server.wait(timeout=30)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,99 @@
+"""Compare sizes and serialization times of the parking spaces API formats.
+
+Builds synthetic listings and reports, for the object-per-space and the
+columnar format, the raw/gzip/brotli sizes and the time to build and serialize with
+json and (when installed) orjson.
+
+    python benchmarks/bench_payload.py --counts 10000 100000
+"""
+import argparse
+import gzip
+import json
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from services.payloads import encode_compact
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+
+def synthetic_spaces(count, owners=None, seed=1):
+    """Spaces scattered around a city, sharing a pool of owners"""
+    rng = random.Random(seed)
+    owners = owners or max(1, count // 20)
+    spaces = []
+    for i in range(count):
+        owner = rng.randrange(owners)
+        spaces.append({
+            'id': i + 1,
+            'title': f'Parking space {i + 1}',
+            'address': f'{rng.randint(1, 999)} Example Road, Pune',
+            'latitude': round(18.45 + rng.random() * 0.2, 6),
+            'longitude': round(73.75 + rng.random() * 0.2, 6),
+            'price_per_hour': float(rng.choice([20, 25, 30, 40, 50, 60])),
+            'owner_username': f'owner{owner}',
+            'owner_rating': round(rng.uniform(3, 5), 1),
+            'owner_total_ratings': rng.randint(0, 200),
+        })
+    # One rating per owner, as the API reports it
+    by_owner = {}
+    for space in spaces:
+        rating = by_owner.setdefault(space['owner_username'], (space['owner_rating'], space['owner_total_ratings']))
+        space['owner_rating'], space['owner_total_ratings'] = rating
+    return spaces
+
+
+def best_time(function, repeat):
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def report(count, repeat):
+    spaces = synthetic_spaces(count)
+    formats = {
+        'objects': lambda: spaces,
+        'columns': lambda: encode_compact(spaces),
+    }
+    print(f'\n{count} spaces')
+    print(f"{'format':<10}{'raw':>12}{'gzip':>12}{'brotli':>12}{'json ms':>10}{'orjson ms':>11}")
+    for name, build in formats.items():
+        body = json.dumps(build(), separators=(',', ':')).encode('utf-8')
+        gzipped = len(gzip.compress(body, compresslevel=6))
+        brotli_size = len(brotli.compress(body, quality=5)) if brotli else None
+        json_ms = best_time(lambda: json.dumps(build(), separators=(',', ':')), repeat) * 1000
+        orjson_ms = best_time(lambda: orjson.dumps(build()), repeat) * 1000 if orjson else None
+        brotli_column = f'{brotli_size:,}' if brotli_size is not None else '-'
+        orjson_column = f'{orjson_ms:.1f}' if orjson_ms is not None else '-'
+        print(f'{name:<10}{len(body):>12,}{gzipped:>12,}{brotli_column:>12}'
+              f'{json_ms:>10.1f}{orjson_column:>11}')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--counts', type=int, nargs='+', default=[10000, 100000])
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+    if brotli is None or orjson is None:
+        print('Install requirements-optional.txt to include brotli and orjson.')
+    for count in args.counts:
+        report(count, args.repeat)
+
+
+if __name__ == '__main__':
+    main()
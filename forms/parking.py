@@ -1,5 +1,6 @@
 from flask_wtf import FlaskForm
-from wtforms import StringField, TextAreaField, FloatField, TimeField, SubmitField, BooleanField, DateField, FileField
+from wtforms import StringField, TextAreaField, FloatField, TimeField, SubmitField, BooleanField, DateField, FileField, SelectField, SelectMultipleField, HiddenField
+from wtforms.widgets import ListWidget, CheckboxInput
 from wtforms.validators import DataRequired, Length, NumberRange, Optional
 from werkzeug.utils import secure_filename
 
@@ -15,6 +16,7 @@ class ParkingSpaceForm(FlaskForm):
     availability_end = TimeField('Available Until', validators=[DataRequired()])
     is_active = BooleanField('Active Listing', default=True)
     images = FileField('Upload Images', render_kw={'multiple': True})
+    upload_ids = HiddenField()  # Images uploaded in chunks by script.js
     submit = SubmitField('Save Parking Space')
 
 class BookingForm(FlaskForm):
@@ -22,4 +24,22 @@ class BookingForm(FlaskForm):
     date = DateField('Date', validators=[DataRequired()])
     start_time = TimeField('Start Time', validators=[DataRequired()])
     end_time = TimeField('End Time', validators=[DataRequired()])
-    submit = SubmitField('Request Booking')
\ No newline at end of file
+    submit = SubmitField('Request Booking')
+
+class MultiCheckboxField(SelectMultipleField):
+    """A multiple-select rendered as a list of checkboxes"""
+    widget = ListWidget(prefix_label=False)
+    option_widget = CheckboxInput()
+
+class RecurringBookingForm(FlaskForm):
+    """Form for booking a parking space on several dates at once"""
+    start_date = DateField('From Date', validators=[DataRequired()])
+    end_date = DateField('Until Date', validators=[DataRequired()])
+    start_time = TimeField('Start Time', validators=[DataRequired()])
+    end_time = TimeField('End Time', validators=[DataRequired()])
+    pattern = SelectField('Repeat', choices=[('weekly', 'On selected weekdays'), ('daily', 'Every day'),
+                                             ('span', 'Once, from the start to the end date')], default='weekly')
+    weekdays = MultiCheckboxField('Weekdays', coerce=int, validators=[Optional()],
+                                  choices=[(0, 'Mon'), (1, 'Tue'), (2, 'Wed'), (3, 'Thu'), (4, 'Fri'), (5, 'Sat'), (6, 'Sun')])
+    allow_partial = BooleanField('Book the free dates even if some are already taken')
+    submit = SubmitField('Request Bookings')
@@ -0,0 +1,31 @@
+"""Gunicorn settings for serving wsgi:app on Linux.
+
+The application is loaded once in the master (preload_app) and the workers
+are forked from it, sharing its memory copy-on-write. Objects that exist at
+fork time are moved out of the garbage collector's reach with gc.freeze()
+so collections in the workers do not touch, and copy, those pages.
+"""
+import gc
+import os
+
+bind = os.environ.get('SMART_PARK_BIND', '0.0.0.0:8000')
+workers = int(os.environ.get('SMART_PARK_WORKERS', (os.cpu_count() or 1) * 2 + 1))
+preload_app = True
+
+
+def when_ready(server):
+    from wsgi import app
+    server.log.info(app.extensions['startup'].report())
+
+
+def pre_fork(server, worker):
+    gc.freeze()
+
+
+def post_fork(server, worker):
+    # Connections opened in the master must not be shared with the workers
+    from models.database import db
+    from wsgi import app
+    with app.app_context():
+        for engine in db.engines.values():
+            engine.dispose(close=False)
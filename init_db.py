@@ -68,12 +68,24 @@ def initialize_tables():
                 address VARCHAR(300) NOT NULL,
                 latitude FLOAT,
                 longitude FLOAT,
+                geo_cell INT,
                 price_per_hour FLOAT NOT NULL,
                 availability_start TIME NOT NULL,
                 availability_end TIME NOT NULL,
                 is_active BOOLEAN DEFAULT TRUE,
                 created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                updated_at DATETIME,
+                change_seq BIGINT,
+                rating_score FLOAT,
+                rank_score FLOAT,
                 owner_id INT NOT NULL,
+                INDEX ix_parking_spaces_geo_cell (geo_cell),
+                INDEX ix_parking_spaces_updated_at (updated_at),
+                INDEX ix_parking_spaces_change_seq (change_seq),
+                INDEX ix_parking_spaces_active_rank (is_active, rank_score, id),
+                INDEX ix_parking_spaces_active_price (is_active, price_per_hour, id),
+                INDEX ix_parking_spaces_active_created (is_active, created_at, id),
+                INDEX ix_parking_spaces_active_rating (is_active, rating_score, id),
                 FOREIGN KEY (owner_id) REFERENCES users(id) ON DELETE CASCADE
             )
         ''')
@@ -90,6 +102,15 @@ def initialize_tables():
             )
         ''')
         
+        # Create image_deletions table, the files the reaper is to remove
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS image_deletions (
+                id INT AUTO_INCREMENT PRIMARY KEY,
+                image_url VARCHAR(500) NOT NULL,
+                queued_at DATETIME NOT NULL
+            )
+        ''')
+        
         # Create bookings table
         cursor.execute('''
             CREATE TABLE IF NOT EXISTS bookings (
@@ -99,9 +120,11 @@ def initialize_tables():
                 total_price FLOAT NOT NULL,
                 status VARCHAR(20) DEFAULT 'pending',
                 booking_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                closed_at DATETIME,
                 customer_id INT NOT NULL,
                 owner_id INT NOT NULL,
                 parking_space_id INT NOT NULL,
+                INDEX ix_bookings_status_closed (status, closed_at),
                 FOREIGN KEY (customer_id) REFERENCES users(id) ON DELETE CASCADE,
                 FOREIGN KEY (owner_id) REFERENCES users(id) ON DELETE CASCADE,
                 FOREIGN KEY (parking_space_id) REFERENCES parking_spaces(id) ON DELETE CASCADE
@@ -120,6 +143,151 @@ def initialize_tables():
             )
         ''')
         
+        # Create archive tables for bookings moved out of bookings by
+        # services/archive.py; the parking space may since have been deleted
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS archived_bookings (
+                id INT PRIMARY KEY,
+                start_time DATETIME NOT NULL,
+                end_time DATETIME NOT NULL,
+                total_price FLOAT NOT NULL,
+                status VARCHAR(20) NOT NULL,
+                booking_date DATETIME,
+                closed_at DATETIME,
+                archived_at DATETIME NOT NULL,
+                parking_space_id INT NOT NULL,
+                space_title VARCHAR(200),
+                customer_id INT NOT NULL,
+                owner_id INT NOT NULL,
+                INDEX ix_archived_bookings_customer_start (customer_id, start_time),
+                INDEX ix_archived_bookings_owner_start (owner_id, start_time),
+                INDEX ix_archived_bookings_status_closed (status, closed_at),
+                FOREIGN KEY (customer_id) REFERENCES users(id) ON DELETE CASCADE,
+                FOREIGN KEY (owner_id) REFERENCES users(id) ON DELETE CASCADE
+            )
+        ''')
+        
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS archived_feedbacks (
+                id INT PRIMARY KEY,
+                rating INT NOT NULL,
+                comment TEXT,
+                submitted_at DATETIME,
+                booking_id INT NOT NULL UNIQUE,
+                owner_id INT NOT NULL,
+                INDEX ix_archived_feedbacks_owner_id (owner_id),
+                FOREIGN KEY (booking_id) REFERENCES archived_bookings(id) ON DELETE CASCADE
+            )
+        ''')
+        
+        # Create settlement tables, filled by `flask settle` (services/settlement.py)
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS settlements (
+                id INT AUTO_INCREMENT PRIMARY KEY,
+                period CHAR(7) NOT NULL,
+                booking_count INT NOT NULL DEFAULT 0,
+                gross_amount FLOAT NOT NULL DEFAULT 0,
+                updated_at DATETIME,
+                owner_id INT NOT NULL,
+                UNIQUE KEY uq_settlements_owner_period (owner_id, period),
+                FOREIGN KEY (owner_id) REFERENCES users(id) ON DELETE CASCADE
+            )
+        ''')
+        
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS settlement_runs (
+                period CHAR(7) PRIMARY KEY,
+                last_booking_id INT NOT NULL DEFAULT 0,
+                booking_count INT NOT NULL DEFAULT 0,
+                status VARCHAR(20) NOT NULL DEFAULT 'running',
+                started_at DATETIME,
+                finished_at DATETIME
+            )
+        ''')
+        
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS settlement_lines (
+                booking_id INT PRIMARY KEY,
+                period CHAR(7) NOT NULL,
+                space_title VARCHAR(200),
+                start_time DATETIME NOT NULL,
+                end_time DATETIME NOT NULL,
+                completed_at DATETIME NOT NULL,
+                total_price FLOAT NOT NULL,
+                owner_id INT NOT NULL,
+                INDEX ix_settlement_lines_owner_period (owner_id, period, booking_id),
+                FOREIGN KEY (owner_id) REFERENCES users(id) ON DELETE CASCADE
+            )
+        ''')
+        
+        # Create space_tombstones table
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS space_tombstones (
+                space_id INT PRIMARY KEY,
+                change_seq BIGINT NOT NULL,
+                deleted_at DATETIME NOT NULL,
+                INDEX ix_space_tombstones_change_seq (change_seq)
+            )
+        ''')
+        
+        # Create sync_counters table
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS sync_counters (
+                name VARCHAR(50) PRIMARY KEY,
+                value BIGINT NOT NULL DEFAULT 0
+            )
+        ''')
+        
+        # Create user_locations table
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS user_locations (
+                id INT AUTO_INCREMENT PRIMARY KEY,
+                latitude FLOAT NOT NULL,
+                longitude FLOAT NOT NULL,
+                recorded_at DATETIME NOT NULL,
+                user_id INT NOT NULL,
+                INDEX ix_user_locations_recorded_at (recorded_at),
+                INDEX ix_user_locations_user_recorded (user_id, recorded_at),
+                FOREIGN KEY (user_id) REFERENCES users(id) ON DELETE CASCADE
+            )
+        ''')
+        
+        # Create audit_entries table (services/audit.py), partitioned by month;
+        # `flask audit-partitions` splits p_future into the coming months
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS audit_entries (
+                id BIGINT AUTO_INCREMENT,
+                created_at DATETIME NOT NULL,
+                actor_id INT,
+                action VARCHAR(50) NOT NULL,
+                target_type VARCHAR(30) NOT NULL,
+                target_id INT NOT NULL,
+                before_value TEXT,
+                after_value TEXT,
+                PRIMARY KEY (id, created_at),
+                INDEX ix_audit_entries_created_at (created_at),
+                INDEX ix_audit_entries_actor_created (actor_id, created_at),
+                INDEX ix_audit_entries_target_created (target_type, target_id, created_at)
+            )
+            PARTITION BY RANGE COLUMNS (created_at) (
+                PARTITION p_future VALUES LESS THAN (MAXVALUE)
+            )
+        ''')
+        
+        # Audit entries are append-only; old months are removed by dropping
+        # their partitions, which does not fire the triggers
+        for trigger, event in [
+            ('audit_entries_no_update', 'UPDATE'),
+            ('audit_entries_no_delete', 'DELETE'),
+        ]:
+            if not trigger_exists(cursor, trigger):
+                cursor.execute(f'''
+                    CREATE TRIGGER {trigger} BEFORE {event} ON audit_entries
+                    FOR EACH ROW
+                    SIGNAL SQLSTATE '45000' SET MESSAGE_TEXT = 'Audit entries cannot be changed or deleted'
+                ''')
+        print("Run `flask --app wsgi audit-partitions` monthly to add the audit log partitions.")
+        
         conn.commit()
         cursor.close()
         conn.close()
@@ -129,13 +297,115 @@ def initialize_tables():
         print(f"Error initializing tables: {e}")
         return False
 
+def column_exists(cursor, table, column):
+    """Check whether a column exists in the current database"""
+    cursor.execute(
+        "SELECT COUNT(*) FROM information_schema.COLUMNS "
+        "WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = %s AND COLUMN_NAME = %s",
+        (table, column)
+    )
+    return cursor.fetchone()[0] > 0
+
+def index_exists(cursor, table, index):
+    """Check whether an index exists in the current database"""
+    cursor.execute(
+        "SELECT COUNT(*) FROM information_schema.STATISTICS "
+        "WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = %s AND INDEX_NAME = %s",
+        (table, index)
+    )
+    return cursor.fetchone()[0] > 0
+
+def trigger_exists(cursor, trigger):
+    """Check whether a trigger exists in the current database"""
+    cursor.execute(
+        "SELECT COUNT(*) FROM information_schema.TRIGGERS "
+        "WHERE TRIGGER_SCHEMA = DATABASE() AND TRIGGER_NAME = %s",
+        (trigger,)
+    )
+    return cursor.fetchone()[0] > 0
+
+def upgrade_tables():
+    """Add columns and indexes introduced after a database was first created"""
+    try:
+        db_config_with_db = DB_CONFIG.copy()
+        db_config_with_db['database'] = DATABASE_NAME
+        conn = pymysql.connect(**db_config_with_db)
+        cursor = conn.cursor()
+        
+        # Grid cell of each parking space for the nearest-space search,
+        # computed the same way as services/geo.py (0.05 degree cells)
+        if not column_exists(cursor, 'parking_spaces', 'geo_cell'):
+            cursor.execute("ALTER TABLE parking_spaces ADD COLUMN geo_cell INT AFTER longitude")
+            cursor.execute('''
+                UPDATE parking_spaces
+                SET geo_cell = LEAST(FLOOR((latitude + 90) / 0.05), 3599) * 7200
+                             + MOD(FLOOR((longitude + 180) / 0.05), 7200)
+                WHERE latitude IS NOT NULL AND longitude IS NOT NULL
+            ''')
+        if not index_exists(cursor, 'parking_spaces', 'ix_parking_spaces_geo_cell'):
+            cursor.execute("CREATE INDEX ix_parking_spaces_geo_cell ON parking_spaces (geo_cell)")
+        
+        # Change feed position of each parking space for delta sync; existing
+        # rows are numbered by id and the counter continues after them
+        if not column_exists(cursor, 'parking_spaces', 'change_seq'):
+            cursor.execute("ALTER TABLE parking_spaces ADD COLUMN updated_at DATETIME AFTER created_at")
+            cursor.execute("ALTER TABLE parking_spaces ADD COLUMN change_seq BIGINT AFTER updated_at")
+            cursor.execute("UPDATE parking_spaces SET updated_at = created_at, change_seq = id")
+            cursor.execute('''
+                INSERT INTO sync_counters (name, value)
+                SELECT 'parking_spaces', COALESCE(MAX(id), 0) FROM parking_spaces
+                ON DUPLICATE KEY UPDATE value = GREATEST(value, VALUES(value))
+            ''')
+        if not index_exists(cursor, 'parking_spaces', 'ix_parking_spaces_updated_at'):
+            cursor.execute("CREATE INDEX ix_parking_spaces_updated_at ON parking_spaces (updated_at)")
+        if not index_exists(cursor, 'parking_spaces', 'ix_parking_spaces_change_seq'):
+            cursor.execute("CREATE INDEX ix_parking_spaces_change_seq ON parking_spaces (change_seq)")
+        
+        # Ranking scores and one index per sort order of the listing; the
+        # scores of existing spaces are filled by `flask refresh-rankings`
+        if not column_exists(cursor, 'parking_spaces', 'rank_score'):
+            cursor.execute("ALTER TABLE parking_spaces ADD COLUMN rating_score FLOAT AFTER change_seq")
+            cursor.execute("ALTER TABLE parking_spaces ADD COLUMN rank_score FLOAT AFTER rating_score")
+            print("Run `flask --app wsgi refresh-rankings` to compute the ranking scores.")
+        for index, columns in [
+            ('ix_parking_spaces_active_rank', 'is_active, rank_score, id'),
+            ('ix_parking_spaces_active_price', 'is_active, price_per_hour, id'),
+            ('ix_parking_spaces_active_created', 'is_active, created_at, id'),
+            ('ix_parking_spaces_active_rating', 'is_active, rating_score, id'),
+        ]:
+            if not index_exists(cursor, 'parking_spaces', index):
+                cursor.execute(f"CREATE INDEX {index} ON parking_spaces ({columns})")
+        
+        # When a booking was completed or cancelled, used to pick bookings to
+        # archive; earlier bookings are taken to have closed when they ended
+        if not column_exists(cursor, 'bookings', 'closed_at'):
+            cursor.execute("ALTER TABLE bookings ADD COLUMN closed_at DATETIME AFTER booking_date")
+            cursor.execute(
+                "UPDATE bookings SET closed_at = end_time WHERE status IN ('completed', 'cancelled')"
+            )
+        if not index_exists(cursor, 'bookings', 'ix_bookings_status_closed'):
+            cursor.execute("CREATE INDEX ix_bookings_status_closed ON bookings (status, closed_at)")
+        if not index_exists(cursor, 'archived_bookings', 'ix_archived_bookings_status_closed'):
+            cursor.execute(
+                "CREATE INDEX ix_archived_bookings_status_closed ON archived_bookings (status, closed_at)"
+            )
+        
+        conn.commit()
+        cursor.close()
+        conn.close()
+        print("All tables are up to date.")
+        return True
+    except Exception as e:
+        print(f"Error upgrading tables: {e}")
+        return False
+
 def main():
     """Main function to create database and initialize tables"""
     print("Initializing Smart Park System database for XAMPP MySQL...")
     
     if create_database():
         print("Database creation successful.")
-        if initialize_tables():
+        if initialize_tables() and upgrade_tables():
             print("Database initialization completed successfully!")
         else:
             print("Failed to initialize tables.")
@@ -1,3 +1,62 @@
+import sqlite3
+from contextvars import ContextVar
+
+from flask import current_app
 from flask_sqlalchemy import SQLAlchemy
+from flask_sqlalchemy.session import Session
+from sqlalchemy import event, inspect
+from sqlalchemy.engine import Engine
+from sqlalchemy.sql.util import find_tables
+
+# Tables kept in the shard of their region when SHARD_REGIONS is configured
+# (services/sharding.py); all other tables stay in the default database
+SHARDED_TABLES = frozenset({
+    'parking_spaces', 'parking_images', 'bookings', 'feedbacks',
+    'archived_bookings', 'archived_feedbacks', 'space_tombstones', 'sync_counters',
+    'settlements', 'settlement_runs', 'settlement_lines', 'image_deletions',
+})
+
+# Region whose shard the sharded tables are read from and written to
+current_region = ContextVar('current_region', default=None)
+
+
+class ShardingError(Exception):
+    """A sharded table was used without a region, or across regions"""
+
+
+def shard_bind_key(region):
+    """Return the SQLALCHEMY_BINDS key of a region's shard"""
+    return f'shard:{region}'
+
+
+class RoutingSession(Session):
+    """Session that sends statements on sharded tables to the current region's shard"""
+
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        if bind is None and current_app.config.get('SHARD_REGIONS'):
+            if mapper is not None:
+                sharded = inspect(mapper).local_table.name in SHARDED_TABLES
+            elif clause is not None:
+                sharded = any(table.name in SHARDED_TABLES
+                              for table in find_tables(clause, include_crud=True))
+            else:
+                # Session.connection(), e.g. for counters in flush hooks
+                sharded = current_region.get() is not None
+            if sharded:
+                region = current_region.get()
+                if region is None:
+                    raise ShardingError('No region selected for a query on sharded tables')
+                return self._db.engines[shard_bind_key(region)]
+        return super().get_bind(mapper=mapper, clause=clause, bind=bind, **kwargs)
+
+
+db = SQLAlchemy(session_options={'class_': RoutingSession})
+
 
-db = SQLAlchemy()
\ No newline at end of file
+@event.listens_for(Engine, 'connect')
+def _enable_sqlite_foreign_keys(dbapi_connection, connection_record):
+    """SQLite only enforces foreign keys, and ON DELETE CASCADE, when asked to"""
+    if isinstance(dbapi_connection, sqlite3.Connection):
+        cursor = dbapi_connection.cursor()
+        cursor.execute('PRAGMA foreign_keys=ON')
+        cursor.close()
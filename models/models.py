@@ -35,18 +35,13 @@ class User(db.Model, UserMixin):
     
     def get_average_rating(self):
         """Calculate the average rating for this user as a parking space owner"""
-        # Get all bookings where this user is the owner and have feedback
-        bookings_with_feedback = [booking for booking in self.bookings_received if booking.feedback]
-        
-        if not bookings_with_feedback:
-            return None
-            
-        total_rating = sum(booking.feedback.rating for booking in bookings_with_feedback)
-        return round(total_rating / len(bookings_with_feedback), 1)
+        from services.ratings import owner_rating_stats
+        return owner_rating_stats([self.id]).get(self.id, (None, 0))[0]
     
     def get_total_ratings(self):
         """Get the total number of ratings for this user as a parking space owner"""
-        return len([booking for booking in self.bookings_received if booking.feedback])
+        from services.ratings import owner_rating_stats
+        return owner_rating_stats([self.id]).get(self.id, (None, 0))[1]
     
     def __repr__(self):
         return f'<User {self.username}>'
@@ -54,6 +49,13 @@ class User(db.Model, UserMixin):
 class ParkingSpace(db.Model):
     """Model for parking spaces listed by owners"""
     __tablename__ = 'parking_spaces'
+    # One index per sort order of the listing, see services/ranking.py
+    __table_args__ = (
+        db.Index('ix_parking_spaces_active_rank', 'is_active', 'rank_score', 'id'),
+        db.Index('ix_parking_spaces_active_price', 'is_active', 'price_per_hour', 'id'),
+        db.Index('ix_parking_spaces_active_created', 'is_active', 'created_at', 'id'),
+        db.Index('ix_parking_spaces_active_rating', 'is_active', 'rating_score', 'id'),
+    )
     
     id = db.Column(db.Integer, primary_key=True)
     title = db.Column(db.String(200), nullable=False)
@@ -61,24 +63,52 @@ class ParkingSpace(db.Model):
     address = db.Column(db.String(300), nullable=False)
     latitude = db.Column(db.Float, nullable=True)
     longitude = db.Column(db.Float, nullable=True)
+    geo_cell = db.Column(db.Integer, nullable=True, index=True)  # Grid cell of the coordinates, see services/geo.py
     price_per_hour = db.Column(db.Float, nullable=False)
     availability_start = db.Column(db.Time, nullable=False)
     availability_end = db.Column(db.Time, nullable=False)
     is_active = db.Column(db.Boolean, default=True, nullable=False)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow, index=True)
+    change_seq = db.Column(db.BigInteger, nullable=True, index=True)  # Position in the change feed, see services/sync.py
+    rating_score = db.Column(db.Float, nullable=True)  # Smoothed owner rating, see services/ranking.py
+    rank_score = db.Column(db.Float, nullable=True)  # Rating blended with price, see services/ranking.py
     
     # Foreign key to owner
     owner_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False)
     
-    # Relationship with bookings
-    bookings = db.relationship('Booking', backref='parking_space', lazy=True, cascade='all, delete-orphan')
+    # Relationship with bookings; the database deletes them with the space
+    bookings = db.relationship('Booking', backref='parking_space', lazy=True, cascade='all, delete-orphan',
+                               passive_deletes=True)
     
-    # Relationship with images
-    images = db.relationship('ParkingImage', backref='parking_space', lazy=True, cascade='all, delete-orphan')
+    # Relationship with images; the database deletes the rows, services/reaper.py the files
+    images = db.relationship('ParkingImage', backref='parking_space', lazy=True, cascade='all, delete-orphan',
+                             passive_deletes=True)
     
     def __repr__(self):
         return f'<ParkingSpace {self.title}>'
 
+class SpaceTombstone(db.Model):
+    """Model recording deleted parking spaces for delta sync clients"""
+    __tablename__ = 'space_tombstones'
+    
+    space_id = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    change_seq = db.Column(db.BigInteger, nullable=False, index=True)
+    deleted_at = db.Column(db.DateTime, default=datetime.utcnow, nullable=False)
+    
+    def __repr__(self):
+        return f'<SpaceTombstone {self.space_id}>'
+
+class SyncCounter(db.Model):
+    """Model for named monotonic counters such as the parking space change feed"""
+    __tablename__ = 'sync_counters'
+    
+    name = db.Column(db.String(50), primary_key=True)
+    value = db.Column(db.BigInteger, nullable=False, default=0)
+    
+    def __repr__(self):
+        return f'<SyncCounter {self.name}={self.value}>'
+
 class ParkingImage(db.Model):
     """Model for storing parking space images"""
     __tablename__ = 'parking_images'
@@ -89,14 +119,28 @@ class ParkingImage(db.Model):
     uploaded_at = db.Column(db.DateTime, default=datetime.utcnow)
     
     # Foreign key to parking space
-    parking_space_id = db.Column(db.Integer, db.ForeignKey('parking_spaces.id'), nullable=False)
+    parking_space_id = db.Column(db.Integer, db.ForeignKey('parking_spaces.id', ondelete='CASCADE'), nullable=False)
     
     def __repr__(self):
         return f'<ParkingImage {self.id}>'
 
+class ImageDeletion(db.Model):
+    """Model queueing the files of deleted images for the reaper"""
+    __tablename__ = 'image_deletions'
+    
+    id = db.Column(db.Integer, primary_key=True)
+    image_url = db.Column(db.String(300), nullable=False)
+    queued_at = db.Column(db.DateTime, default=datetime.utcnow, nullable=False)
+    
+    def __repr__(self):
+        return f'<ImageDeletion {self.image_url}>'
+
 class Booking(db.Model):
     """Model for parking space bookings"""
     __tablename__ = 'bookings'
+    __table_args__ = (
+        db.Index('ix_bookings_status_closed', 'status', 'closed_at'),
+    )
     
     id = db.Column(db.Integer, primary_key=True)
     start_time = db.Column(db.DateTime, nullable=False)
@@ -104,14 +148,16 @@ class Booking(db.Model):
     total_price = db.Column(db.Float, nullable=False)
     status = db.Column(db.String(20), default='pending', nullable=False)  # pending, confirmed, cancelled, completed
     booking_date = db.Column(db.DateTime, default=datetime.utcnow)
+    closed_at = db.Column(db.DateTime, nullable=True)  # When the booking was completed or cancelled
     
     # Foreign keys
     customer_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False)
     owner_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False)
-    parking_space_id = db.Column(db.Integer, db.ForeignKey('parking_spaces.id'), nullable=False)
+    parking_space_id = db.Column(db.Integer, db.ForeignKey('parking_spaces.id', ondelete='CASCADE'), nullable=False)
     
     # Relationship with feedback
-    feedback = db.relationship('Feedback', backref='booking', uselist=False, cascade='all, delete-orphan')
+    feedback = db.relationship('Feedback', backref='booking', uselist=False, cascade='all, delete-orphan',
+                               passive_deletes=True)
     
     def __repr__(self):
         return f'<Booking {self.id}>'
@@ -126,7 +172,160 @@ class Feedback(db.Model):
     submitted_at = db.Column(db.DateTime, default=datetime.utcnow)
     
     # Foreign key to booking
-    booking_id = db.Column(db.Integer, db.ForeignKey('bookings.id'), nullable=False)
+    booking_id = db.Column(db.Integer, db.ForeignKey('bookings.id', ondelete='CASCADE'), nullable=False)
+    
+    def __repr__(self):
+        return f'<Feedback {self.id}>'
+
+class UserLocation(db.Model):
+    """Model for location pings shared by users"""
+    __tablename__ = 'user_locations'
+    __table_args__ = (
+        db.Index('ix_user_locations_user_recorded', 'user_id', 'recorded_at'),
+    )
+    
+    id = db.Column(db.Integer, primary_key=True)
+    latitude = db.Column(db.Float, nullable=False)
+    longitude = db.Column(db.Float, nullable=False)
+    recorded_at = db.Column(db.DateTime, default=datetime.utcnow, nullable=False, index=True)
+    
+    # Foreign key to user
+    user_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False)
+    
+    def __repr__(self):
+        return f'<UserLocation {self.id}>'
+
+# Booking statuses after which a booking never changes again
+TERMINAL_BOOKING_STATUSES = ('completed', 'cancelled')
+
+@db.event.listens_for(Booking.status, 'set')
+def _record_closed_at(booking, value, oldvalue, initiator):
+    """Remember when a booking reached a terminal status"""
+    if value in TERMINAL_BOOKING_STATUSES and value != oldvalue:
+        booking.closed_at = datetime.utcnow()
+
+class ArchivedBooking(db.Model):
+    """Booking moved out of the bookings table long after it was closed"""
+    __tablename__ = 'archived_bookings'
+    __table_args__ = (
+        db.Index('ix_archived_bookings_customer_start', 'customer_id', 'start_time'),
+        db.Index('ix_archived_bookings_owner_start', 'owner_id', 'start_time'),
+        db.Index('ix_archived_bookings_status_closed', 'status', 'closed_at'),
+    )
+    
+    # Same id as the booking had
+    id = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    start_time = db.Column(db.DateTime, nullable=False)
+    end_time = db.Column(db.DateTime, nullable=False)
+    total_price = db.Column(db.Float, nullable=False)
+    status = db.Column(db.String(20), nullable=False)
+    booking_date = db.Column(db.DateTime)
+    closed_at = db.Column(db.DateTime)
+    archived_at = db.Column(db.DateTime, default=datetime.utcnow, nullable=False)
+    
+    # The space may be deleted later, so its title is kept and its id is not a foreign key
+    parking_space_id = db.Column(db.Integer, nullable=False)
+    space_title = db.Column(db.String(200))
+    customer_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False)
+    owner_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False)
+    
+    customer = db.relationship('User', foreign_keys=[customer_id])
+    booking_owner = db.relationship('User', foreign_keys=[owner_id])
+    feedback = db.relationship('ArchivedFeedback', backref='booking', uselist=False)
+    
+    def __repr__(self):
+        return f'<ArchivedBooking {self.id}>'
+
+class ArchivedFeedback(db.Model):
+    """Feedback of an archived booking"""
+    __tablename__ = 'archived_feedbacks'
+    
+    # Same id as the feedback had
+    id = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    rating = db.Column(db.Integer, nullable=False)
+    comment = db.Column(db.Text, nullable=True)
+    submitted_at = db.Column(db.DateTime)
+    
+    booking_id = db.Column(db.Integer, db.ForeignKey('archived_bookings.id'), nullable=False, unique=True)
+    # Copied from the booking so owner ratings need no join
+    owner_id = db.Column(db.Integer, nullable=False, index=True)
+    
+    def __repr__(self):
+        return f'<ArchivedFeedback {self.id}>'
+
+class Settlement(db.Model):
+    """What an owner earned from the bookings completed in one period"""
+    __tablename__ = 'settlements'
+    __table_args__ = (
+        db.UniqueConstraint('owner_id', 'period', name='uq_settlements_owner_period'),
+    )
+    
+    id = db.Column(db.Integer, primary_key=True)
+    period = db.Column(db.String(7), nullable=False)  # YYYY-MM
+    booking_count = db.Column(db.Integer, default=0, nullable=False)
+    gross_amount = db.Column(db.Float, default=0.0, nullable=False)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+    
+    owner_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False)
+    
+    owner = db.relationship('User')
+    
+    def __repr__(self):
+        return f'<Settlement {self.owner_id} {self.period}>'
+
+class SettlementRun(db.Model):
+    """Progress of the settlement of one period, so a run can resume"""
+    __tablename__ = 'settlement_runs'
+    
+    period = db.Column(db.String(7), primary_key=True)
+    # Every completed booking up to this id has been counted
+    last_booking_id = db.Column(db.Integer, default=0, nullable=False)
+    booking_count = db.Column(db.Integer, default=0, nullable=False)
+    status = db.Column(db.String(20), default='running', nullable=False)  # running, complete
+    started_at = db.Column(db.DateTime, default=datetime.utcnow)
+    finished_at = db.Column(db.DateTime, nullable=True)
+    
+    def __repr__(self):
+        return f'<SettlementRun {self.period} {self.status}>'
+
+class SettlementLine(db.Model):
+    """A booking counted in a settlement, as it was when the period was settled"""
+    __tablename__ = 'settlement_lines'
+    __table_args__ = (
+        db.Index('ix_settlement_lines_owner_period', 'owner_id', 'period', 'booking_id'),
+    )
+    
+    # No foreign key: the statement outlives the booking and its space
+    booking_id = db.Column(db.Integer, primary_key=True)
+    period = db.Column(db.String(7), nullable=False)  # YYYY-MM
+    space_title = db.Column(db.String(200), nullable=True)
+    start_time = db.Column(db.DateTime, nullable=False)
+    end_time = db.Column(db.DateTime, nullable=False)
+    completed_at = db.Column(db.DateTime, nullable=False)
+    total_price = db.Column(db.Float, nullable=False)
+    
+    owner_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False)
+    
+    def __repr__(self):
+        return f'<SettlementLine {self.period} {self.booking_id}>'
+
+class AuditEntry(db.Model):
+    """Who changed what on a user, space or booking; rows are never updated"""
+    __tablename__ = 'audit_entries'
+    __table_args__ = (
+        db.Index('ix_audit_entries_actor_created', 'actor_id', 'created_at'),
+        db.Index('ix_audit_entries_target_created', 'target_type', 'target_id', 'created_at'),
+    )
+    
+    id = db.Column(db.BigInteger().with_variant(db.Integer, 'sqlite'), primary_key=True)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow, nullable=False, index=True)
+    # No foreign keys: entries outlive the rows they describe
+    actor_id = db.Column(db.Integer, nullable=True)  # None for commands and background jobs
+    action = db.Column(db.String(50), nullable=False)  # e.g. booking.status, user.is_admin
+    target_type = db.Column(db.String(30), nullable=False)
+    target_id = db.Column(db.Integer, nullable=False)
+    before_value = db.Column(db.Text, nullable=True)  # JSON
+    after_value = db.Column(db.Text, nullable=True)   # JSON
     
     def __repr__(self):
-        return f'<Feedback {self.id}>'
\ No newline at end of file
+        return f'<AuditEntry {self.action} {self.target_type} {self.target_id}>'
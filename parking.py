@@ -1,18 +1,98 @@
-from flask import Blueprint, render_template, redirect, url_for, flash, request, abort, jsonify, current_app
+from flask import Blueprint, render_template, redirect, url_for, flash, request, abort, jsonify, current_app, Response, stream_with_context
 from flask_login import login_required, current_user
-from forms.parking import ParkingSpaceForm, BookingForm
+from forms.parking import ParkingSpaceForm, BookingForm, RecurringBookingForm
 from forms.feedback import FeedbackForm
-from models.models import ParkingSpace, Booking, Feedback, ParkingImage, db
+from models.models import User, ParkingSpace, Booking, Feedback, ParkingImage, db
+from services.pricing import get_pricing_engine
+from services.bookings import expand_occurrences, span_occurrences, create_recurring_bookings, MAX_OCCURRENCES
+from services.geo import area_filters, nearest_spaces, parse_near
+from services.locations import get_location_buffer
+from services.events import get_broker, format_sse
+from services import sync
+from services.ratings import owner_rating_stats
+from services.payloads import encode_compact
+from services.fragments import space_cards
+from services.snapshot import get_snapshot, snapshot_nearest
+from services.archive import booking_history
+from services.settlement import owner_settlements, period_settlements, statement_csv
+from services.ranking import SORT_MODES, DEFAULT_SORT, sorted_spaces
+from services.reaper import queue_image_files, wake_reaper
+from services.sharding import gather, same_region
+from services.uploads import UploadError, allowed_file, attach_uploads, get_upload_store, parse_upload_ids
 from datetime import datetime, timedelta
 import os
+import time
 from werkzeug.utils import secure_filename
 
-# Allowed file extensions
-ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg', 'gif'}
+def upload_path(filename):
+    """Return where to save an uploaded file, creating the upload folder on first use"""
+    folder = current_app.config['UPLOAD_FOLDER']
+    os.makedirs(folder, exist_ok=True)
+    return os.path.join(folder, filename)
 
-def allowed_file(filename):
-    return '.' in filename and \
-           filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
+def save_image_files(files):
+    """Save images posted with a form and return their URLs
+
+    Called before the database work of a request, so no transaction is
+    open while the files are written.
+    """
+    image_urls = []
+    for file in files:
+        if file and allowed_file(file.filename):
+            filename = secure_filename(file.filename)
+            # Add timestamp to filename to avoid conflicts
+            timestamp = datetime.now().strftime("%Y%m%d_%H%M%S_")
+            filename = timestamp + filename
+            
+            # Save file to upload folder
+            file.save(upload_path(filename))
+            
+            # Create relative URL for the image
+            image_urls.append(url_for('static', filename=f'uploads/{filename}'))
+    return image_urls
+
+# Limits of the "near" search mode
+DEFAULT_NEAR_K = 20
+MAX_NEAR_K = 100
+DEFAULT_NEAR_MAX_KM = 10.0
+MAX_NEAR_MAX_KM = 100.0
+
+def parse_near_args(args):
+    """Return (latitude, longitude, k, max_km) of a near query, or None without one"""
+    near = args.get('near')
+    if not near:
+        return None
+    latitude, longitude = parse_near(near)
+    k = args.get('k', DEFAULT_NEAR_K, type=int)
+    max_km = args.get('max_km', DEFAULT_NEAR_MAX_KM, type=float)
+    if not 1 <= k <= MAX_NEAR_K:
+        raise ValueError(f'k must be between 1 and {MAX_NEAR_K}')
+    if not 0 < max_km <= MAX_NEAR_MAX_KM:
+        raise ValueError(f'max_km must be between 0 and {MAX_NEAR_MAX_KM:g}')
+    return latitude, longitude, k, max_km
+
+def parse_bbox(value):
+    """Parse a 'south,west,north,east' query parameter, raising ValueError when invalid"""
+    parts = [float(part) for part in value.split(',')]
+    if len(parts) != 4:
+        raise ValueError('bbox must be given as "south,west,north,east"')
+    south, west, north, east = parts
+    if not (-90 <= south <= north <= 90 and -180 <= west <= east <= 180):
+        raise ValueError('bbox is out of range')
+    return south, west, north, east
+
+def parse_location_ping(data):
+    """Return (latitude, longitude) of a location ping, raising ValueError when invalid"""
+    if 'latitude' not in data or 'longitude' not in data:
+        raise ValueError('Latitude and longitude are required')
+    try:
+        latitude = float(data['latitude'])
+        longitude = float(data['longitude'])
+    except (TypeError, ValueError):
+        raise ValueError('Latitude and longitude must be numbers')
+    if not (-90 <= latitude <= 90 and -180 <= longitude <= 180):
+        raise ValueError('Latitude or longitude is out of range')
+    return latitude, longitude
 
 parking = Blueprint('parking', __name__)
 
@@ -23,13 +103,25 @@ def list_spaces():
     search_query = request.args.get('search', '')
     min_price = request.args.get('min_price', type=float)
     max_price = request.args.get('max_price', type=float)
+    after = request.args.get('after', type=int)
+    before = request.args.get('before', type=int)
+    
+    try:
+        near = parse_near_args(request.args)
+    except ValueError as e:
+        flash(str(e), 'error')
+        near = None
     
-    # Base query for active parking spaces
-    query = ParkingSpace.query.filter_by(is_active=True)
+    # Spaces near a location are sorted by distance unless another order is chosen
+    sort = request.args.get('sort') or ('distance' if near else DEFAULT_SORT)
+    if sort not in SORT_MODES or (sort == 'distance' and not near):
+        sort = DEFAULT_SORT
+    
+    filters = []
     
     # Apply search filter
     if search_query:
-        query = query.filter(
+        filters.append(
             db.or_(
                 ParkingSpace.title.contains(search_query),
                 ParkingSpace.description.contains(search_query),
@@ -39,18 +131,49 @@ def list_spaces():
     
     # Apply price filters
     if min_price is not None:
-        query = query.filter(ParkingSpace.price_per_hour >= min_price)
+        filters.append(ParkingSpace.price_per_hour >= min_price)
     if max_price is not None:
-        query = query.filter(ParkingSpace.price_per_hour <= max_price)
-    
-    # Execute query
-    spaces = query.all()
+        filters.append(ParkingSpace.price_per_hour <= max_price)
+    
+    distances = {}
+    has_previous = has_next = False
+    if sort == 'distance':
+        # Nearest spaces first, limited to k results
+        latitude, longitude, k, max_km = near
+        # The shared snapshot can rank by distance and price, but not search text
+        snapshot = get_snapshot() if not search_query else None
+        if snapshot is not None:
+            nearest = snapshot_nearest(snapshot, latitude, longitude, k, max_km, min_price, max_price)
+        else:
+            nearest = nearest_spaces(latitude, longitude, k=k, max_km=max_km, filters=filters)
+        spaces = [space for space, _ in nearest]
+        distances = {space.id: distance for space, distance in nearest}
+    else:
+        if near:
+            # Other orders list the spaces in the box max_km around the location
+            latitude, longitude, _, max_km = near
+            filters.extend(area_filters(latitude, longitude, max_km))
+        # Read in index order of the sort, one page at a time from the neighbouring page's edge
+        spaces, has_more = sorted_spaces(filters, sort, current_app.config['SPACES_PER_PAGE'],
+                                         after=after, before=before)
+        if after is None and before is not None:
+            has_previous, has_next = has_more, True
+        else:
+            has_previous, has_next = after is not None, has_more
     
     return render_template('parking/list.html', 
                          spaces=spaces, 
+                         cards=space_cards(spaces, 'list'),
+                         distances=distances,
+                         near=request.args.get('near', '') if near else '',
                          search_query=search_query,
                          min_price=min_price,
-                         max_price=max_price)
+                         max_price=max_price,
+                         sort=sort,
+                         has_previous=has_previous and bool(spaces),
+                         has_next=has_next and bool(spaces),
+                         page_args={key: value for key, value in request.args.items()
+                                    if key not in ('after', 'before')})
 
 @parking.route('/space/<int:space_id>')
 def view_space(space_id):
@@ -82,11 +205,8 @@ def book_space(space_id):
             flash('End time must be after start time.', 'error')
             return render_template('parking/book_space.html', form=form, space=space)
         
-        # Calculate duration in hours
-        duration = (end_datetime - start_datetime).total_seconds() / 3600
-        
-        # Calculate total price
-        total_price = duration * space.price_per_hour
+        # Calculate total price from the demand-based hourly price grid
+        total_price = get_pricing_engine().quote(space, start_datetime, end_datetime)
         
         # Create booking
         booking = Booking(
@@ -107,11 +227,80 @@ def book_space(space_id):
     
     return render_template('parking/book_space.html', form=form, space=space)
 
+@parking.route('/space/<int:space_id>/book-recurring', methods=['GET', 'POST'])
+@login_required
+def book_recurring(space_id):
+    """Book a parking space on a weekly pattern, every day of a date range or for a span of days"""
+    space = ParkingSpace.query.get_or_404(space_id)
+    
+    # Check if the user is trying to book their own space
+    if space.owner_id == current_user.id:
+        flash('You cannot book your own parking space.', 'error')
+        return redirect(url_for('parking.view_space', space_id=space_id))
+    
+    form = RecurringBookingForm()
+    if form.validate_on_submit():
+        if form.end_date.data < form.start_date.data:
+            flash('The end date must not be before the start date.', 'error')
+            return render_template('parking/book_recurring.html', form=form, space=space)
+        
+        if form.pattern.data == 'span':
+            # One booking from the start time on the start date to the end time on the end date
+            occurrences = span_occurrences(form.start_date.data, form.end_date.data,
+                                           form.start_time.data, form.end_time.data)
+            if occurrences[0][1] <= occurrences[0][0]:
+                flash('The end must be after the start.', 'error')
+                return render_template('parking/book_recurring.html', form=form, space=space)
+        else:
+            if form.end_time.data <= form.start_time.data:
+                flash('End time must be after start time.', 'error')
+                return render_template('parking/book_recurring.html', form=form, space=space)
+            
+            if form.pattern.data == 'weekly' and not form.weekdays.data:
+                flash('Select at least one weekday.', 'error')
+                return render_template('parking/book_recurring.html', form=form, space=space)
+            
+            weekdays = set(form.weekdays.data) if form.pattern.data == 'weekly' else None
+            occurrences = expand_occurrences(form.start_date.data, form.end_date.data,
+                                             form.start_time.data, form.end_time.data, weekdays,
+                                             limit=MAX_OCCURRENCES + 1)
+        
+        if not occurrences:
+            flash('No dates in that range match the selected weekdays.', 'error')
+            return render_template('parking/book_recurring.html', form=form, space=space)
+        
+        if len(occurrences) > MAX_OCCURRENCES:
+            flash(f'A recurring request can cover at most {MAX_OCCURRENCES} dates.', 'error')
+            return render_template('parking/book_recurring.html', form=form, space=space)
+        
+        results = create_recurring_bookings(space, current_user.id, occurrences,
+                                            all_or_nothing=not form.allow_partial.data)
+        booked = [result for result in results if result['status'] == 'booked']
+        
+        if not booked and form.pattern.data == 'span':
+            flash('That span overlaps a booking that is already taken.', 'error')
+            return render_template('parking/book_recurring.html', form=form, space=space, results=results)
+        
+        if not booked:
+            flash('None of the dates could be booked because some are already taken.', 'error')
+            return render_template('parking/book_recurring.html', form=form, space=space, results=results)
+        
+        if len(booked) < len(results):
+            flash(f'{len(booked)} of {len(results)} dates requested. The others are already taken.', 'info')
+            return render_template('parking/book_recurring.html', form=form, space=space, results=results)
+        
+        flash(f'{len(booked)} booking requests sent successfully! Please wait for the owner to confirm.', 'success')
+        return redirect(url_for('parking.my_bookings'))
+    
+    return render_template('parking/book_recurring.html', form=form, space=space)
+
 @parking.route('/my-spaces')
 @login_required
 def my_spaces():
     """List parking spaces owned by current user"""
-    spaces = ParkingSpace.query.filter_by(owner_id=current_user.id).all()
+    # In every region, with the images loaded from the space's own shard
+    spaces = gather(lambda: ParkingSpace.query.filter_by(owner_id=current_user.id)
+                    .options(db.selectinload(ParkingSpace.images)).all())
     return render_template('parking/my_spaces.html', spaces=spaces)
 
 @parking.route('/add-space', methods=['GET', 'POST'])
@@ -120,6 +309,8 @@ def add_space():
     """Add a new parking space"""
     form = ParkingSpaceForm()
     if form.validate_on_submit():
+        image_urls = save_image_files(request.files.getlist('images')) if form.images.data else []
+        
         space = ParkingSpace(
             title=form.title.data,
             description=form.description.data,
@@ -136,37 +327,22 @@ def add_space():
         db.session.add(space)
         db.session.flush()  # Get the space ID before committing
         
-        # Handle image uploads
-        if form.images.data:
-            uploaded_files = request.files.getlist("images")
-            primary_set = False
-            
-            for file in uploaded_files:
-                if file and allowed_file(file.filename):
-                    filename = secure_filename(file.filename)
-                    # Add timestamp to filename to avoid conflicts
-                    timestamp = datetime.now().strftime("%Y%m%d_%H%M%S_")
-                    filename = timestamp + filename
-                    
-                    # Save file to upload folder
-                    file_path = os.path.join(current_app.config['UPLOAD_FOLDER'], filename)
-                    file.save(file_path)
-                    
-                    # Create relative URL for the image
-                    image_url = url_for('static', filename=f'uploads/{filename}')
-                    
-                    # Create ParkingImage record
-                    parking_image = ParkingImage(
-                        image_url=image_url,
-                        is_primary=not primary_set,  # First image is primary
-                        parking_space_id=space.id
-                    )
-                    
-                    db.session.add(parking_image)
-                    primary_set = True  # Only first image is primary
+        # Images posted with the form; the first one is primary
+        for i, image_url in enumerate(image_urls):
+            db.session.add(ParkingImage(
+                image_url=image_url,
+                is_primary=i == 0,
+                parking_space_id=space.id
+            ))
         
         db.session.commit()
         
+        # Images uploaded in chunks beforehand, attached in their own transaction
+        try:
+            attach_uploads(space, parse_upload_ids(form.upload_ids.data))
+        except UploadError as e:
+            flash(f'Some images could not be added: {e}', 'warning')
+        
         flash('Parking space added successfully!', 'success')
         return redirect(url_for('parking.my_spaces'))
     
@@ -184,6 +360,13 @@ def edit_space(space_id):
     
     form = ParkingSpaceForm(obj=space)
     if form.validate_on_submit():
+        # A space stays in the shard of the region it was added in
+        if not same_region(space.id, form.latitude.data or None, form.longitude.data or None, form.address.data):
+            flash('A parking space cannot be moved to another region. Please add it as a new space.', 'error')
+            return render_template('parking/edit_space.html', form=form, space=space)
+        
+        image_urls = save_image_files(request.files.getlist('images')) if form.images.data else []
+        
         space.title = form.title.data
         space.description = form.description.data
         space.address = form.address.data
@@ -195,41 +378,20 @@ def edit_space(space_id):
         space.is_active = form.is_active.data
         
         # Handle image uploads
-        if form.images.data:
-            uploaded_files = request.files.getlist("images")
+        for image_url in image_urls:
+            # Make this the primary image if the space has none yet
+            is_primary = not any(img.is_primary for img in space.images)
             
-            for file in uploaded_files:
-                if file and allowed_file(file.filename):
-                    filename = secure_filename(file.filename)
-                    # Add timestamp to filename to avoid conflicts
-                    timestamp = datetime.now().strftime("%Y%m%d_%H%M%S_")
-                    filename = timestamp + filename
-                    
-                    # Save file to upload folder
-                    file_path = os.path.join(current_app.config['UPLOAD_FOLDER'], filename)
-                    file.save(file_path)
-                    
-                    # Create relative URL for the image
-                    image_url = url_for('static', filename=f'uploads/{filename}')
-                    
-                    # Check if this should be the primary image
-                    is_primary = False
-                    if not space.images:  # If no images exist yet, make this primary
-                        is_primary = True
-                    elif not any(img.is_primary for img in space.images):
-                        is_primary = True  # If no primary image exists, make this one primary
-                    
-                    # Create ParkingImage record
-                    parking_image = ParkingImage(
-                        image_url=image_url,
-                        is_primary=is_primary,
-                        parking_space_id=space.id
-                    )
-                    
-                    db.session.add(parking_image)
+            space.images.append(ParkingImage(image_url=image_url, is_primary=is_primary))
         
         db.session.commit()
         
+        # Images uploaded in chunks beforehand, attached in their own transaction
+        try:
+            attach_uploads(space, parse_upload_ids(form.upload_ids.data))
+        except UploadError as e:
+            flash(f'Some images could not be added: {e}', 'warning')
+        
         flash('Parking space updated successfully!', 'success')
         return redirect(url_for('parking.my_spaces'))
     
@@ -245,8 +407,12 @@ def delete_space(space_id):
     if space.owner_id != current_user.id:
         abort(403)
     
+    # Bookings, feedback and images are deleted by the database (ON DELETE
+    # CASCADE) without being loaded; the image files are queued for the reaper
+    queue_image_files(space.id)
     db.session.delete(space)
     db.session.commit()
+    wake_reaper()
     
     flash('Parking space deleted successfully!', 'success')
     return redirect(url_for('parking.my_spaces'))
@@ -255,14 +421,54 @@ def delete_space(space_id):
 @login_required
 def my_bookings():
     """List bookings made by current user"""
+    # Bookings of every region, with their space and feedback loaded from
+    # the booking's own shard
+    def bookings_where(column):
+        return gather(lambda: Booking.query.filter(column == current_user.id)
+                      .options(db.joinedload(Booking.parking_space), db.joinedload(Booking.feedback))
+                      .order_by(Booking.id).all())
     # Get bookings made by current user
-    bookings = current_user.bookings_made
+    bookings = bookings_where(Booking.customer_id)
     # Get bookings received by current user (as owner)
-    received_bookings = current_user.bookings_received
+    received_bookings = bookings_where(Booking.owner_id)
     return render_template('parking/my_bookings.html', 
                          bookings=bookings, 
                          received_bookings=received_bookings)
 
+@parking.route('/my-bookings/history')
+@login_required
+def booking_history_view():
+    """List archived bookings made or received by current user"""
+    received = request.args.get('view') == 'received'
+    page = max(request.args.get('page', 1, type=int), 1)
+    bookings, has_more = booking_history(current_user.id, received, page)
+    # Users are not in the region shards, so their names are looked up apart
+    user_ids = {booking.customer_id if received else booking.owner_id for booking in bookings}
+    usernames = dict(db.session.query(User.id, User.username).filter(User.id.in_(user_ids)).all()) if user_ids else {}
+    return render_template('parking/booking_history.html',
+                         bookings=bookings,
+                         usernames=usernames,
+                         received=received,
+                         page=page,
+                         has_more=has_more)
+
+@parking.route('/statements')
+@login_required
+def statements():
+    """List the settlements of current user's earnings as owner"""
+    return render_template('parking/statements.html', settlements=owner_settlements(current_user.id))
+
+@parking.route('/statements/<period>.csv')
+@login_required
+def download_statement(period):
+    """Download the CSV statement of one settled month"""
+    settlements = period_settlements(current_user.id, period)
+    if not settlements:
+        abort(404)
+    return Response(stream_with_context(statement_csv(settlements)), mimetype='text/csv', headers={
+        'Content-Disposition': f'attachment; filename=statement-{period}.csv'
+    })
+
 @parking.route('/booking/<int:booking_id>/confirm', methods=['POST'])
 @login_required
 def confirm_booking(booking_id):
@@ -370,6 +576,13 @@ def submit_feedback(booking_id):
 @parking.route('/map')
 def map_view():
     """Display the map with parking spaces and user location"""
+    snapshot = get_snapshot()
+    if snapshot is not None:
+        spaces = snapshot.spaces()
+        details = {space.id: (space.primary_image_url, space.owner_username,
+                              space.owner_rating, space.owner_total_ratings) for space in spaces}
+        return render_template('parking/map.html', spaces=spaces, cards=space_cards(spaces, 'map', details))
+    
     # Get all active parking spaces with coordinates
     spaces = ParkingSpace.query.filter(
         ParkingSpace.is_active == True,
@@ -377,24 +590,193 @@ def map_view():
         ParkingSpace.longitude.isnot(None)
     ).all()
     
-    return render_template('parking/map.html', spaces=spaces)
+    return render_template('parking/map.html', spaces=spaces, cards=space_cards(spaces, 'map'))
 
 @parking.route('/api/user-location', methods=['POST'])
 @login_required
 def update_user_location():
     """Update the current user's location"""
-    data = request.get_json()
-    
-    if 'latitude' not in data or 'longitude' not in data:
-        return jsonify({'error': 'Latitude and longitude are required'}), 400
+    try:
+        latitude, longitude = parse_location_ping(request.get_json(silent=True) or {})
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    
+    # Buffered and written to the database in batches by a background thread
+    get_location_buffer().add(current_user.id, latitude, longitude)
+    return jsonify({'message': 'Location updated successfully'}), 202
+
+def upload_error_response(error):
+    """JSON answer for a rejected upload request, with the offset to resume from if known"""
+    payload = {'error': str(error)}
+    if error.offset is not None:
+        payload['offset'] = error.offset
+    return jsonify(payload), error.status
+
+@parking.route('/api/uploads', methods=['POST'])
+@login_required
+def create_upload():
+    """Start a chunked image upload"""
+    data = request.get_json(silent=True) or {}
+    try:
+        upload = get_upload_store().create(current_user.id, data.get('filename'), data.get('size'),
+                                           data.get('sha256'))
+    except UploadError as e:
+        return upload_error_response(e)
+    return jsonify(upload), 201
+
+@parking.route('/api/uploads/<upload_id>', methods=['GET'])
+@login_required
+def upload_status(upload_id):
+    """Report how much of an upload has arrived, to resume it"""
+    try:
+        return jsonify(get_upload_store().status(upload_id, current_user.id))
+    except UploadError as e:
+        return upload_error_response(e)
+
+@parking.route('/api/uploads/<upload_id>', methods=['PATCH'])
+@login_required
+def upload_chunk(upload_id):
+    """Append one chunk at the offset given in the Upload-Offset header"""
+    offset = request.headers.get('Upload-Offset', type=int)
+    if offset is None:
+        return jsonify({'error': 'Upload-Offset header is required'}), 400
+    store = get_upload_store()
+    try:
+        store.append(upload_id, current_user.id, offset, request.stream, request.content_length)
+        return jsonify(store.status(upload_id, current_user.id))
+    except UploadError as e:
+        return upload_error_response(e)
+
+@parking.route('/api/uploads/<upload_id>/complete', methods=['POST'])
+@login_required
+def complete_upload(upload_id):
+    """Verify a fully sent upload and store the image"""
+    try:
+        return jsonify(get_upload_store().complete(upload_id, current_user.id))
+    except UploadError as e:
+        return upload_error_response(e)
+
+@parking.route('/api/uploads/<upload_id>', methods=['DELETE'])
+@login_required
+def cancel_upload(upload_id):
+    """Cancel an upload that was not attached to a space"""
+    try:
+        get_upload_store().discard(upload_id, current_user.id)
+    except UploadError as e:
+        return upload_error_response(e)
+    return '', 204
+
+@parking.route('/api/spaces/<int:space_id>/images', methods=['POST'])
+@login_required
+def attach_space_images(space_id):
+    """Add completed uploads to the images of a space"""
+    space = ParkingSpace.query.get_or_404(space_id)
+    if space.owner_id != current_user.id:
+        abort(403)
+    data = request.get_json(silent=True) or {}
+    upload_ids = data.get('upload_ids')
+    if not isinstance(upload_ids, list) or not all(isinstance(i, str) for i in upload_ids):
+        return jsonify({'error': 'upload_ids must be a list of upload ids'}), 400
+    try:
+        images = attach_uploads(space, upload_ids)
+    except UploadError as e:
+        return upload_error_response(e)
+    return jsonify([{'id': image.id, 'image_url': image.image_url, 'is_primary': image.is_primary}
+                    for image in images]), 201
+
+def space_to_dict(space, owner_username=None, rating_stats=None):
+    """Convert a parking space to the JSON format of the spaces API
     
-    # In a real implementation, you would save this to the database
-    # For now, we'll just return success
-    return jsonify({'message': 'Location updated successfully'})
+    Listings pass the owner's username and (average, count) rating stats
+    loaded in bulk; without them they are read from the owner.
+    """
+    if rating_stats is None:
+        owner_rating = space.owner.get_average_rating()
+        owner_total_ratings = space.owner.get_total_ratings()
+    else:
+        owner_rating, owner_total_ratings = rating_stats
+    
+    return {
+        'id': space.id,
+        'title': space.title,
+        'address': space.address,
+        'latitude': float(space.latitude) if space.latitude else None,
+        'longitude': float(space.longitude) if space.longitude else None,
+        'price_per_hour': float(space.price_per_hour),
+        'owner_username': owner_username or space.owner.username,
+        'owner_rating': float(owner_rating) if owner_rating else None,
+        'owner_total_ratings': owner_total_ratings
+    }
+
+def spaces_to_dicts(spaces):
+    """Convert many spaces with two queries for all owners instead of several per space"""
+    owner_ids = {space.owner_id for space in spaces}
+    usernames = dict(
+        db.session.query(User.id, User.username).filter(User.id.in_(owner_ids)).all()
+    ) if owner_ids else {}
+    stats = owner_rating_stats(owner_ids)
+    return [
+        space_to_dict(space, usernames[space.owner_id], stats.get(space.owner_id, (None, 0)))
+        for space in spaces
+    ]
+
+def snapshot_listing(snapshot):
+    """The spaces API listing of every space in the snapshot, without a database query"""
+    return [
+        space_to_dict(space, space.owner_username, (space.owner_rating, space.owner_total_ratings))
+        for space in snapshot.spaces()
+    ]
+
+def spaces_response(spaces_data):
+    """Return spaces as a list of objects, or columnar with ?format=compact"""
+    if request.args.get('format') == 'compact':
+        return jsonify(encode_compact(spaces_data))
+    return jsonify(spaces_data)
 
 @parking.route('/api/parking-spaces')
 def api_parking_spaces():
-    """API endpoint to get all parking spaces with coordinates"""
+    """API endpoint to get all parking spaces with coordinates
+    
+    With ?near=<lat>,<lng> only the k nearest spaces within max_km are
+    returned, closest first, each with its distance_km.
+    
+    With ?since=<cursor> only the spaces changed after the cursor are
+    returned as upserts and deletions, with the cursor to ask from next.
+    The full listing carries its cursor in the X-Sync-Cursor header.
+    
+    With ?format=compact the listing is sent in the columnar format of
+    services.payloads instead of one object per space.
+    """
+    if 'since' in request.args:
+        return api_parking_space_changes()
+    
+    try:
+        near = parse_near_args(request.args)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    
+    if near:
+        latitude, longitude, k, max_km = near
+        snapshot = get_snapshot()
+        if snapshot is not None:
+            nearest = snapshot_nearest(snapshot, latitude, longitude, k, max_km)
+        else:
+            nearest = nearest_spaces(latitude, longitude, k=k, max_km=max_km)
+        spaces_data = spaces_to_dicts([space for space, _ in nearest])
+        for space_data, (_, distance) in zip(spaces_data, nearest):
+            space_data['distance_km'] = round(distance, 3)
+        return spaces_response(spaces_data)
+    
+    snapshot = get_snapshot()
+    if snapshot is not None:
+        # Changes since the snapshot was built reach the client through delta sync
+        spaces_data = snapshot_listing(snapshot)
+        response = spaces_response(spaces_data)
+        response.headers['X-Sync-Cursor'] = str(snapshot.cursor)
+        return response
+    
+    # Read the cursor first so changes committed meanwhile are sent again later
+    cursor = sync.current_cursor()
     spaces = ParkingSpace.query.filter(
         ParkingSpace.is_active == True,
         ParkingSpace.latitude.isnot(None),
@@ -402,22 +784,76 @@ def api_parking_spaces():
     ).all()
     
     # Convert to JSON serializable format
-    spaces_data = []
-    for space in spaces:
-        # Get owner rating
-        owner_rating = space.owner.get_average_rating()
-        owner_total_ratings = space.owner.get_total_ratings()
-        
-        spaces_data.append({
-            'id': space.id,
-            'title': space.title,
-            'address': space.address,
-            'latitude': float(space.latitude) if space.latitude else None,
-            'longitude': float(space.longitude) if space.longitude else None,
-            'price_per_hour': float(space.price_per_hour),
-            'owner_username': space.owner.username,
-            'owner_rating': float(owner_rating) if owner_rating else None,
-            'owner_total_ratings': owner_total_ratings
-        })
+    spaces_data = spaces_to_dicts(spaces)
     
-    return jsonify(spaces_data)
+    response = spaces_response(spaces_data)
+    response.headers['X-Sync-Cursor'] = str(cursor)
+    return response
+
+def api_parking_space_changes():
+    """Delta mode of the spaces API: what changed since the client's cursor"""
+    since = request.args.get('since', type=int)
+    limit = request.args.get('limit', sync.DEFAULT_PAGE_SIZE, type=int)
+    if since is None or since < 0:
+        return jsonify({'error': 'since must be a non-negative integer cursor'}), 400
+    if not 1 <= limit <= sync.MAX_PAGE_SIZE:
+        return jsonify({'error': f'limit must be between 1 and {sync.MAX_PAGE_SIZE}'}), 400
+    
+    try:
+        spaces, deleted_ids, cursor, has_more = sync.changes_since(since, limit)
+    except sync.CursorExpired:
+        return jsonify({'error': 'Cursor expired, reload the full list'}), 410
+    
+    listed = []
+    deletions = list(deleted_ids)
+    for space in spaces:
+        # Spaces that left the listing are deletions for the client
+        if space.is_active and space.latitude is not None and space.longitude is not None:
+            listed.append(space)
+        else:
+            deletions.append(space.id)
+    upserts = spaces_to_dicts(listed)
+    
+    return jsonify({
+        'upserts': upserts,
+        'deletions': deletions,
+        'cursor': cursor,
+        'has_more': has_more
+    })
+
+@parking.route('/api/parking-spaces/stream')
+def stream_parking_spaces():
+    """Server-Sent Events stream of changes to spaces inside the client's viewport"""
+    if not current_app.config['STREAM_ENABLED']:
+        # A blocking worker would be held by the client for the whole stream
+        return jsonify({'error': 'The live stream is served by the async mode (asgi.py)'}), 503
+    
+    bbox = None
+    if request.args.get('bbox'):
+        try:
+            bbox = parse_bbox(request.args['bbox'])
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+    
+    broker = get_broker()
+    subscription = broker.subscribe(bbox)
+    keepalive = current_app.config['STREAM_KEEPALIVE_SECONDS']
+    # Streams end after a while so clients reconnect, e.g. to another worker after a restart
+    deadline = time.monotonic() + current_app.config['STREAM_MAX_SECONDS']
+    
+    def generate():
+        try:
+            yield 'retry: 5000\n\n'
+            while time.monotonic() < deadline:
+                events = subscription.get(timeout=keepalive)
+                if not events:
+                    yield ': keepalive\n\n'
+                for event in events:
+                    yield format_sse(event)
+        finally:
+            broker.unsubscribe(subscription)
+    
+    return Response(generate(), mimetype='text/event-stream', headers={
+        'Cache-Control': 'no-cache',
+        'X-Accel-Buffering': 'no'
+    })
\ No newline at end of file
@@ -0,0 +1,113 @@
+"""Archive tier for closed bookings.
+
+Bookings that were completed or cancelled more than ARCHIVE_AFTER_DAYS days
+ago are moved, with their feedback, into archived_bookings and
+archived_feedbacks. This keeps the bookings table limited to recent and open
+bookings. Each batch is copied with INSERT ... SELECT and deleted in one
+transaction, so a booking is always in exactly one of the two tables.
+
+Archived bookings keep their ids and can no longer change. In particular,
+feedback can only be left before a booking is archived. Owner ratings
+include archived feedback (services/ratings.py). ARCHIVE_AFTER_DAYS should
+stay above PRICING_LOOKBACK_DAYS so demand pricing still sees every booking
+it uses.
+"""
+from datetime import datetime, timedelta
+
+import click
+from flask import current_app
+from flask.cli import with_appcontext
+
+from models.models import (
+    ArchivedBooking, ArchivedFeedback, Booking, Feedback, ParkingSpace,
+    TERMINAL_BOOKING_STATUSES, db
+)
+from services.sharding import each_region, gather, is_sharded
+
+DEFAULT_BATCH_SIZE = 500
+HISTORY_PAGE_SIZE = 20
+
+
+def init_app(app):
+    """Register the archive command"""
+    app.config.setdefault('ARCHIVE_AFTER_DAYS', 90)
+    app.cli.add_command(archive_bookings_command)
+
+
+def archive_bookings(older_than_days, batch_size=DEFAULT_BATCH_SIZE):
+    """Move bookings closed before the cutoff to the archive, returning how many moved"""
+    cutoff = datetime.utcnow() - timedelta(days=older_than_days)
+    archived = 0
+    while True:
+        ids = db.session.execute(
+            db.select(Booking.id)
+            .where(Booking.status.in_(TERMINAL_BOOKING_STATUSES), Booking.closed_at < cutoff)
+            .order_by(Booking.id)
+            .limit(batch_size)
+            .with_for_update()
+        ).scalars().all()
+        if not ids:
+            return archived
+
+        db.session.execute(db.insert(ArchivedBooking).from_select(
+            ['id', 'start_time', 'end_time', 'total_price', 'status', 'booking_date', 'closed_at',
+             'archived_at', 'parking_space_id', 'space_title', 'customer_id', 'owner_id'],
+            db.select(
+                Booking.id, Booking.start_time, Booking.end_time, Booking.total_price, Booking.status,
+                Booking.booking_date, Booking.closed_at, db.literal(datetime.utcnow(), db.DateTime),
+                Booking.parking_space_id, ParkingSpace.title, Booking.customer_id, Booking.owner_id
+            ).outerjoin(ParkingSpace, ParkingSpace.id == Booking.parking_space_id)
+            .where(Booking.id.in_(ids))
+        ))
+        db.session.execute(db.insert(ArchivedFeedback).from_select(
+            ['id', 'rating', 'comment', 'submitted_at', 'booking_id', 'owner_id'],
+            db.select(
+                Feedback.id, Feedback.rating, Feedback.comment, Feedback.submitted_at,
+                Feedback.booking_id, Booking.owner_id
+            ).join(Booking, Booking.id == Feedback.booking_id)
+            .where(Feedback.booking_id.in_(ids))
+        ))
+        db.session.execute(db.delete(Feedback).where(Feedback.booking_id.in_(ids)))
+        db.session.execute(db.delete(Booking).where(Booking.id.in_(ids)))
+        db.session.commit()
+        archived += len(ids)
+
+
+def booking_history(user_id, received=False, page=1, per_page=HISTORY_PAGE_SIZE):
+    """Return (archived bookings, has_more) made or received by a user, newest first
+
+    With region shards the newest bookings of every shard are merged, so
+    each shard reads every page up to the one shown.
+    """
+    column = ArchivedBooking.owner_id if received else ArchivedBooking.customer_id
+    sharded = is_sharded()
+    skip = (page - 1) * per_page
+
+    def newest():
+        # Users live outside the shards, so they are not joined here
+        query = ArchivedBooking.query.filter(column == user_id) \
+            .options(db.joinedload(ArchivedBooking.feedback)) \
+            .order_by(ArchivedBooking.start_time.desc(), ArchivedBooking.id.desc())
+        if sharded:
+            return query.limit(skip + per_page + 1).all()
+        return query.offset(skip).limit(per_page + 1).all()
+
+    bookings = gather(newest)
+    if sharded:
+        bookings.sort(key=lambda booking: (booking.start_time, booking.id), reverse=True)
+        bookings = bookings[skip:]
+    return bookings[:per_page], len(bookings) > per_page
+
+
+@click.command('archive-bookings')
+@click.option('--days', type=int, default=None,
+              help='Archive bookings closed more than this many days ago [default: ARCHIVE_AFTER_DAYS].')
+@click.option('--batch-size', default=DEFAULT_BATCH_SIZE, show_default=True,
+              help='Bookings moved per transaction.')
+@with_appcontext
+def archive_bookings_command(days, batch_size):
+    """Move old completed and cancelled bookings to the archive tables"""
+    if days is None:
+        days = current_app.config['ARCHIVE_AFTER_DAYS']
+    archived = sum(archive_bookings(days, batch_size) for _ in each_region())
+    click.echo(f'Archived {archived} bookings.')
@@ -0,0 +1,269 @@
+"""Append-only audit log of admin actions and booking status changes.
+
+Changes to the audited attributes (AUDITED) are collected when a session
+flushes and queued in memory once the transaction commits, one entry per
+attribute with the acting user and the values before and after. A
+background thread writes the queue with one bulk insert every
+AUDIT_FLUSH_INTERVAL seconds, and once more on shutdown, so requests never
+wait for the audit table. The thread is woken early once half of
+AUDIT_BUFFER_MAX_ENTRIES are pending; entries arriving while the queue is
+full, e.g. because the database is down, are dropped, counted and logged.
+Entries still queued when a process is killed are lost.
+
+In MySQL the audit_entries table is partitioned by month of created_at
+and triggers refuse UPDATE and DELETE (see init_db.py). The
+audit-partitions command adds the partitions of the coming months and
+drops old ones, which is the only way entries are removed.
+"""
+import atexit
+import json
+import logging
+import threading
+from datetime import datetime
+
+import click
+from flask import current_app, has_app_context, has_request_context
+from flask.cli import with_appcontext
+from flask_login import current_user
+from sqlalchemy import inspect
+from sqlalchemy.orm import Session
+
+from models.models import AuditEntry, Booking, ParkingSpace, User, db
+from services.background import PeriodicWorker
+
+logger = logging.getLogger(__name__)
+
+# Audited attributes per model, with the target type their entries carry
+AUDITED = {
+    User: ('user', ('is_verified', 'is_admin')),
+    ParkingSpace: ('parking_space', ('is_active',)),
+    Booking: ('booking', ('status',)),
+}
+
+TARGET_TYPES = tuple(target_type for target_type, _ in AUDITED.values())
+
+DEFAULT_PAGE_SIZE = 50
+
+FUTURE_PARTITION = 'p_future'
+
+
+def init_app(app):
+    """Attach the audit log queue to the application"""
+    app.config.setdefault('AUDIT_FLUSH_INTERVAL', 2.0)
+    app.config.setdefault('AUDIT_BUFFER_MAX_ENTRIES', 5000)
+    log = AuditLog(
+        max_entries=app.config['AUDIT_BUFFER_MAX_ENTRIES'],
+        flush_interval=app.config['AUDIT_FLUSH_INTERVAL'],
+        writer=lambda rows: _write_entries(app, rows)
+    )
+    app.extensions['audit'] = log
+    app.cli.add_command(audit_partitions_command)
+    atexit.register(log.shutdown)
+
+
+def get_audit_log():
+    """Return the audit log queue of the current application"""
+    return current_app.extensions['audit']
+
+
+def _write_entries(app, rows):
+    """Insert a batch of audit entries in one statement"""
+    with app.app_context():
+        db.session.execute(db.insert(AuditEntry), rows)
+        db.session.commit()
+
+
+class AuditLog:
+    """Queues audit entries and writes them in batches"""
+
+    def __init__(self, max_entries=5000, flush_interval=2.0, writer=None):
+        self.max_entries = max_entries
+        self.writer = writer
+        self.dropped = 0
+        self._pending = []
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._worker = PeriodicWorker('audit-flusher', flush_interval, self.flush)
+
+    def add(self, entries):
+        """Queue entries (dicts of AuditEntry columns) to be written, never writing them here"""
+        if not entries:
+            return
+        with self._lock:
+            room = max(0, self.max_entries - len(self._pending))
+            self._pending.extend(entries[:room])
+            dropped = len(entries) - min(room, len(entries))
+            self.dropped += dropped
+            filling = len(self._pending) * 2 >= self.max_entries
+        self._worker.start()
+        if dropped:
+            logger.error('Dropped %d audit entries, the queue is full', dropped)
+        if filling:
+            self._worker.wake()
+
+    def __len__(self):
+        return len(self._pending)
+
+    def flush(self):
+        """Write all queued entries, returning how many were written"""
+        with self._flush_lock:
+            with self._lock:
+                batch, self._pending = self._pending, []
+            if not batch:
+                return 0
+            try:
+                self.writer(batch)
+            except Exception:
+                logger.exception('Failed to write %d audit entries', len(batch))
+                self._requeue(batch)
+                return 0
+            return len(batch)
+
+    def _requeue(self, batch):
+        """Put a failed batch back in front, keeping at most max_entries"""
+        with self._lock:
+            self._pending[:0] = batch
+            excess = len(self._pending) - self.max_entries
+            if excess > 0:
+                del self._pending[:excess]
+                self.dropped += excess
+                logger.error('Dropped %d audit entries that could not be written', excess)
+
+    def shutdown(self):
+        """Stop the flusher and write what is still queued"""
+        self._worker.stop()
+        self.flush()
+
+
+def _actor_id():
+    if has_request_context() and current_user.is_authenticated:
+        return current_user.id
+    return None
+
+
+@db.event.listens_for(Session, 'after_flush')
+def _collect_entries(session, flush_context):
+    """Remember the audited changes of this flush until the transaction commits"""
+    entries = None
+    now = datetime.utcnow()
+    # Only changes are audited, not the values rows are created with
+    for obj in session.dirty:
+        audited = AUDITED.get(type(obj))
+        if audited is None:
+            continue
+        target_type, attributes = audited
+        state = inspect(obj)
+        for attribute in attributes:
+            history = state.attrs[attribute].history
+            if not history.added or history.added == history.deleted:
+                continue
+            if entries is None:
+                entries = session.info.setdefault('audit_entries', [])
+            entries.append({
+                'created_at': now,
+                'actor_id': _actor_id(),
+                'action': f'{target_type}.{attribute}',
+                'target_type': target_type,
+                'target_id': obj.id,
+                'before_value': json.dumps(history.deleted[0]) if history.deleted else None,
+                'after_value': json.dumps(history.added[0]),
+            })
+
+
+@db.event.listens_for(Session, 'after_commit')
+def _queue_entries(session):
+    entries = session.info.pop('audit_entries', None)
+    if entries and has_app_context():
+        log = current_app.extensions.get('audit')
+        if log is not None:
+            log.add(entries)
+
+
+@db.event.listens_for(Session, 'after_rollback')
+def _discard_entries(session):
+    session.info.pop('audit_entries', None)
+
+
+@db.event.listens_for(AuditEntry, 'before_update')
+@db.event.listens_for(AuditEntry, 'before_delete')
+def _refuse_changes(mapper, connection, entry):
+    raise ValueError('Audit entries cannot be changed or deleted')
+
+
+def search_entries(actor_id=None, target_type=None, target_id=None, action=None,
+                   since=None, until=None, page=1, per_page=DEFAULT_PAGE_SIZE):
+    """Return (entries, has_more) matching the filters, newest first
+
+    The actor and target filters are served by the (actor_id, created_at)
+    and (target_type, target_id, created_at) indexes.
+    """
+    query = AuditEntry.query
+    if actor_id is not None:
+        query = query.filter(AuditEntry.actor_id == actor_id)
+    if target_type:
+        query = query.filter(AuditEntry.target_type == target_type)
+    if target_id is not None:
+        query = query.filter(AuditEntry.target_id == target_id)
+    if action:
+        query = query.filter(AuditEntry.action == action)
+    if since is not None:
+        query = query.filter(AuditEntry.created_at >= since)
+    if until is not None:
+        query = query.filter(AuditEntry.created_at < until)
+    entries = query.order_by(AuditEntry.created_at.desc(), AuditEntry.id.desc()) \
+        .offset((page - 1) * per_page).limit(per_page + 1).all()
+    return entries[:per_page], len(entries) > per_page
+
+
+def month_start(moment, months_ahead=0):
+    """Return the first day of the month months_ahead after moment's month"""
+    month = moment.year * 12 + moment.month - 1 + months_ahead
+    return datetime(month // 12, month % 12 + 1, 1)
+
+
+def partition_name(start):
+    return start.strftime('p%Y%m')
+
+
+def monthly_partitions(first_month, months):
+    """Return the partition definitions of months starting at first_month"""
+    definitions = []
+    for i in range(months):
+        start = month_start(first_month, i)
+        end = month_start(first_month, i + 1)
+        definitions.append(f"PARTITION {partition_name(start)} VALUES LESS THAN ('{end:%Y-%m-%d}')")
+    return definitions
+
+
+@click.command('audit-partitions')
+@click.option('--months', default=3, show_default=True, help='Coming months to have partitions for.')
+@click.option('--drop-before', default=None, help='Drop the partitions of months before YYYY-MM.')
+@with_appcontext
+def audit_partitions_command(months, drop_before):
+    """Add the audit log partitions of the coming months and drop old ones (MySQL)"""
+    if db.engine.dialect.name != 'mysql':
+        raise click.ClickException('The audit log is only partitioned in MySQL.')
+    with db.engine.begin() as connection:
+        existing = set(connection.execute(db.text(
+            "SELECT partition_name FROM information_schema.partitions "
+            "WHERE table_schema = DATABASE() AND table_name = 'audit_entries'"
+        )).scalars())
+        # Split the catch-all partition into the months after the newest one
+        newest = max((name for name in existing if name != FUTURE_PARTITION), default='')
+        now = datetime.utcnow()
+        missing = [month_start(now, i) for i in range(months + 1)
+                   if partition_name(month_start(now, i)) > newest]
+        if missing:
+            definitions = monthly_partitions(missing[0], len(missing))
+            connection.execute(db.text(
+                f"ALTER TABLE audit_entries REORGANIZE PARTITION {FUTURE_PARTITION} INTO "
+                f"({', '.join(definitions)}, PARTITION {FUTURE_PARTITION} VALUES LESS THAN (MAXVALUE))"
+            ))
+        dropped = []
+        if drop_before:
+            cutoff = partition_name(datetime.strptime(drop_before, '%Y-%m'))
+            dropped = sorted(name for name in existing
+                             if name != FUTURE_PARTITION and name < cutoff)
+            if dropped:
+                connection.execute(db.text(f"ALTER TABLE audit_entries DROP PARTITION {', '.join(dropped)}"))
+    click.echo(f'Added {len(missing)} and dropped {len(dropped)} audit log partitions.')
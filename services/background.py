@@ -0,0 +1,90 @@
+"""Background threads and process locks for periodic maintenance work."""
+import logging
+import os
+import threading
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+    import msvcrt
+
+logger = logging.getLogger(__name__)
+
+
+class PeriodicWorker:
+    """Runs a callable every interval seconds on a daemon thread
+
+    The thread is started lazily and restarted when the process id changes,
+    so a worker created before a prefork server forks keeps working in the
+    children. wake() runs the callable early.
+    """
+
+    def __init__(self, name, interval, target):
+        self.name = name
+        self.interval = interval
+        self.target = target
+        self._thread = None
+        self._pid = None
+        self._wakeup = threading.Event()
+        self._stopping = threading.Event()
+        self._start_lock = threading.Lock()
+
+    def start(self):
+        """Start the thread unless it is already running in this process"""
+        if self._pid == os.getpid() and self._thread is not None and self._thread.is_alive():
+            return
+        with self._start_lock:
+            if self._pid == os.getpid() and self._thread is not None and self._thread.is_alive():
+                return
+            self._stopping.clear()
+            self._thread = threading.Thread(target=self._run, name=self.name, daemon=True)
+            self._pid = os.getpid()
+            self._thread.start()
+
+    def wake(self):
+        """Run the target as soon as possible"""
+        self._wakeup.set()
+
+    def stop(self, timeout=5.0):
+        """Stop the thread, waiting for a running iteration to finish"""
+        self._stopping.set()
+        self._wakeup.set()
+        if self._thread is not None and self._pid == os.getpid():
+            self._thread.join(timeout)
+        self._thread = None
+
+    def _run(self):
+        while not self._stopping.is_set():
+            self._wakeup.wait(self.interval)
+            self._wakeup.clear()
+            if self._stopping.is_set():
+                break
+            try:
+                self.target()
+            except Exception:
+                logger.exception('%s failed', self.name)
+
+
+@contextmanager
+def try_lock(path):
+    """Take an exclusive lock between processes without waiting; yields whether it was taken"""
+    with open(path, 'a+b') as f:
+        try:
+            if fcntl is not None:
+                fcntl.flock(f.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+            else:
+                f.seek(0)
+                msvcrt.locking(f.fileno(), msvcrt.LK_NBLCK, 1)
+        except OSError:
+            yield False
+            return
+        try:
+            yield True
+        finally:
+            if fcntl is not None:
+                fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+            else:
+                f.seek(0)
+                msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
@@ -0,0 +1,123 @@
+"""Recurring and multi-day bookings.
+
+All occurrences of a request are conflict-checked with a single range query
+and written with a single bulk insert inside one transaction.
+"""
+from bisect import bisect_left
+from datetime import datetime, timedelta
+from itertools import islice
+
+from models.models import ParkingSpace, Booking, db
+from services.pricing import get_pricing_engine
+from services.sharding import allocate_ids
+
+# Upper bound on the occurrences a single request may create
+MAX_OCCURRENCES = 100
+
+# Bookings in these states hold the space
+BLOCKING_STATUSES = ('pending', 'confirmed')
+
+
+def iter_occurrences(start_date, end_date, start_time, end_time, weekdays=None):
+    """Yield (start, end) datetimes for every matching date in the range
+
+    weekdays is a collection of date.weekday() numbers; None means every day.
+    """
+    day = start_date
+    while day <= end_date:
+        if weekdays is None or day.weekday() in weekdays:
+            yield datetime.combine(day, start_time), datetime.combine(day, end_time)
+        day += timedelta(days=1)
+
+
+def expand_occurrences(start_date, end_date, start_time, end_time, weekdays=None, limit=None):
+    """Return the occurrences of the range as a list of at most limit items
+
+    Callers pass MAX_OCCURRENCES + 1 so a range spanning years stops walking
+    as soon as it is known to be too long.
+    """
+    return list(islice(iter_occurrences(start_date, end_date, start_time, end_time, weekdays), limit))
+
+
+def span_occurrences(start_date, end_date, start_time, end_time):
+    """Return the single (start, end) of one booking spanning several days"""
+    return [(datetime.combine(start_date, start_time), datetime.combine(end_date, end_time))]
+
+
+def find_conflicts(existing, occurrences):
+    """Return the indexes of occurrences overlapping any existing interval
+
+    Both arguments are lists of (start, end) pairs; occurrences may be in any
+    order. Runs in O((n + m) log n) by sweeping the existing intervals sorted
+    by start with a running maximum of their ends.
+    """
+    existing = sorted(existing)
+    starts = [start for start, _ in existing]
+    max_ends = []
+    latest = None
+    for _, end in existing:
+        latest = end if latest is None or end > latest else latest
+        max_ends.append(latest)
+
+    conflicts = set()
+    for i, (start, end) in enumerate(occurrences):
+        # Existing bookings starting before this occurrence ends
+        j = bisect_left(starts, end)
+        if j and max_ends[j - 1] > start:
+            conflicts.add(i)
+    return conflicts
+
+
+def create_recurring_bookings(space, customer_id, occurrences, all_or_nothing=True):
+    """Book every occurrence of a recurring request in one transaction
+
+    Returns one result dict per occurrence with its start, end, price and
+    status ('booked', 'conflict' or 'skipped'). When all_or_nothing is set a
+    single conflict leaves the whole request unbooked.
+    """
+    # Lock the space so concurrent requests for it are checked one at a time
+    db.session.query(ParkingSpace.id).filter_by(id=space.id).with_for_update().one()
+
+    window_start = min(start for start, _ in occurrences)
+    window_end = max(end for _, end in occurrences)
+    existing = db.session.query(Booking.start_time, Booking.end_time).filter(
+        Booking.parking_space_id == space.id,
+        Booking.status.in_(BLOCKING_STATUSES),
+        Booking.start_time < window_end,
+        Booking.end_time > window_start
+    ).all()
+    conflicts = find_conflicts([(row.start_time, row.end_time) for row in existing], occurrences)
+
+    engine = get_pricing_engine()
+    results = []
+    for i, (start, end) in enumerate(occurrences):
+        if i in conflicts:
+            status = 'conflict'
+        elif conflicts and all_or_nothing:
+            status = 'skipped'
+        else:
+            status = 'booked'
+        results.append({
+            'start': start,
+            'end': end,
+            'price': engine.quote(space, start, end),
+            'status': status,
+        })
+
+    rows = [{
+        'start_time': result['start'],
+        'end_time': result['end'],
+        'total_price': result['price'],
+        'status': 'pending',
+        'customer_id': customer_id,
+        'owner_id': space.owner_id,
+        'parking_space_id': space.id,
+    } for result in results if result['status'] == 'booked']
+
+    if rows:
+        ids = allocate_ids(Booking, len(rows))
+        for row, booking_id in zip(rows, ids or ()):
+            row['id'] = booking_id
+        db.session.execute(db.insert(Booking), rows)
+    db.session.commit()
+    return results
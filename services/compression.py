@@ -0,0 +1,64 @@
+"""Response compression negotiated via Accept-Encoding.
+
+JSON responses above COMPRESS_MIN_SIZE bytes are compressed with brotli
+when the client accepts it and the brotli module is installed, otherwise
+with gzip. Streamed responses such as Server-Sent Events are left alone.
+"""
+import gzip
+
+from flask import request
+
+try:
+    import brotli
+except ImportError:  # Optional, gzip is used instead
+    brotli = None
+
+
+def init_app(app):
+    """Compress eligible responses of the application"""
+    app.config.setdefault('COMPRESS_MIMETYPES', ('application/json',))
+    app.config.setdefault('COMPRESS_MIN_SIZE', 1024)
+    app.config.setdefault('COMPRESS_GZIP_LEVEL', 6)
+    app.config.setdefault('COMPRESS_BROTLI_QUALITY', 5)
+
+    @app.after_request
+    def compress_response(response):
+        return compress(response, app.config)
+
+
+def choose_encoding(accept_encodings):
+    """Return the best supported encoding the client accepts, or None"""
+    supported = ['br', 'gzip'] if brotli is not None else ['gzip']
+    return accept_encodings.best_match(supported)
+
+
+def compress(response, config):
+    """Compress a response in place when it is worth it"""
+    if (response.direct_passthrough or response.is_streamed
+            or response.status_code != 200
+            or 'Content-Encoding' in response.headers
+            or response.mimetype not in config['COMPRESS_MIMETYPES']):
+        return response
+
+    response.vary.add('Accept-Encoding')
+    data = response.get_data()
+    if len(data) < config['COMPRESS_MIN_SIZE']:
+        return response
+
+    data, encoding = compress_body(data, request.accept_encodings, config)
+    if encoding is None:
+        return response
+
+    response.set_data(data)
+    response.headers['Content-Encoding'] = encoding
+    return response
+
+
+def compress_body(data, accept_encodings, config):
+    """Return (data, encoding) compressed for the client, or (data, None) when it accepts neither"""
+    encoding = choose_encoding(accept_encodings)
+    if encoding == 'br':
+        return brotli.compress(data, quality=config['COMPRESS_BROTLI_QUALITY']), encoding
+    if encoding == 'gzip':
+        return gzip.compress(data, compresslevel=config['COMPRESS_GZIP_LEVEL']), encoding
+    return data, None
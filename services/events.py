@@ -0,0 +1,336 @@
+"""Live parking space changes for map clients.
+
+Committed changes to parking spaces and booking confirmations are turned
+into small events and fanned out by an in-process broker to subscribers
+whose map viewport contains the change. Subscribers are plain mailboxes:
+publishing never blocks and uses no thread per client, and a slow client
+whose mailbox overflows is told to resync instead of growing without bound.
+
+The broker only reaches clients connected to the same process. With
+STREAM_RELAY_URL set to a redis:// URL, committed events are published to
+a Redis channel instead and every process with connected clients listens
+to it, so a change reaches the clients of every worker and host.
+
+Blocking WSGI workers would each be held by an open stream, so wsgi.py
+refuses the stream (STREAM_ENABLED) and it is served by the async
+handler of async_api.py, where an idle client costs no thread.
+"""
+import json
+import logging
+import math
+import os
+import threading
+import time
+from collections import deque
+
+from flask import current_app, has_app_context
+from sqlalchemy import inspect
+from sqlalchemy.orm import Session
+
+from models.models import ParkingSpace, Booking, db
+
+# Size of the coarse cells subscriptions are indexed by, in degrees
+INDEX_CELL_SIZE = 0.5
+
+# Viewports covering more coarse cells than this receive every event
+MAX_INDEXED_CELLS = 64
+
+# Booking status changes that take a space or give it back
+BOOKED_STATUSES = ('confirmed',)
+
+# Redis channel the relay carries events on
+RELAY_CHANNEL = 'smart_park:space_events'
+
+logger = logging.getLogger(__name__)
+
+
+def init_app(app):
+    """Attach an event broker to the application"""
+    app.config.setdefault('STREAM_MAX_PENDING_EVENTS', 100)
+    app.config.setdefault('STREAM_KEEPALIVE_SECONDS', 15)
+    app.config.setdefault('STREAM_MAX_SECONDS', 300)
+    app.config.setdefault('STREAM_ENABLED', True)
+    app.config.setdefault('STREAM_RELAY_URL', None)
+    broker = EventBroker(max_pending=app.config['STREAM_MAX_PENDING_EVENTS'])
+    if app.config['STREAM_RELAY_URL']:
+        broker.relay = create_relay(app.config['STREAM_RELAY_URL'], broker)
+    app.extensions['events'] = broker
+
+
+def get_broker():
+    """Return the event broker of the current application"""
+    return current_app.extensions['events']
+
+
+def format_sse(event):
+    """Encode an event as a Server-Sent Events message"""
+    return f"event: {event['type']}\ndata: {json.dumps(event['data'])}\n\n"
+
+
+def create_relay(url, broker):
+    """Return the relay for a STREAM_RELAY_URL"""
+    if url.startswith(('redis://', 'rediss://', 'unix://')):
+        try:
+            import redis
+        except ImportError:
+            raise RuntimeError('STREAM_RELAY_URL needs the redis package, see requirements-optional.txt')
+        return RedisRelay(redis.Redis.from_url(url), broker)
+    raise ValueError(f'Unsupported STREAM_RELAY_URL {url!r}')
+
+
+def _coarse_cell(latitude, longitude):
+    return (int(math.floor(latitude / INDEX_CELL_SIZE)), int(math.floor(longitude / INDEX_CELL_SIZE)))
+
+
+class Subscription:
+    """Mailbox of one connected client, optionally limited to a viewport"""
+
+    def __init__(self, bbox=None, max_pending=100):
+        self.bbox = bbox  # (south, west, north, east) or None for everything
+        self.max_pending = max_pending
+        self.on_push = None  # Called after each push, e.g. to wake an asyncio task
+        self._events = deque()
+        self._overflowed = False
+        self._ready = threading.Condition()
+
+    def wants(self, event):
+        """Check whether any point touched by the event lies in the viewport"""
+        if self.bbox is None or not event['points']:
+            return True
+        south, west, north, east = self.bbox
+        return any(south <= lat <= north and west <= lng <= east for lat, lng in event['points'])
+
+    def push(self, event):
+        with self._ready:
+            if len(self._events) >= self.max_pending:
+                # Too far behind: drop the backlog and have the client reload
+                self._events.clear()
+                self._overflowed = True
+            elif not self._overflowed:
+                self._events.append(event)
+            self._ready.notify()
+        if self.on_push is not None:
+            self.on_push()
+
+    def get(self, timeout):
+        """Wait up to timeout seconds and return all pending events"""
+        with self._ready:
+            if not self._events and not self._overflowed:
+                self._ready.wait(timeout)
+            if self._overflowed:
+                self._overflowed = False
+                return [{'type': 'resync', 'data': {}, 'points': []}]
+            events = list(self._events)
+            self._events.clear()
+            return events
+
+
+class EventBroker:
+    """Fans events out to the subscriptions whose viewport they touch"""
+
+    def __init__(self, max_pending=100):
+        self.max_pending = max_pending
+        self.relay = None  # Carries committed events to the brokers of every process
+        self._lock = threading.Lock()
+        self._by_cell = {}  # coarse cell -> set of subscriptions
+        self._everywhere = set()
+
+    def _cells(self, bbox):
+        if bbox is None:
+            return None
+        south, west, north, east = bbox
+        row_min, col_min = _coarse_cell(south, west)
+        row_max, col_max = _coarse_cell(north, east)
+        if (row_max - row_min + 1) * (col_max - col_min + 1) > MAX_INDEXED_CELLS:
+            return None
+        return [(row, col) for row in range(row_min, row_max + 1) for col in range(col_min, col_max + 1)]
+
+    def subscribe(self, bbox=None):
+        if self.relay is not None:
+            self.relay.start()
+        subscription = Subscription(bbox, self.max_pending)
+        cells = self._cells(bbox)
+        with self._lock:
+            if cells is None:
+                self._everywhere.add(subscription)
+            else:
+                for cell in cells:
+                    self._by_cell.setdefault(cell, set()).add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        cells = self._cells(subscription.bbox)
+        with self._lock:
+            if cells is None:
+                self._everywhere.discard(subscription)
+                return
+            for cell in cells:
+                subscribers = self._by_cell.get(cell)
+                if subscribers is not None:
+                    subscribers.discard(subscription)
+                    if not subscribers:
+                        del self._by_cell[cell]
+
+    def subscriber_count(self):
+        with self._lock:
+            return len(self._everywhere | set().union(*self._by_cell.values()))
+
+    def publish(self, event):
+        """Deliver an event to every interested subscriber"""
+        with self._lock:
+            if event['points']:
+                candidates = set(self._everywhere)
+                for lat, lng in event['points']:
+                    candidates.update(self._by_cell.get(_coarse_cell(lat, lng), ()))
+            else:
+                candidates = self._everywhere.union(*self._by_cell.values())
+        for subscription in candidates:
+            if subscription.wants(event):
+                subscription.push(event)
+
+
+class RedisRelay:
+    """Publishes events to a Redis channel and feeds those of all processes to the local broker
+
+    The listening thread is started by the first subscription of a process
+    and restarted when the process id changes, like PeriodicWorker. After
+    losing the connection it tells the local subscribers to resync, since
+    events may have been missed meanwhile.
+    """
+
+    def __init__(self, client, broker, channel=RELAY_CHANNEL):
+        self.client = client
+        self.broker = broker
+        self.channel = channel
+        self._thread = None
+        self._pid = None
+        self._start_lock = threading.Lock()
+
+    def publish(self, event):
+        self.client.publish(self.channel, json.dumps(event))
+
+    def start(self):
+        """Start listening unless this process already does"""
+        if self._pid == os.getpid() and self._thread is not None and self._thread.is_alive():
+            return
+        with self._start_lock:
+            if self._pid == os.getpid() and self._thread is not None and self._thread.is_alive():
+                return
+            subscribed = threading.Event()
+            self._thread = threading.Thread(target=self._listen, args=(subscribed,),
+                                            name='event-relay', daemon=True)
+            self._pid = os.getpid()
+            self._thread.start()
+            # Events committed right after this subscription must not be missed
+            subscribed.wait(5)
+
+    def _listen(self, subscribed):
+        while True:
+            try:
+                pubsub = self.client.pubsub(ignore_subscribe_messages=True)
+                pubsub.subscribe(self.channel)
+                if subscribed.is_set():
+                    self.broker.publish({'type': 'resync', 'data': {}, 'points': []})
+                subscribed.set()
+                for message in pubsub.listen():
+                    if message['type'] == 'message':
+                        self.broker.publish(json.loads(message['data']))
+            except Exception:
+                logger.exception('Event relay lost its connection')
+                subscribed.set()
+                time.sleep(1)
+
+
+def _space_event(space, old_points):
+    """Build the event describing the current state of a space"""
+    points = list(old_points)
+    if space.latitude is not None and space.longitude is not None:
+        points.append((space.latitude, space.longitude))
+    if space.is_active and space.latitude is not None and space.longitude is not None:
+        return {
+            'type': 'upsert',
+            'data': {
+                'id': space.id,
+                'title': space.title,
+                'address': space.address,
+                'latitude': float(space.latitude),
+                'longitude': float(space.longitude),
+                'price_per_hour': float(space.price_per_hour),
+            },
+            'points': points,
+        }
+    return {'type': 'remove', 'data': {'id': space.id}, 'points': points}
+
+
+def _previous_points(space):
+    """Return the coordinates a space had before this flush, if they changed"""
+    state = inspect(space)
+    old_lat = state.attrs.latitude.history.deleted
+    old_lng = state.attrs.longitude.history.deleted
+    lat = old_lat[0] if old_lat else space.latitude
+    lng = old_lng[0] if old_lng else space.longitude
+    if lat is None or lng is None or (lat, lng) == (space.latitude, space.longitude):
+        return []
+    return [(lat, lng)]
+
+
+@db.event.listens_for(Session, 'after_flush')
+def _collect_events(session, flush_context):
+    """Remember the changes of this flush until the transaction commits"""
+    events = session.info.setdefault('space_events', [])
+
+    for space in session.new:
+        if isinstance(space, ParkingSpace):
+            events.append(_space_event(space, []))
+
+    for space in session.deleted:
+        if isinstance(space, ParkingSpace):
+            points = [(space.latitude, space.longitude)] if space.latitude is not None and space.longitude is not None else []
+            events.append({'type': 'remove', 'data': {'id': space.id}, 'points': points})
+
+    for obj in session.dirty:
+        if isinstance(obj, ParkingSpace) and session.is_modified(obj):
+            events.append(_space_event(obj, _previous_points(obj)))
+        elif isinstance(obj, Booking):
+            history = inspect(obj).attrs.status.history
+            if not history.deleted:
+                continue
+            was_booked = history.deleted[0] in BOOKED_STATUSES
+            is_booked = obj.status in BOOKED_STATUSES
+            if was_booked == is_booked:
+                continue
+            row = session.connection().execute(
+                db.select(ParkingSpace.latitude, ParkingSpace.longitude)
+                .where(ParkingSpace.id == obj.parking_space_id)
+            ).first()
+            points = [(row.latitude, row.longitude)] if row and row.latitude is not None and row.longitude is not None else []
+            events.append({
+                'type': 'availability',
+                'data': {'id': obj.parking_space_id, 'booked': is_booked},
+                'points': points,
+            })
+
+
+@db.event.listens_for(Session, 'after_commit')
+def _publish_events(session):
+    events = session.info.pop('space_events', None)
+    if not events or not has_app_context():
+        return
+    broker = current_app.extensions.get('events')
+    if broker is None:
+        return
+    if broker.relay is None:
+        for event in events:
+            broker.publish(event)
+        return
+    try:
+        for event in events:
+            broker.relay.publish(event)
+    except Exception:
+        # Already committed; clients pick the change up when they catch up
+        logger.exception('Could not relay %d space events', len(events))
+
+
+@db.event.listens_for(Session, 'after_rollback')
+def _discard_events(session):
+    session.info.pop('space_events', None)
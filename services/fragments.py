@@ -0,0 +1,132 @@
+"""Cache of rendered parking space cards.
+
+Listing pages render the same card for a space on every request. Cards are
+rendered once from templates/parking/_space_card.html and kept in an
+in-process LRU cache under (variant, space id), together with the version
+they were rendered for. The version is built from the space's change_seq,
+its primary image and its owner's username and rating, all loaded for the
+whole page in bulk, so a card is re-rendered as soon as any of them change.
+"""
+import threading
+from collections import OrderedDict
+
+from flask import current_app, render_template
+from markupsafe import Markup
+
+from models.models import ParkingImage, User, db
+from services.ratings import owner_rating_stats
+
+CARD_TEMPLATE = 'parking/_space_card.html'
+
+
+def init_app(app):
+    """Attach a fragment cache to the application"""
+    app.config.setdefault('FRAGMENT_CACHE_MAX_ENTRIES', 10000)
+    app.extensions['fragments'] = FragmentCache(app.config['FRAGMENT_CACHE_MAX_ENTRIES'])
+
+
+def get_fragment_cache():
+    """Return the fragment cache of the current application"""
+    return current_app.extensions['fragments']
+
+
+class FragmentCache:
+    """Thread-safe LRU mapping of key -> (version, html)"""
+
+    def __init__(self, max_entries=10000):
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, version):
+        """Return the cached html for key if it was rendered for this version"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] != version:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def set(self, key, version, html):
+        if self.max_entries <= 0:
+            return
+        with self._lock:
+            self._entries[key] = (version, html)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+
+def primary_image_urls(space_ids):
+    """Return {space_id: url} of the primary image, or the first one when none is primary
+
+    space_ids is a list of ids or a select of them.
+    """
+    rows = db.session.query(
+        ParkingImage.parking_space_id, ParkingImage.image_url, ParkingImage.is_primary
+    ).filter(ParkingImage.parking_space_id.in_(space_ids)).order_by(ParkingImage.id).all()
+    urls = {}
+    primary = set()
+    for space_id, image_url, is_primary in rows:
+        if is_primary and space_id not in primary:
+            urls[space_id] = image_url
+            primary.add(space_id)
+        else:
+            urls.setdefault(space_id, image_url)
+    return urls
+
+
+def space_cards(spaces, variant, details=None):
+    """Return {space_id: card html} for a page of spaces, rendering only stale cards
+
+    variant is 'list' for the spaces page or 'map' for the list under the map.
+    details maps space ids to (primary_image_url, owner_username,
+    owner_rating, owner_total_ratings) when already known, e.g. from the
+    snapshot; otherwise they are loaded for the page.
+    """
+    if not spaces:
+        return {}
+    if details is None:
+        owner_ids = {space.owner_id for space in spaces}
+        usernames = dict(db.session.query(User.id, User.username).filter(User.id.in_(owner_ids)).all())
+        ratings = owner_rating_stats(owner_ids)
+        images = primary_image_urls([space.id for space in spaces])
+        details = {
+            space.id: (images.get(space.id), usernames.get(space.owner_id),
+                       *ratings.get(space.owner_id, (None, 0)))
+            for space in spaces
+        }
+
+    cache = get_fragment_cache()
+    cards = {}
+    for space in spaces:
+        primary_image_url, owner_username, owner_rating, owner_total_ratings = details[space.id]
+        context = {
+            'space': space,
+            'variant': variant,
+            'primary_image_url': primary_image_url,
+            'owner_username': owner_username,
+            'owner_rating': owner_rating,
+            'owner_total_ratings': owner_total_ratings,
+        }
+        key = (variant, space.id)
+        version = (space.change_seq, context['primary_image_url'], context['owner_username'],
+                   owner_rating, owner_total_ratings)
+        html = cache.get(key, version) if space.change_seq is not None else None
+        if html is None:
+            html = Markup(render_template(CARD_TEMPLATE, **context))
+            if space.change_seq is not None:
+                cache.set(key, version, html)
+        cards[space.id] = html
+    return cards
@@ -0,0 +1,173 @@
+"""Nearest-space search.
+
+Every parking space stores the id of the fixed-size latitude/longitude grid
+cell it falls into (ParkingSpace.geo_cell, indexed). A search first collects
+the candidates of the cells around the point, then ranks them with a
+vectorized haversine over compact coordinate arrays. The search radius grows
+until k spaces are found or the maximum distance is reached.
+"""
+import math
+
+from models.models import ParkingSpace, db
+from services.startup import lazy_import
+
+np = lazy_import('numpy')
+
+EARTH_RADIUS_KM = 6371.0088
+
+# Grid cell size in degrees, roughly 5.5km north-south
+CELL_SIZE = 0.05
+CELLS_PER_ROW = int(round(360 / CELL_SIZE))
+CELL_ROWS = int(round(180 / CELL_SIZE))
+
+# Radius the search starts with before widening
+INITIAL_RADIUS_KM = 2.0
+
+# Beyond this many cells a plain bounding box filter is cheaper
+MAX_CELLS_PER_QUERY = 1500
+
+KM_PER_DEGREE = math.pi * EARTH_RADIUS_KM / 180
+
+
+def cell_of(latitude, longitude):
+    """Return the grid cell id of a coordinate pair, or None without coordinates"""
+    if latitude is None or longitude is None:
+        return None
+    row = min(int(math.floor((latitude + 90) / CELL_SIZE)), CELL_ROWS - 1)
+    col = int(math.floor((longitude + 180) / CELL_SIZE)) % CELLS_PER_ROW
+    return row * CELLS_PER_ROW + col
+
+
+def bounding_box(latitude, longitude, radius_km):
+    """Return (south, west, north, east) degrees enclosing a circle"""
+    dlat = radius_km / KM_PER_DEGREE
+    cos_lat = math.cos(math.radians(latitude))
+    dlng = 180.0 if cos_lat < 1e-6 else min(radius_km / (KM_PER_DEGREE * cos_lat), 180.0)
+    return latitude - dlat, longitude - dlng, latitude + dlat, longitude + dlng
+
+
+def cells_within(latitude, longitude, radius_km):
+    """Return the ids of all cells that may hold points within radius_km
+
+    One extra ring of cells is included so points sitting on a cell edge are
+    found regardless of floating point rounding.
+    """
+    south, west, north, east = bounding_box(latitude, longitude, radius_km)
+    row_min = max(int(math.floor((south + 90) / CELL_SIZE)) - 1, 0)
+    row_max = min(int(math.floor((north + 90) / CELL_SIZE)) + 1, CELL_ROWS - 1)
+    col_min = int(math.floor((west + 180) / CELL_SIZE)) - 1
+    col_max = int(math.floor((east + 180) / CELL_SIZE)) + 1
+    if col_max - col_min + 1 >= CELLS_PER_ROW:
+        cols = range(CELLS_PER_ROW)
+    else:
+        cols = [col % CELLS_PER_ROW for col in range(col_min, col_max + 1)]
+    return [row * CELLS_PER_ROW + col for row in range(row_min, row_max + 1) for col in cols]
+
+
+def haversine_km(latitude, longitude, latitudes, longitudes):
+    """Return the great-circle distances from one point to arrays of points"""
+    lat1 = math.radians(latitude)
+    lat2 = np.radians(latitudes)
+    dlat = lat2 - lat1
+    dlng = np.radians(longitudes) - math.radians(longitude)
+    a = np.sin(dlat / 2) ** 2 + math.cos(lat1) * np.cos(lat2) * np.sin(dlng / 2) ** 2
+    return 2 * EARTH_RADIUS_KM * np.arcsin(np.sqrt(np.minimum(a, 1.0)))
+
+
+def rank_nearest(latitude, longitude, ids, latitudes, longitudes, k, max_km):
+    """Return (ids, distances) of the k nearest points within max_km, closest first"""
+    ids = np.asarray(ids)
+    distances = haversine_km(latitude, longitude,
+                             np.asarray(latitudes, dtype=np.float64),
+                             np.asarray(longitudes, dtype=np.float64))
+    inside = np.flatnonzero(distances <= max_km)
+    if len(inside) > k:
+        inside = inside[np.argpartition(distances[inside], k - 1)[:k]]
+    order = inside[np.argsort(distances[inside], kind='stable')]
+    return ids[order], distances[order]
+
+
+def area_filters(latitude, longitude, radius_km):
+    """Return criteria keeping the spaces in the bounding box of a circle
+
+    The box holds every space within radius_km, and a few in its corners
+    that are further away. Small boxes are looked up by grid cell.
+    """
+    south, west, north, east = bounding_box(latitude, longitude, radius_km)
+    filters = [ParkingSpace.latitude.between(south, north), ParkingSpace.longitude.isnot(None)]
+    if west >= -180 and east <= 180:
+        filters.append(ParkingSpace.longitude.between(west, east))
+    cells = cells_within(latitude, longitude, radius_km)
+    if len(cells) <= MAX_CELLS_PER_QUERY:
+        filters.append(ParkingSpace.geo_cell.in_(cells))
+    return filters
+
+
+def candidate_statement(latitude, longitude, radius_km, filters=()):
+    """Select (id, latitude, longitude) of the active spaces that may lie within radius_km"""
+    return db.select(
+        ParkingSpace.id, ParkingSpace.latitude, ParkingSpace.longitude
+    ).where(ParkingSpace.is_active == True, *filters, *area_filters(latitude, longitude, radius_km))
+
+
+def rank_rows(latitude, longitude, rows, k, radius_km):
+    """rank_nearest() over rows of candidate_statement()"""
+    return rank_nearest(
+        latitude, longitude,
+        np.fromiter((row.id for row in rows), dtype=np.int64, count=len(rows)),
+        np.fromiter((row.latitude for row in rows), dtype=np.float64, count=len(rows)),
+        np.fromiter((row.longitude for row in rows), dtype=np.float64, count=len(rows)),
+        k, radius_km
+    )
+
+
+def next_radius(radius_km, found, k, max_km):
+    """Return the radius to search next, or None when the search is complete"""
+    # Every space within radius has been ranked, so k hits are the true top k
+    if found >= k or radius_km >= max_km:
+        return None
+    return min(radius_km * 2, max_km)
+
+
+def nearest_spaces(latitude, longitude, k=20, max_km=10.0, filters=()):
+    """Return [(space, distance_km)] for the k nearest active spaces
+
+    filters are extra SQLAlchemy criteria applied to the candidate query,
+    e.g. the search and price filters of the list view.
+    """
+    radius = min(INITIAL_RADIUS_KM, max_km)
+    while radius is not None:
+        rows = db.session.execute(candidate_statement(latitude, longitude, radius, filters)).all()
+        ids, distances = rank_rows(latitude, longitude, rows, k, radius)
+        radius = next_radius(radius, len(ids), k, max_km)
+
+    return spaces_by_rank(ids, distances)
+
+
+def spaces_by_rank(ids, distances, filters=()):
+    """Load ranked spaces by id and return [(space, distance_km)] in rank order
+
+    Ids that no longer match the filters are left out.
+    """
+    query = ParkingSpace.query.filter(ParkingSpace.id.in_(ids.tolist()), *filters)
+    spaces = {space.id: space for space in query}
+    return [(spaces[space_id], float(distance))
+            for space_id, distance in zip(ids.tolist(), distances) if space_id in spaces]
+
+
+def parse_near(value):
+    """Parse a 'lat,lng' query parameter, raising ValueError when invalid"""
+    parts = value.split(',')
+    if len(parts) != 2:
+        raise ValueError('near must be given as "latitude,longitude"')
+    latitude, longitude = float(parts[0]), float(parts[1])
+    if not (-90 <= latitude <= 90 and -180 <= longitude <= 180):
+        raise ValueError('near is out of range')
+    return latitude, longitude
+
+
+@db.event.listens_for(ParkingSpace, 'before_insert')
+@db.event.listens_for(ParkingSpace, 'before_update')
+def _update_geo_cell(mapper, connection, space):
+    """Keep the cell id in step with the coordinates on every write"""
+    space.geo_cell = cell_of(space.latitude, space.longitude)
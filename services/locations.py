@@ -0,0 +1,123 @@
+"""Write-behind ingestion of user location pings.
+
+Pings are accepted into an in-memory buffer that keeps only the latest
+position per user. A background thread flushes the buffer with one bulk
+insert every LOCATION_FLUSH_INTERVAL seconds, and once more on shutdown.
+The buffer holds at most LOCATION_BUFFER_MAX_USERS users; beyond that the
+oldest pending ping is dropped.
+"""
+import atexit
+import logging
+import threading
+from collections import OrderedDict
+from datetime import datetime
+
+from flask import current_app
+
+from models.models import UserLocation, db
+from services.background import PeriodicWorker
+
+logger = logging.getLogger(__name__)
+
+
+def init_app(app):
+    """Attach a location buffer to the application"""
+    app.config.setdefault('LOCATION_FLUSH_INTERVAL', 5.0)
+    app.config.setdefault('LOCATION_BUFFER_MAX_USERS', 10000)
+    buffer = LocationBuffer(
+        max_users=app.config['LOCATION_BUFFER_MAX_USERS'],
+        flush_interval=app.config['LOCATION_FLUSH_INTERVAL'],
+        writer=lambda rows: _write_locations(app, rows)
+    )
+    app.extensions['locations'] = buffer
+    atexit.register(buffer.shutdown)
+
+
+def get_location_buffer():
+    """Return the location buffer of the current application"""
+    return current_app.extensions['locations']
+
+
+def _write_locations(app, rows):
+    """Insert a batch of location rows in one statement"""
+    with app.app_context():
+        db.session.execute(db.insert(UserLocation), rows)
+        db.session.commit()
+
+
+class LocationBuffer:
+    """Coalesces location pings per user and writes them in batches"""
+
+    def __init__(self, max_users=10000, flush_interval=5.0, writer=None):
+        self.max_users = max_users
+        self.writer = writer
+        self.dropped = 0
+        self._pending = OrderedDict()  # user id -> (latitude, longitude, recorded_at)
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._worker = PeriodicWorker('location-flusher', flush_interval, self.flush)
+
+    def add(self, user_id, latitude, longitude, recorded_at=None):
+        """Record a ping, replacing any pending ping of the same user"""
+        ping = (latitude, longitude, recorded_at or datetime.utcnow())
+        with self._lock:
+            self._pending.pop(user_id, None)
+            self._pending[user_id] = ping
+            if len(self._pending) > self.max_users:
+                self._pending.popitem(last=False)
+                self.dropped += 1
+            nearly_full = len(self._pending) >= self.max_users * 0.8
+        self._worker.start()
+        if nearly_full:
+            self._worker.wake()
+
+    def latest(self, user_id):
+        """Return the pending (latitude, longitude, recorded_at) of a user, if any"""
+        with self._lock:
+            return self._pending.get(user_id)
+
+    def __len__(self):
+        return len(self._pending)
+
+    def flush(self):
+        """Write all pending pings, returning how many were written"""
+        with self._flush_lock:
+            with self._lock:
+                batch, self._pending = self._pending, OrderedDict()
+            if not batch:
+                return 0
+
+            rows = [{
+                'user_id': user_id,
+                'latitude': latitude,
+                'longitude': longitude,
+                'recorded_at': recorded_at,
+            } for user_id, (latitude, longitude, recorded_at) in batch.items()]
+            try:
+                self.writer(rows)
+            except Exception:
+                logger.exception('Failed to write %d location pings', len(rows))
+                self._requeue(batch)
+                return 0
+            return len(rows)
+
+    def _requeue(self, batch):
+        """Put a failed batch back without overwriting newer pings"""
+        dropped = 0
+        with self._lock:
+            for user_id, ping in reversed(batch.items()):
+                if user_id in self._pending:
+                    continue
+                if len(self._pending) >= self.max_users:
+                    dropped += 1
+                    continue
+                self._pending[user_id] = ping
+                self._pending.move_to_end(user_id, last=False)
+            self.dropped += dropped
+        if dropped:
+            logger.error('Dropped %d location pings that could not be written', dropped)
+
+    def shutdown(self):
+        """Stop the flusher and write what is still pending"""
+        self._worker.stop()
+        self.flush()
@@ -0,0 +1,124 @@
+"""Compact encodings of the parking spaces API.
+
+The default listing is a list of objects that repeats every key for every
+space. The compact format stores one array per field instead, coordinates
+as integers at a fixed precision and owner details once per owner:
+
+    {
+        "format": "columns-v1",
+        "count": 2,
+        "coord_scale": 100000,
+        "id": [4, 9],
+        "title": [...], "address": [...],
+        "lat": [1852040, 1853001], "lng": [7385670, 7386012],
+        "price_per_hour": [40.0, 25.5],
+        "owner": [0, 0],
+        "owners": {"username": ["asha"], "rating": [4.5], "total_ratings": [12]}
+    }
+
+When orjson is installed it replaces the standard JSON provider.
+"""
+from flask.json.provider import DefaultJSONProvider
+
+try:
+    import orjson
+except ImportError:  # Optional, the standard library json module is used instead
+    orjson = None
+
+COMPACT_FORMAT = 'columns-v1'
+
+# Coordinates are sent as integers in units of 1e-5 degrees, about 1.1m
+COORD_SCALE = 100000
+
+
+def encode_compact(spaces_data):
+    """Convert space dicts as returned by space_to_dict() to the columnar format"""
+    owner_index = {}
+    owners = {'username': [], 'rating': [], 'total_ratings': []}
+    columns = {
+        'id': [], 'title': [], 'address': [], 'lat': [], 'lng': [],
+        'price_per_hour': [], 'owner': [],
+    }
+    with_distance = bool(spaces_data) and 'distance_km' in spaces_data[0]
+    if with_distance:
+        columns['distance_km'] = []
+
+    for space in spaces_data:
+        username = space['owner_username']
+        index = owner_index.get(username)
+        if index is None:
+            index = owner_index[username] = len(owners['username'])
+            owners['username'].append(username)
+            owners['rating'].append(space['owner_rating'])
+            owners['total_ratings'].append(space['owner_total_ratings'])
+
+        columns['id'].append(space['id'])
+        columns['title'].append(space['title'])
+        columns['address'].append(space['address'])
+        columns['lat'].append(_fixed(space['latitude']))
+        columns['lng'].append(_fixed(space['longitude']))
+        columns['price_per_hour'].append(space['price_per_hour'])
+        columns['owner'].append(index)
+        if with_distance:
+            columns['distance_km'].append(space['distance_km'])
+
+    payload = {'format': COMPACT_FORMAT, 'count': len(spaces_data), 'coord_scale': COORD_SCALE}
+    payload.update(columns)
+    payload['owners'] = owners
+    return payload
+
+
+def decode_compact(payload):
+    """Turn a columnar payload back into the list of space dicts"""
+    scale = payload['coord_scale']
+    owners = payload['owners']
+    spaces_data = []
+    for i in range(payload['count']):
+        owner = payload['owner'][i]
+        space = {
+            'id': payload['id'][i],
+            'title': payload['title'][i],
+            'address': payload['address'][i],
+            'latitude': None if payload['lat'][i] is None else payload['lat'][i] / scale,
+            'longitude': None if payload['lng'][i] is None else payload['lng'][i] / scale,
+            'price_per_hour': payload['price_per_hour'][i],
+            'owner_username': owners['username'][owner],
+            'owner_rating': owners['rating'][owner],
+            'owner_total_ratings': owners['total_ratings'][owner],
+        }
+        if 'distance_km' in payload:
+            space['distance_km'] = payload['distance_km'][i]
+        spaces_data.append(space)
+    return spaces_data
+
+
+def _fixed(value):
+    return None if value is None else int(round(value * COORD_SCALE))
+
+
+class OrjsonProvider(DefaultJSONProvider):
+    """JSON provider backed by orjson, several times faster than json"""
+
+    # Options orjson can honour; anything else, e.g. the object_hook of the
+    # session serializer, is left to the standard library provider
+    ORJSON_DUMPS_OPTIONS = {'sort_keys', 'separators'}
+
+    def dumps(self, obj, **kwargs):
+        if kwargs.keys() - self.ORJSON_DUMPS_OPTIONS:
+            return super().dumps(obj, **kwargs)
+        # Datetimes go through default() so they keep Flask's HTTP date format
+        option = orjson.OPT_NON_STR_KEYS | orjson.OPT_PASSTHROUGH_DATETIME
+        if kwargs.get('sort_keys', self.sort_keys):
+            option |= orjson.OPT_SORT_KEYS
+        return orjson.dumps(obj, default=self.default, option=option).decode('utf-8')
+
+    def loads(self, s, **kwargs):
+        if kwargs:
+            return super().loads(s, **kwargs)
+        return orjson.loads(s)
+
+
+def init_app(app):
+    """Use the fastest available JSON serializer"""
+    if orjson is not None and app.config.get('JSON_USE_ORJSON', True):
+        app.json = OrjsonProvider(app)
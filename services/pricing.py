@@ -0,0 +1,196 @@
+"""Demand-based pricing for parking spaces.
+
+Price grids are computed for every active space in one vectorized batch from
+the booking history. Each grid holds one price per hour of the week
+(Monday 00:00 is slot 0), so quoting a booking only sums precomputed slots.
+"""
+import math
+import threading
+import time
+from datetime import datetime, timedelta
+
+from flask import current_app
+
+from models.models import ParkingSpace, Booking, db
+from services.sharding import gather
+from services.startup import lazy_import
+
+np = lazy_import('numpy')
+
+SLOTS_PER_WEEK = 7 * 24
+
+# Bookings in these states never occupied the space
+IGNORED_STATUSES = ('cancelled',)
+
+
+def init_app(app):
+    """Attach a pricing engine to the application"""
+    app.config.setdefault('PRICING_LOOKBACK_DAYS', 56)
+    app.config.setdefault('PRICING_REFRESH_SECONDS', 900)
+    app.config.setdefault('PRICING_SENSITIVITY', 0.8)
+    app.config.setdefault('PRICING_TARGET_OCCUPANCY', 0.5)
+    app.config.setdefault('PRICING_LOCAL_WEIGHT', 0.3)
+    app.config.setdefault('PRICING_MIN_MULTIPLIER', 0.8)
+    app.config.setdefault('PRICING_MAX_MULTIPLIER', 1.8)
+    app.config.setdefault('PRICING_CELL_SIZE', 0.01)  # degrees, roughly 1km
+    app.extensions['pricing'] = PricingEngine()
+
+
+def get_pricing_engine():
+    """Return the pricing engine of the current application"""
+    return current_app.extensions['pricing']
+
+
+def compute_price_grids(base_prices, cell_ids, booking_space_idx, booking_start_slots,
+                        booking_hours, weeks, sensitivity=0.8, target_occupancy=0.5,
+                        local_weight=0.3, min_multiplier=0.8, max_multiplier=1.8):
+    """Compute an (n_spaces, 168) float32 price grid for all spaces at once
+
+    booking_space_idx indexes into base_prices, booking_start_slots is the
+    hour-of-week each booking starts in and booking_hours how many hourly
+    slots it covers. cell_ids groups spaces into neighbourhoods whose mean
+    occupancy is blended into each space's own demand.
+    """
+    base_prices = np.asarray(base_prices, dtype=np.float64)
+    n_spaces = len(base_prices)
+    if n_spaces == 0:
+        return np.zeros((0, SLOTS_PER_WEEK), dtype=np.float32)
+
+    # Expand every booking into the hourly slots it occupies
+    hours = np.clip(np.asarray(booking_hours, dtype=np.int64), 1, SLOTS_PER_WEEK)
+    space_idx = np.asarray(booking_space_idx, dtype=np.int64)
+    start_slots = np.asarray(booking_start_slots, dtype=np.int64)
+    first = np.cumsum(hours) - hours
+    offsets = np.arange(hours.sum()) - np.repeat(first, hours)
+    slots = (np.repeat(start_slots, hours) + offsets) % SLOTS_PER_WEEK
+    flat = np.repeat(space_idx, hours) * SLOTS_PER_WEEK + slots
+    counts = np.bincount(flat, minlength=n_spaces * SLOTS_PER_WEEK)
+    own = np.minimum(counts.reshape(n_spaces, SLOTS_PER_WEEK) / max(weeks, 1.0), 1.0)
+
+    # Mean occupancy of the neighbourhood each space sits in
+    _, cell_idx = np.unique(np.asarray(cell_ids), return_inverse=True)
+    cell_idx = cell_idx.reshape(-1)
+    cell_totals = np.zeros((cell_idx.max() + 1, SLOTS_PER_WEEK))
+    np.add.at(cell_totals, cell_idx, own)
+    cell_sizes = np.bincount(cell_idx)
+    local = cell_totals[cell_idx] / cell_sizes[cell_idx, None]
+
+    demand = (1.0 - local_weight) * own + local_weight * local
+    multiplier = np.clip(1.0 + sensitivity * (demand - target_occupancy),
+                         min_multiplier, max_multiplier)
+    # Without any booking history nearby there is no signal to price on
+    multiplier[demand.sum(axis=1) == 0] = 1.0
+    return np.round(base_prices[:, None] * multiplier, 2).astype(np.float32)
+
+
+def hour_of_week(moment):
+    """Return the hourly slot a datetime falls into"""
+    return moment.weekday() * 24 + moment.hour
+
+
+class PricingEngine:
+    """Holds the latest price grid of every space and quotes booking windows"""
+
+    def __init__(self):
+        self._grids = {}  # space id -> (base price at build time, float32[168])
+        self._built_at = None
+        self._lock = threading.Lock()
+
+    def is_stale(self):
+        if self._built_at is None:
+            return True
+        return time.monotonic() - self._built_at > current_app.config['PRICING_REFRESH_SECONDS']
+
+    def rebuild(self):
+        """Recompute the grids of all active spaces from recent bookings"""
+        config = current_app.config
+        # Grids are kept for the spaces of every region
+        spaces = gather(lambda: db.session.query(
+            ParkingSpace.id, ParkingSpace.price_per_hour,
+            ParkingSpace.latitude, ParkingSpace.longitude
+        ).filter(ParkingSpace.is_active == True).all())
+
+        lookback = timedelta(days=config['PRICING_LOOKBACK_DAYS'])
+        cutoff = datetime.utcnow() - lookback
+        bookings = gather(lambda: db.session.query(
+            Booking.parking_space_id, Booking.start_time, Booking.end_time
+        ).filter(
+            Booking.start_time >= cutoff,
+            Booking.status.notin_(IGNORED_STATUSES)
+        ).all())
+
+        ids = np.array([row.id for row in spaces], dtype=np.int64)
+        base_prices = np.array([row.price_per_hour for row in spaces], dtype=np.float64)
+        # Spaces without coordinates each get a neighbourhood of their own
+        cell_size = config['PRICING_CELL_SIZE']
+        cell_keys = [
+            (math.floor(row.latitude / cell_size), math.floor(row.longitude / cell_size))
+            if row.latitude is not None and row.longitude is not None else ('space', row.id)
+            for row in spaces
+        ]
+        cell_index = {}
+        cell_ids = [cell_index.setdefault(key, len(cell_index)) for key in cell_keys]
+
+        index_of = {space_id: i for i, space_id in enumerate(ids.tolist())}
+        known = [b for b in bookings if b.parking_space_id in index_of]
+        starts = np.array([b.start_time for b in known], dtype='datetime64[s]')
+        ends = np.array([b.end_time for b in known], dtype='datetime64[s]')
+        seconds = starts.astype(np.int64)
+        # 1970-01-01 was a Thursday, i.e. weekday 3
+        weekdays = (seconds // 86400 + 3) % 7
+        start_slots = weekdays * 24 + (seconds // 3600) % 24
+        durations = (ends - starts).astype(np.int64)
+        booking_hours = np.ceil(durations / 3600.0).astype(np.int64)
+
+        grids = compute_price_grids(
+            base_prices, cell_ids,
+            [index_of[b.parking_space_id] for b in known],
+            start_slots, booking_hours,
+            weeks=lookback.days / 7.0,
+            sensitivity=config['PRICING_SENSITIVITY'],
+            target_occupancy=config['PRICING_TARGET_OCCUPANCY'],
+            local_weight=config['PRICING_LOCAL_WEIGHT'],
+            min_multiplier=config['PRICING_MIN_MULTIPLIER'],
+            max_multiplier=config['PRICING_MAX_MULTIPLIER'],
+        )
+
+        self._grids = {
+            space_id: (float(base_prices[i]), grids[i])
+            for i, space_id in enumerate(ids.tolist())
+        }
+        self._built_at = time.monotonic()
+
+    def grid_for(self, space):
+        """Return the hourly price grid of a space, rebuilding grids when stale"""
+        if self.is_stale() and self._lock.acquire(blocking=False):
+            try:
+                self.rebuild()
+            finally:
+                self._lock.release()
+
+        entry = self._grids.get(space.id)
+        if entry is None:
+            # New or inactive space: flat base price until the next rebuild
+            return np.full(SLOTS_PER_WEEK, space.price_per_hour, dtype=np.float32)
+        base_price, grid = entry
+        if base_price != space.price_per_hour:
+            if not base_price:
+                # A free space's grid has nothing to scale: flat price until rebuilt
+                return np.full(SLOTS_PER_WEEK, space.price_per_hour, dtype=np.float32)
+            # The owner changed the base price since the grids were built
+            return grid * np.float32(space.price_per_hour / base_price)
+        return grid
+
+    def quote(self, space, start, end):
+        """Return the total price of booking a space from start to end"""
+        grid = self.grid_for(space)
+        first_hour = start.replace(minute=0, second=0, microsecond=0)
+        n_hours = math.ceil((end - first_hour).total_seconds() / 3600)
+        slots = (hour_of_week(first_hour) + np.arange(n_hours)) % SLOTS_PER_WEEK
+
+        # Fraction of each hourly slot actually covered by the booking
+        fractions = np.ones(n_hours)
+        fractions[0] -= (start - first_hour).total_seconds() / 3600
+        fractions[-1] -= (first_hour + timedelta(hours=n_hours) - end).total_seconds() / 3600
+
+        return round(float(np.dot(grid[slots].astype(np.float64), fractions)), 2)
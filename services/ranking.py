@@ -0,0 +1,195 @@
+"""Sort orders of the space listing and the precomputed ranking scores.
+
+Every parking space stores two scores next to its price:
+
+    rating_score  its owner's average rating, smoothed towards a prior so
+                  owners with a handful of ratings do not outrank owners
+                  with hundreds (a Bayesian average)
+    rank_score    rating_score blended with how cheap the space is, used
+                  by the default 'recommended' order
+
+Each sort order has a composite index (is_active, <sort column>, id).
+Pages are read by keyset: a page starts after the (sort column, id) of the
+last space of the page before, so the index finds where it starts instead
+of the database skipping the rows of all earlier pages. The indexes do not
+cover the listing, so each space shown is still read from the table. The
+scores are kept up to date as feedback arrives and prices change; the
+refresh-rankings command recomputes all of them, e.g. after changing the
+settings.
+"""
+import click
+from flask import current_app, has_app_context
+from flask.cli import with_appcontext
+from sqlalchemy import inspect
+from sqlalchemy.orm import Session
+
+from models.models import Booking, Feedback, ParkingSpace, db
+from services.ratings import rating_stats_statement
+from services.sharding import each_region
+
+DEFAULTS = {
+    'RANKING_PRIOR_RATING': 3.5,     # rating assumed before any feedback
+    'RANKING_PRIOR_WEIGHT': 5,       # how many ratings the prior counts as
+    'RANKING_PRICE_WEIGHT': 0.3,     # share of price in the rank score
+    'RANKING_PRICE_REFERENCE': 50.0, # price per hour that scores half
+}
+
+MAX_RATING = 5
+
+DEFAULT_SORT = 'recommended'
+
+# Sort column and whether it is descending, matching the ix_parking_spaces_active_* indexes;
+# ties are broken by id in the same direction
+SORT_KEYS = {
+    'recommended': (ParkingSpace.rank_score, True),
+    'price': (ParkingSpace.price_per_hour, False),
+    'newest': (ParkingSpace.created_at, True),
+    'rating': (ParkingSpace.rating_score, True),
+}
+
+# Sort modes offered by the listing; distance needs a location
+SORT_MODES = ('recommended', 'price', 'newest', 'rating', 'distance')
+
+DEFAULT_PAGE_SIZE = 24
+REFRESH_BATCH_SIZE = 500
+
+
+def init_app(app):
+    """Register the ranking settings and the refresh command"""
+    for key, value in DEFAULTS.items():
+        app.config.setdefault(key, value)
+    app.config.setdefault('SPACES_PER_PAGE', DEFAULT_PAGE_SIZE)
+    app.cli.add_command(refresh_rankings_command)
+
+
+def _settings():
+    config = current_app.config if has_app_context() else {}
+    return {key: config.get(key, value) for key, value in DEFAULTS.items()}
+
+
+def bayesian_rating(total, count, prior_rating, prior_weight):
+    """Average rating smoothed towards the prior"""
+    return (prior_rating * prior_weight + total) / (prior_weight + count)
+
+
+def blend_score(rating_score, price, price_weight, price_reference):
+    """Rank score in [0, 1]; works on numbers as well as SQL expressions"""
+    cheapness = price_reference / (price_reference + price)
+    return (1 - price_weight) * rating_score / MAX_RATING + price_weight * cheapness
+
+
+def owner_rating_scores(connection, owner_ids):
+    """Return {owner_id: rating_score} for the given owners"""
+    settings = _settings()
+    stats = {owner_id: (total, count) for owner_id, total, count
+             in connection.execute(rating_stats_statement(owner_ids))}
+    return {
+        owner_id: bayesian_rating(*stats.get(owner_id, (0, 0)),
+                                  settings['RANKING_PRIOR_RATING'], settings['RANKING_PRIOR_WEIGHT'])
+        for owner_id in owner_ids
+    }
+
+
+def refresh_owner_scores(connection, owner_ids):
+    """Recompute the scores of all spaces of the given owners"""
+    settings = _settings()
+    for owner_id, rating_score in owner_rating_scores(connection, set(owner_ids)).items():
+        connection.execute(
+            db.update(ParkingSpace)
+            .where(ParkingSpace.owner_id == owner_id)
+            .values(rating_score=rating_score,
+                    rank_score=blend_score(rating_score, ParkingSpace.price_per_hour,
+                                           settings['RANKING_PRICE_WEIGHT'],
+                                           settings['RANKING_PRICE_REFERENCE']))
+        )
+
+
+def _beyond(sort, anchor_id, backwards=False):
+    """Criteria for the spaces after, or before, the space anchor_id in a sort order
+
+    The anchor's sort value is read by a subquery, so it is compared exactly
+    as stored. NULL scores, not computed yet, sort below every value as in
+    MySQL and SQLite.
+    """
+    column, descending = SORT_KEYS[sort]
+    anchor = db.select(column).where(ParkingSpace.id == anchor_id).scalar_subquery()
+    if descending != backwards:
+        criteria = [column < anchor, db.and_(column == anchor, ParkingSpace.id < anchor_id)]
+        if column.nullable:
+            criteria.append(db.and_(column.is_(None), db.or_(anchor.isnot(None), ParkingSpace.id < anchor_id)))
+    else:
+        criteria = [column > anchor, db.and_(column == anchor, ParkingSpace.id > anchor_id)]
+        if column.nullable:
+            criteria.append(db.and_(anchor.is_(None), db.or_(column.isnot(None), ParkingSpace.id > anchor_id)))
+    return db.or_(*criteria)
+
+
+def sorted_spaces(filters, sort=DEFAULT_SORT, per_page=DEFAULT_PAGE_SIZE, after=None, before=None):
+    """Return (spaces, has_more) of one page of active spaces in a sort order
+
+    after is the id of the last space of the previous page, before that of
+    the first space of the next page; without either the first page is
+    returned. has_more tells whether more spaces lie beyond the page in
+    the direction it was read.
+    """
+    column, descending = SORT_KEYS[sort]
+    backwards = after is None and before is not None
+    query = ParkingSpace.query.filter(ParkingSpace.is_active == True, *filters)
+    if after is not None or before is not None:
+        query = query.filter(_beyond(sort, after if after is not None else before, backwards))
+    if descending != backwards:
+        query = query.order_by(column.desc(), ParkingSpace.id.desc())
+    else:
+        query = query.order_by(column.asc(), ParkingSpace.id.asc())
+    spaces = query.limit(per_page + 1).all()
+    has_more = len(spaces) > per_page
+    spaces = spaces[:per_page]
+    if backwards:
+        spaces.reverse()
+    return spaces, has_more
+
+
+@db.event.listens_for(ParkingSpace, 'before_insert')
+@db.event.listens_for(ParkingSpace, 'before_update')
+def _update_rank_score(mapper, connection, space):
+    """Score new spaces and rescore spaces whose price or owner changed"""
+    state = inspect(space)
+    if space.rating_score is not None and not state.attrs.price_per_hour.history.has_changes() \
+            and not state.attrs.owner_id.history.has_changes():
+        return
+    if space.rating_score is None or state.attrs.owner_id.history.has_changes():
+        space.rating_score = owner_rating_scores(connection, {space.owner_id})[space.owner_id]
+    settings = _settings()
+    space.rank_score = blend_score(space.rating_score, space.price_per_hour,
+                                   settings['RANKING_PRICE_WEIGHT'], settings['RANKING_PRICE_REFERENCE'])
+
+
+@db.event.listens_for(Session, 'after_flush')
+def _rescore_rated_owners(session, flush_context):
+    """Rescore the spaces of owners who just received feedback"""
+    booking_ids = {obj.booking_id for obj in session.new if isinstance(obj, Feedback)}
+    if not booking_ids:
+        return
+    connection = session.connection()
+    owner_ids = connection.execute(
+        db.select(Booking.owner_id).where(Booking.id.in_(booking_ids)).distinct()
+    ).scalars().all()
+    refresh_owner_scores(connection, owner_ids)
+
+
+@click.command('refresh-rankings')
+@click.option('--batch-size', default=REFRESH_BATCH_SIZE, show_default=True,
+              help='Owners rescored per transaction.')
+@with_appcontext
+def refresh_rankings_command(batch_size):
+    """Recompute the ranking scores of all parking spaces"""
+    rescored = 0
+    for _ in each_region():
+        owner_ids = db.session.execute(
+            db.select(ParkingSpace.owner_id).distinct().order_by(ParkingSpace.owner_id)
+        ).scalars().all()
+        for start in range(0, len(owner_ids), batch_size):
+            refresh_owner_scores(db.session.connection(), owner_ids[start:start + batch_size])
+            db.session.commit()
+        rescored += len(owner_ids)
+    click.echo(f'Rescored the spaces of {rescored} owners.')
@@ -0,0 +1,257 @@
+"""Rate limiting and load shedding.
+
+Rate limits are token buckets per route and per client. A client is its
+user id when logged in and its IP address otherwise, or always its IP
+address for rules with key 'ip'. RATELIMIT_RULES maps endpoint names to
+rules:
+
+    'auth.login': {'limit': '10/minute', 'key': 'ip', 'methods': ('POST',)}
+
+A limit of N per period lets a client make N requests at once and then one
+every period/N. Buckets live in process memory by default, so each worker
+limits on its own. With RATELIMIT_STORAGE_URL set to a redis:// URL (and
+the redis package installed) all workers share them.
+
+Load shedding turns requests away with 503 instead of letting them wait
+until they time out: when a worker already handles
+LOAD_SHED_MAX_IN_FLIGHT requests, or when a request waited in a queue for
+longer than LOAD_SHED_MAX_QUEUE_SECONDS. The wait is measured from the
+X-Request-Start header ("t=<unix time>"), which a proxy such as nginx or
+the ASGI app sets when the request arrives.
+
+Both answer quickly with a Retry-After header, in JSON for API routes.
+"""
+import math
+import threading
+import time
+
+from flask import g, jsonify, request
+from flask_login import current_user
+from werkzeug.exceptions import ServiceUnavailable, TooManyRequests
+
+PERIODS = {'second': 1, 'minute': 60, 'hour': 3600, 'day': 86400}
+
+DEFAULT_RULES = {
+    # Password hashing makes failed logins and registrations expensive
+    'auth.login': {'limit': '10/minute', 'key': 'ip', 'methods': ('POST',)},
+    'auth.register': {'limit': '5/minute', 'key': 'ip', 'methods': ('POST',)},
+    # Also covers delta sync, which is the same endpoint with ?since=
+    'parking.api_parking_spaces': {'limit': '120/minute'},
+}
+
+# Long-lived or trivial requests that never count as load
+LOAD_SHED_EXEMPT = ('static', 'parking.stream_parking_spaces')
+
+REDIS_SCRIPT = """
+local rate = tonumber(ARGV[1])
+local burst = tonumber(ARGV[2])
+local cost = tonumber(ARGV[3])
+local clock = redis.call('TIME')
+local now = tonumber(clock[1]) + tonumber(clock[2]) / 1000000
+local state = redis.call('HMGET', KEYS[1], 'tokens', 'updated')
+local tokens = tonumber(state[1]) or burst
+local updated = tonumber(state[2]) or now
+tokens = math.min(burst, tokens + math.max(0, now - updated) * rate)
+local wait = 0
+if tokens >= cost then
+    tokens = tokens - cost
+else
+    wait = (cost - tokens) / rate
+end
+redis.call('HSET', KEYS[1], 'tokens', tostring(tokens), 'updated', tostring(now))
+redis.call('PEXPIRE', KEYS[1], math.ceil(burst / rate * 1000))
+return tostring(wait)
+"""
+
+
+def init_app(app):
+    """Limit and shed the requests of the application"""
+    app.config.setdefault('RATELIMIT_ENABLED', True)
+    app.config.setdefault('RATELIMIT_STORAGE_URL', 'memory://')
+    app.config.setdefault('RATELIMIT_RULES', DEFAULT_RULES)
+    app.config.setdefault('LOAD_SHED_MAX_IN_FLIGHT', 64)
+    app.config.setdefault('LOAD_SHED_MAX_QUEUE_SECONDS', 10.0)
+
+    limiter = RateLimiter(create_backend(app.config['RATELIMIT_STORAGE_URL']),
+                          app.config['RATELIMIT_RULES'])
+    shedder = LoadShedder(app.config['LOAD_SHED_MAX_IN_FLIGHT'])
+    app.extensions['ratelimit'] = limiter
+    app.extensions['load_shedder'] = shedder
+
+    @app.before_request
+    def shed_and_limit():
+        if request.endpoint in LOAD_SHED_EXEMPT:
+            return None
+        waited = queue_seconds(request.headers.get('X-Request-Start'))
+        max_wait = app.config['LOAD_SHED_MAX_QUEUE_SECONDS']
+        if max_wait and waited is not None and waited > max_wait:
+            return limit_response(ServiceUnavailable, 1)
+        if not shedder.enter():
+            return limit_response(ServiceUnavailable, 1)
+        g.load_shed_entered = True
+
+        if app.config['RATELIMIT_ENABLED']:
+            retry_after = limiter.hit(request.endpoint, request.method, client_key)
+            if retry_after:
+                return limit_response(TooManyRequests, retry_after)
+        return None
+
+    @app.teardown_request
+    def leave(exc=None):
+        if g.pop('load_shed_entered', False):
+            shedder.leave()
+
+
+def parse_limit(limit):
+    """Turn 'N/period' into (tokens per second, burst)"""
+    count, _, period = limit.partition('/')
+    try:
+        count = int(count)
+        seconds = PERIODS[period.strip()]
+    except (KeyError, ValueError):
+        raise ValueError(f'Invalid rate limit {limit!r}, expected e.g. "10/minute"')
+    if count <= 0:
+        raise ValueError(f'Invalid rate limit {limit!r}, the count must be positive')
+    return count / seconds, count
+
+
+def queue_seconds(header, now=None):
+    """Return how long ago an X-Request-Start header was set, or None"""
+    if not header:
+        return None
+    try:
+        started = float(header[2:] if header.startswith('t=') else header)
+    except ValueError:
+        return None
+    # nginx sends seconds with millisecond precision, some proxies microseconds
+    while started > 1e11:
+        started /= 1000
+    return (now if now is not None else time.time()) - started
+
+
+def client_key(kind):
+    """Return the bucket key of the current client"""
+    if kind != 'ip' and current_user.is_authenticated:
+        return f'user:{current_user.id}'
+    return f'ip:{request.remote_addr}'
+
+
+def limit_response(error, retry_after):
+    """Answer a limited request at once, with a Retry-After in whole seconds"""
+    retry_after = max(1, math.ceil(retry_after))
+    if '/api/' in request.path:
+        response = jsonify({'error': error.description})
+        response.status_code = error.code
+        response.headers['Retry-After'] = str(retry_after)
+        return response
+    return error(retry_after=retry_after).get_response()
+
+
+def create_backend(url):
+    """Return the bucket store for a RATELIMIT_STORAGE_URL"""
+    if url.startswith('memory://'):
+        return MemoryBackend()
+    if url.startswith(('redis://', 'rediss://', 'unix://')):
+        try:
+            import redis
+        except ImportError:
+            raise RuntimeError('RATELIMIT_STORAGE_URL needs the redis package, see requirements-optional.txt')
+        return RedisBackend(redis.Redis.from_url(url))
+    raise ValueError(f'Unsupported RATELIMIT_STORAGE_URL {url!r}')
+
+
+class MemoryBackend:
+    """Token buckets in process memory"""
+
+    def __init__(self, max_keys=100000):
+        self.max_keys = max_keys
+        self._buckets = {}
+        self._lock = threading.Lock()
+
+    def take(self, key, rate, burst, cost=1, now=None):
+        """Take cost tokens; return 0 when taken, else the seconds until they will be there"""
+        now = time.monotonic() if now is None else now
+        with self._lock:
+            tokens, updated = self._buckets.get(key, (burst, now))
+            tokens = min(burst, tokens + max(0.0, now - updated) * rate)
+            wait = 0.0
+            if tokens >= cost:
+                tokens -= cost
+            else:
+                wait = (cost - tokens) / rate
+            if key not in self._buckets and len(self._buckets) >= self.max_keys:
+                self._prune(now)
+            self._buckets[key] = (tokens, now)
+            return wait
+
+    def _prune(self, now):
+        """Forget the buckets idle for an hour, or else the least recently used tenth"""
+        stale = [key for key, (_, updated) in self._buckets.items() if now - updated > 3600]
+        if not stale:
+            by_age = sorted(self._buckets, key=lambda key: self._buckets[key][1])
+            stale = by_age[:len(by_age) // 10 + 1]
+        for key in stale:
+            del self._buckets[key]
+
+    def __len__(self):
+        return len(self._buckets)
+
+
+class RedisBackend:
+    """Token buckets in Redis, shared by all workers and hosts"""
+
+    def __init__(self, client, prefix='ratelimit:'):
+        self.client = client
+        self.prefix = prefix
+        self._script = client.register_script(REDIS_SCRIPT)
+
+    def take(self, key, rate, burst, cost=1, now=None):
+        return float(self._script(keys=[self.prefix + key], args=[rate, burst, cost]))
+
+
+class RateLimiter:
+    """Applies the configured rules to requests"""
+
+    def __init__(self, backend, rules):
+        self.backend = backend
+        self.rules = {}
+        for endpoint, rule in rules.items():
+            rate, burst = parse_limit(rule['limit'])
+            methods = rule.get('methods')
+            self.rules[endpoint] = {
+                'rate': rate,
+                'burst': burst,
+                'key': rule.get('key', 'user'),
+                'methods': {method.upper() for method in methods} if methods else None,
+            }
+
+    def hit(self, endpoint, method, key_for):
+        """Count a request; return 0 when allowed, else the seconds to wait
+
+        key_for(kind) returns the client's key for a rule's key kind.
+        """
+        rule = self.rules.get(endpoint)
+        if rule is None or (rule['methods'] is not None and method not in rule['methods']):
+            return 0
+        return self.backend.take(f"{endpoint}:{key_for(rule['key'])}", rule['rate'], rule['burst'])
+
+
+class LoadShedder:
+    """Counts the requests in progress and refuses those above the limit"""
+
+    def __init__(self, max_in_flight):
+        self.max_in_flight = max_in_flight
+        self.in_flight = 0
+        self._lock = threading.Lock()
+
+    def enter(self):
+        """Start a request; False when the worker is already full"""
+        with self._lock:
+            if self.max_in_flight and self.in_flight >= self.max_in_flight:
+                return False
+            self.in_flight += 1
+            return True
+
+    def leave(self):
+        with self._lock:
+            self.in_flight -= 1
@@ -0,0 +1,49 @@
+"""Owner ratings aggregated in the database.
+
+Listings that show many owners use owner_rating_stats(), which aggregates
+the ratings of all of them in a single grouped query over both the live
+and the archived feedback, one per region shard.
+"""
+from models.models import ArchivedFeedback, Booking, Feedback, db
+from services.sharding import gather
+
+
+def rating_stats_statement(owner_ids):
+    """Select (owner_id, rating_sum, rating_count) of the given owners"""
+    ratings = db.union_all(
+        db.select(Booking.owner_id.label('owner_id'), Feedback.rating.label('rating'))
+        .join(Feedback, Feedback.booking_id == Booking.id)
+        .where(Booking.owner_id.in_(owner_ids)),
+        db.select(ArchivedFeedback.owner_id, ArchivedFeedback.rating)
+        .where(ArchivedFeedback.owner_id.in_(owner_ids))
+    ).subquery()
+    return db.select(
+        ratings.c.owner_id,
+        db.func.sum(ratings.c.rating),
+        db.func.count()
+    ).group_by(ratings.c.owner_id)
+
+
+def stats_from_rows(rows):
+    """Turn rows of rating_stats_statement() into {owner_id: (average_rating, rating_count)}"""
+    return {
+        owner_id: (round(float(total) / count, 1), count)
+        for owner_id, total, count in rows if count
+    }
+
+
+def owner_rating_stats(owner_ids):
+    """Return {owner_id: (average_rating, rating_count)} for owners with ratings
+
+    With region shards the feedback of every region is added up.
+    """
+    owner_ids = set(owner_ids)
+    if not owner_ids:
+        return {}
+    totals = {}
+    for owner_id, total, count in gather(
+        lambda: db.session.execute(rating_stats_statement(owner_ids)).all()
+    ):
+        previous_total, previous_count = totals.get(owner_id, (0, 0))
+        totals[owner_id] = (previous_total + total, previous_count + count)
+    return stats_from_rows((owner_id, total, count) for owner_id, (total, count) in totals.items())
@@ -0,0 +1,129 @@
+"""Removal of the image files of deleted parking spaces.
+
+Deleting a parking space leaves the deletion of its bookings, feedback and
+image rows to the database (ON DELETE CASCADE), so the request does not
+depend on how much history the space has. Just before that, the URLs of
+its images are copied into image_deletions by one INSERT ... SELECT, in
+the same transaction. The reaper removes exactly those files from
+UPLOAD_FOLDER, unless an image row refers to them again, and then drops
+them from the queue. Nothing else in UPLOAD_FOLDER is ever touched.
+
+The reaper runs every ORPHAN_REAP_INTERVAL seconds on a background thread
+when enabled (by default in production), in one process at a time, and
+is woken after a space is deleted. The reap-uploads command runs it once.
+"""
+import logging
+import os
+from datetime import datetime
+
+import click
+from flask import current_app
+from flask.cli import with_appcontext
+
+from models.models import ImageDeletion, ParkingImage, db
+from services.background import PeriodicWorker, try_lock
+from services.sharding import each_region
+from services.startup import PRODUCTION
+
+logger = logging.getLogger(__name__)
+
+LOCK = 'reaper.lock'
+
+# Queued deletions handled per transaction
+REAP_BATCH_SIZE = 500
+
+
+def init_app(app):
+    """Attach the orphan file reaper to the application"""
+    app.config.setdefault('ORPHAN_REAPER_ENABLED', app.config.get('STARTUP_MODE') == PRODUCTION)
+    app.config.setdefault('ORPHAN_REAP_INTERVAL', 3600.0)
+    app.cli.add_command(reap_uploads_command)
+    if not app.config['ORPHAN_REAPER_ENABLED']:
+        app.extensions['reaper'] = None
+        return
+
+    worker = PeriodicWorker('orphan-reaper', app.config['ORPHAN_REAP_INTERVAL'], lambda: _reap_once(app))
+    app.extensions['reaper'] = worker
+
+    @app.before_request
+    def start_reaper():
+        # Started on the first request so it runs in each forked worker
+        worker.start()
+
+
+def queue_image_files(space_id):
+    """Queue the files of a space's images for removal, before the space is deleted"""
+    db.session.execute(db.insert(ImageDeletion).from_select(
+        ['image_url', 'queued_at'],
+        db.select(ParkingImage.image_url, db.literal(datetime.utcnow(), db.DateTime))
+        .where(ParkingImage.parking_space_id == space_id)
+    ))
+
+
+def wake_reaper():
+    """Ask the reaper to run soon, e.g. after images were deleted"""
+    worker = current_app.extensions.get('reaper')
+    if worker is not None:
+        worker.wake()
+
+
+def _reap_once(app):
+    """Reap unless another process is already at it"""
+    os.makedirs(app.instance_path, exist_ok=True)
+    with try_lock(os.path.join(app.instance_path, LOCK)) as locked:
+        if locked:
+            with app.app_context():
+                removed = reap_deleted_images()
+            if removed:
+                logger.info('Removed %d files of deleted images', len(removed))
+
+
+def _file_name(image_url):
+    """Name of an image's file in UPLOAD_FOLDER, or None for a URL outside it"""
+    name = image_url.rsplit('/', 1)[-1]
+    if '/uploads/' not in image_url or not name or name.startswith('.') or '\\' in name:
+        return None
+    return name
+
+
+def reap_deleted_images(dry_run=False):
+    """Delete the files queued by deleted spaces and empty the queue; returns their names"""
+    folder = current_app.config['UPLOAD_FOLDER']
+    removed = []
+    for _ in each_region():
+        last_id = 0
+        while True:
+            queued = db.session.execute(
+                db.select(ImageDeletion.id, ImageDeletion.image_url)
+                .where(ImageDeletion.id > last_id).order_by(ImageDeletion.id).limit(REAP_BATCH_SIZE)
+            ).all()
+            if not queued:
+                break
+            last_id = queued[-1].id
+            urls = {row.image_url for row in queued}
+            # A file that an image refers to again stays
+            in_use = set(db.session.execute(
+                db.select(ParkingImage.image_url).where(ParkingImage.image_url.in_(urls))
+            ).scalars())
+            names = sorted({name for name in map(_file_name, urls - in_use) if name is not None})
+            if not dry_run:
+                for name in names:
+                    try:
+                        os.remove(os.path.join(folder, name))
+                    except FileNotFoundError:
+                        pass
+                db.session.execute(db.delete(ImageDeletion).where(ImageDeletion.id <= last_id))
+                db.session.commit()
+            removed.extend(names)
+    return removed
+
+
+@click.command('reap-uploads')
+@click.option('--dry-run', is_flag=True, help='Only list the files that would be removed.')
+@with_appcontext
+def reap_uploads_command(dry_run):
+    """Remove the image files of deleted parking spaces"""
+    removed = reap_deleted_images(dry_run=dry_run)
+    for name in removed:
+        click.echo(name)
+    click.echo(f"{'Would remove' if dry_run else 'Removed'} {len(removed)} files of deleted images.")
@@ -0,0 +1,278 @@
+"""Owner settlements: what each owner earned from completed bookings per month.
+
+The settle command reads the completed bookings of a month in id order
+from a server-side cursor, hot and archived bookings alike, and adds up
+total_price per owner as the rows go by. A booking belongs to the month in
+which it was completed (closed_at), so a month's bookings no longer change
+once it is over and only past months can be settled.
+
+Every SETTLEMENT_CHECKPOINT_ROWS bookings the running totals are added to
+the owners' settlement rows, the bookings counted are stored as statement
+lines and the id of the last one is stored in the month's settlement run,
+all in the same transaction. A run that fails part way resumes after that
+booking, so no booking is counted twice or skipped. Settling a month that
+is already complete does nothing; --restart settles it again from the
+start.
+
+Owners download a CSV statement of each settled month. It is built from
+the statement lines, so it keeps adding up to the settlement when bookings
+are later archived or deleted with their space.
+"""
+import csv
+import io
+from datetime import datetime
+
+import click
+from flask import current_app
+from flask.cli import with_appcontext
+
+from models.models import ArchivedBooking, Booking, ParkingSpace, Settlement, SettlementLine, SettlementRun, db
+from services.sharding import each_region, region_engine
+
+DEFAULT_CHECKPOINT_ROWS = 10000
+STREAM_BATCH_SIZE = 1000
+
+STATEMENT_COLUMNS = ['booking_id', 'parking_space', 'start_time', 'end_time', 'completed_at', 'total_price']
+
+
+class SettlementError(Exception):
+    """A period that cannot be settled, or a run that lost a race"""
+
+
+def init_app(app):
+    """Register the settlement command"""
+    app.config.setdefault('SETTLEMENT_CHECKPOINT_ROWS', DEFAULT_CHECKPOINT_ROWS)
+    app.cli.add_command(settle_command)
+
+
+def period_bounds(period):
+    """Return the [start, end) datetimes of a 'YYYY-MM' period"""
+    try:
+        start = datetime.strptime(period, '%Y-%m')
+    except (TypeError, ValueError):
+        raise SettlementError(f'Invalid period {period!r}, expected YYYY-MM')
+    end = datetime(start.year + start.month // 12, start.month % 12 + 1, 1)
+    return start, end
+
+
+def previous_period(now=None):
+    """Return the month before the current one as 'YYYY-MM'"""
+    now = now or datetime.utcnow()
+    year, month = (now.year, now.month - 1) if now.month > 1 else (now.year - 1, 12)
+    return f'{year:04d}-{month:02d}'
+
+
+def completed_bookings_statement(start, end, after_id=0, owner_id=None):
+    """Select the bookings completed in [start, end) by id, with their statement columns
+
+    Rows are (id, owner_id, total_price, space_title, start_time, end_time,
+    closed_at). Hot and archived bookings are read in one statement, so a
+    booking moved to the archive meanwhile is neither missed nor read twice.
+    """
+    selects = []
+    for model, title in ((Booking, ParkingSpace.title), (ArchivedBooking, ArchivedBooking.space_title)):
+        select = db.select(model.id, model.owner_id, model.total_price, title.label('space_title'),
+                           model.start_time, model.end_time, model.closed_at).where(
+            model.status == 'completed', model.closed_at >= start, model.closed_at < end,
+            model.id > after_id
+        )
+        if model is Booking:
+            select = select.outerjoin(ParkingSpace, ParkingSpace.id == Booking.parking_space_id)
+        if owner_id is not None:
+            select = select.where(model.owner_id == owner_id)
+        selects.append(select)
+    union = db.union_all(*selects).subquery()
+    return db.select(union).order_by(union.c.id)
+
+
+def settle_period(period, checkpoint_rows=None, restart=False, now=None):
+    """Settle a past period, resuming an unfinished run; returns the SettlementRun"""
+    start, end = period_bounds(period)
+    if end > (now or datetime.utcnow()):
+        raise SettlementError(f'Period {period} is not over yet')
+    if checkpoint_rows is None:
+        checkpoint_rows = current_app.config['SETTLEMENT_CHECKPOINT_ROWS']
+
+    run = _lock_run(period)
+    if run is None:
+        run = SettlementRun(period=period)
+        db.session.add(run)
+    elif run.status == 'complete' and not restart:
+        db.session.commit()
+        return run
+    elif restart:
+        db.session.execute(db.delete(Settlement).where(Settlement.period == period))
+        db.session.execute(db.delete(SettlementLine).where(SettlementLine.period == period))
+        run.last_booking_id = 0
+        run.booking_count = 0
+        run.started_at = datetime.utcnow()
+        run.finished_at = None
+    run.status = 'running'
+    db.session.commit()
+
+    # Stream on a connection of its own, the totals are saved through the session
+    totals = {}
+    lines = []
+    last_id = checkpoint = run.last_booking_id
+    with db.session.get_bind(mapper=Booking).connect() as connection:
+        rows = connection.execution_options(stream_results=True, yield_per=STREAM_BATCH_SIZE).execute(
+            completed_bookings_statement(start, end, after_id=checkpoint)
+        )
+        for booking_id, owner_id, total_price, space_title, start_time, end_time, closed_at in rows:
+            count, amount = totals.get(owner_id, (0, 0.0))
+            totals[owner_id] = (count + 1, amount + total_price)
+            lines.append({
+                'booking_id': booking_id, 'period': period, 'owner_id': owner_id,
+                'space_title': space_title, 'start_time': start_time, 'end_time': end_time,
+                'completed_at': closed_at, 'total_price': total_price,
+            })
+            last_id = booking_id
+            if len(lines) == checkpoint_rows:
+                _save_progress(period, checkpoint, last_id, lines, totals)
+                totals, lines, checkpoint = {}, [], last_id
+        rows.close()
+
+    return _save_progress(period, checkpoint, last_id, lines, totals, complete=True)
+
+
+def _lock_run(period):
+    return db.session.execute(
+        db.select(SettlementRun).where(SettlementRun.period == period)
+        .with_for_update().execution_options(populate_existing=True)
+    ).scalar_one_or_none()
+
+
+def _save_progress(period, checkpoint, last_id, lines, totals, complete=False):
+    """Add the totals and lines since the checkpoint and move the checkpoint, in one transaction"""
+    run = _lock_run(period)
+    if run is None or run.last_booking_id != checkpoint or run.status != 'running':
+        db.session.rollback()
+        raise SettlementError(f'Another run of {period} has made progress, stopping')
+
+    if totals:
+        settlements = {settlement.owner_id: settlement for settlement in db.session.execute(
+            db.select(Settlement)
+            .where(Settlement.period == period, Settlement.owner_id.in_(totals))
+            .with_for_update()
+        ).scalars()}
+        for owner_id, (count, amount) in totals.items():
+            settlement = settlements.get(owner_id)
+            if settlement is None:
+                settlement = Settlement(owner_id=owner_id, period=period, booking_count=0, gross_amount=0.0)
+                db.session.add(settlement)
+            settlement.booking_count += count
+            settlement.gross_amount = round(settlement.gross_amount + amount, 2)
+
+    if lines:
+        db.session.execute(db.insert(SettlementLine), lines)
+    run.last_booking_id = last_id
+    run.booking_count += len(lines)
+    if complete:
+        run.status = 'complete'
+        run.finished_at = datetime.utcnow()
+    db.session.commit()
+    return run
+
+
+def period_settlements(owner_id, period=None):
+    """Return [(region, settlement)] of an owner in every region, newest period first
+
+    With region shards each region is settled on its own, so an owner with
+    spaces in several regions has a settlement per region and period.
+    """
+    settlements = []
+    for region in each_region():
+        query = Settlement.query.filter_by(owner_id=owner_id)
+        if period is not None:
+            query = query.filter_by(period=period)
+        settlements.extend((region, settlement) for settlement in query)
+    settlements.sort(key=lambda pair: pair[1].period, reverse=True)
+    return settlements
+
+
+def owner_settlements(owner_id):
+    """Return the settled periods of an owner, newest first, adding up every region
+
+    Each is a dict with the period, booking_count and gross_amount.
+    """
+    periods = {}
+    for _, settlement in period_settlements(owner_id):
+        summary = periods.setdefault(settlement.period, {
+            'period': settlement.period, 'booking_count': 0, 'gross_amount': 0.0,
+        })
+        summary['booking_count'] += settlement.booking_count
+        summary['gross_amount'] = round(summary['gross_amount'] + settlement.gross_amount, 2)
+    return list(periods.values())
+
+
+def statement_csv(settlements):
+    """Yield the CSV statement of an owner's period line by line
+
+    settlements are the [(region, settlement)] of one owner and period, see
+    period_settlements(). A note is added when the lines do not add up to
+    the settlements, e.g. for a period settled before statement lines were
+    stored.
+    """
+    _, first = settlements[0]
+    owner_id, period = first.owner_id, first.period
+    booking_count = sum(settlement.booking_count for _, settlement in settlements)
+    gross_amount = round(sum(settlement.gross_amount for _, settlement in settlements), 2)
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+
+    def flush():
+        line = buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+        return line
+
+    writer.writerow(STATEMENT_COLUMNS)
+    yield flush()
+
+    count, amount = 0, 0.0
+    for region, _ in settlements:
+        # Streamed from the region's shard without selecting it, as this
+        # generator runs while the response is sent
+        lines = db.session.execute(
+            db.select(SettlementLine.booking_id, SettlementLine.space_title, SettlementLine.start_time,
+                      SettlementLine.end_time, SettlementLine.completed_at, SettlementLine.total_price)
+            .where(SettlementLine.owner_id == owner_id, SettlementLine.period == period)
+            .order_by(SettlementLine.booking_id).execution_options(yield_per=STREAM_BATCH_SIZE),
+            bind_arguments={'bind': region_engine(region)}
+        )
+        for booking_id, space_title, start_time, end_time, completed_at, total_price in lines:
+            writer.writerow([booking_id, space_title or '', start_time.isoformat(' '),
+                             end_time.isoformat(' '), completed_at.isoformat(' '), f'{total_price:.2f}'])
+            count += 1
+            amount += total_price
+            yield flush()
+
+    writer.writerow([])
+    writer.writerow(['period', period])
+    writer.writerow(['bookings', booking_count])
+    writer.writerow(['total', f'{gross_amount:.2f}'])
+    if count != booking_count or round(amount, 2) != gross_amount:
+        writer.writerow(['note', f'The lines above list {count} bookings for {amount:.2f}; '
+                                 'the period must be settled again to list them all'])
+    yield flush()
+
+
+@click.command('settle')
+@click.option('--period', default=None, help='Month to settle as YYYY-MM [default: the previous month].')
+@click.option('--checkpoint-rows', type=int, default=None,
+              help='Bookings counted per transaction [default: SETTLEMENT_CHECKPOINT_ROWS].')
+@click.option('--restart', is_flag=True, help='Settle the month again from the start.')
+@with_appcontext
+def settle_command(period, checkpoint_rows, restart):
+    """Add up what each owner earned from the bookings completed in a month"""
+    period = period or previous_period()
+    for region in each_region():
+        try:
+            run = settle_period(period, checkpoint_rows=checkpoint_rows, restart=restart)
+        except SettlementError as e:
+            raise click.ClickException(str(e))
+        owners = Settlement.query.filter_by(period=period).count()
+        where = f' in {region}' if region else ''
+        click.echo(f'Settled {run.booking_count} bookings of {period} for {owners} owners{where}.')
+        # Every shard has a run with the same period as its key
+        db.session.remove()
@@ -0,0 +1,278 @@
+"""Region sharding of parking spaces and everything that hangs off them.
+
+With SHARD_REGIONS configured, the tables in models.database.SHARDED_TABLES
+(spaces, images, bookings, feedback, their archive, sync counters and
+settlements) live in one database per region. Users and location pings stay
+in the default database. Each region is configured like this:
+
+    SHARD_REGIONS = {
+        'pune': {'index': 1, 'bbox': (18.40, 73.70, 18.70, 74.05), 'cities': ['pune']},
+        'mumbai': {'index': 2, 'bbox': (18.85, 72.75, 19.35, 73.10)},
+    }
+    SQLALCHEMY_BINDS = {'shard:pune': '...', 'shard:mumbai': '...'}
+
+A space belongs to the region whose bbox (south, west, north, east) holds
+its coordinates, else to the first region with one of its cities (default:
+the region name) in its address, else to SHARD_DEFAULT_REGION.
+
+Every request selects one region before the view runs. The region comes
+from the space or booking id in the URL, else an explicit ?region=, else
+the coordinates (near, bbox, latitude/longitude) or address of the request,
+else the region the user last chose, else SHARD_DEFAULT_REGION. The
+RoutingSession then sends every statement on a sharded table to that
+region's shard, and refuses them when no region is selected.
+
+Ids of sharded rows are allocated per shard as n * SHARD_ID_STRIDE + the
+region's index, so ids are unique across shards and name their region.
+Admin views, maintenance commands and the views of a user's own spaces,
+bookings and statements visit every shard with scatter() and gather(), and
+the owner ratings shown add up every shard. The rating scores the listing
+is sorted by and the delta sync feed are per region.
+
+Without SHARD_REGIONS everything is in the default database and nothing
+here has any effect.
+"""
+from contextlib import contextmanager
+
+import click
+from flask import abort, current_app, g, request, session
+from flask.cli import with_appcontext
+from sqlalchemy import inspect
+from sqlalchemy.orm import Session
+
+from models.database import SHARDED_TABLES, ShardingError, current_region, shard_bind_key
+from models.models import Booking, Feedback, ParkingImage, ParkingSpace, Settlement, db
+from services import sync
+from services.geo import parse_near
+
+DEFAULT_ID_STRIDE = 100
+
+# Models whose ids are allocated per shard; other sharded tables copy ids
+ALLOCATED_ID_MODELS = (ParkingSpace, ParkingImage, Booking, Feedback, Settlement)
+
+# URL parameters holding the id of a sharded row
+ID_VIEW_ARGS = ('space_id', 'booking_id')
+
+
+def init_app(app):
+    """Check the shard configuration and select a region for every request"""
+    app.config.setdefault('SHARD_REGIONS', {})
+    app.config.setdefault('SHARD_DEFAULT_REGION', next(iter(app.config['SHARD_REGIONS']), None))
+    app.config.setdefault('SHARD_ID_STRIDE', DEFAULT_ID_STRIDE)
+    app.cli.add_command(create_shards_command)
+    regions = app.config['SHARD_REGIONS']
+    if not regions:
+        return
+
+    stride = app.config['SHARD_ID_STRIDE']
+    binds = app.config.get('SQLALCHEMY_BINDS') or {}
+    indexes = {}
+    for name, region in regions.items():
+        if shard_bind_key(name) not in binds:
+            raise RuntimeError(f'SQLALCHEMY_BINDS has no {shard_bind_key(name)!r} for region {name!r}')
+        index = region.get('index')
+        if not isinstance(index, int) or not 0 < index < stride or index in indexes:
+            raise RuntimeError(f'Region {name!r} needs a unique index between 1 and {stride - 1}')
+        indexes[index] = name
+    if app.config['SHARD_DEFAULT_REGION'] not in regions:
+        raise RuntimeError('SHARD_DEFAULT_REGION must be one of SHARD_REGIONS')
+    # The snapshot is built from a single database
+    if app.config.setdefault('SNAPSHOT_ENABLED', False):
+        raise RuntimeError('SNAPSHOT_ENABLED cannot be used with SHARD_REGIONS')
+    app.extensions['shard_indexes'] = indexes
+
+    @app.before_request
+    def select_region():
+        g.region_token = current_region.set(request_region())
+
+    @app.teardown_request
+    def reset_region(exc=None):
+        token = g.pop('region_token', None)
+        if token is not None:
+            current_region.reset(token)
+
+    @app.context_processor
+    def region_context():
+        return {'shard_regions': list(regions), 'current_region': current_region.get()}
+
+
+def is_sharded():
+    """Whether regions are configured"""
+    return bool(current_app.config['SHARD_REGIONS'])
+
+
+def regions():
+    """Return the names of the configured regions"""
+    return list(current_app.config['SHARD_REGIONS'])
+
+
+def region_for(latitude=None, longitude=None, address=None):
+    """Return the region of a location, or None when not sharded"""
+    config = current_app.config
+    if not config['SHARD_REGIONS']:
+        return None
+    if latitude is not None and longitude is not None:
+        for name, region in config['SHARD_REGIONS'].items():
+            south, west, north, east = region['bbox']
+            if south <= latitude <= north and west <= longitude <= east:
+                return name
+    if address:
+        address = address.lower()
+        for name, region in config['SHARD_REGIONS'].items():
+            if any(city.lower() in address for city in region.get('cities', (name,))):
+                return name
+    return config['SHARD_DEFAULT_REGION']
+
+
+def region_of_id(row_id):
+    """Return the region a sharded row id was allocated in, or None"""
+    if not is_sharded():
+        return None
+    return current_app.extensions['shard_indexes'].get(row_id % current_app.config['SHARD_ID_STRIDE'])
+
+
+def request_region():
+    """Pick the region of the current request"""
+    for arg in ID_VIEW_ARGS:
+        if request.view_args and arg in request.view_args:
+            region = region_of_id(request.view_args[arg])
+            if region is None:
+                abort(404)
+            return region
+
+    chosen = request.args.get('region')
+    if chosen in current_app.config['SHARD_REGIONS']:
+        session['region'] = chosen
+        return chosen
+
+    latitude = longitude = None
+    try:
+        if request.args.get('near'):
+            latitude, longitude = parse_near(request.args['near'])
+        elif request.args.get('bbox'):
+            south, west, north, east = (float(part) for part in request.args['bbox'].split(','))
+            latitude, longitude = (south + north) / 2, (west + east) / 2
+        elif request.method == 'POST':
+            # Spaces are located by their form's coordinates; 0 means none given
+            latitude = request.form.get('latitude', type=float) or None
+            longitude = request.form.get('longitude', type=float) or None
+    except ValueError:
+        pass  # The view reports invalid parameters
+    address = request.form.get('address') if request.method == 'POST' else None
+    if (latitude is not None and longitude is not None) or address:
+        return region_for(latitude, longitude, address)
+
+    if session.get('region') in current_app.config['SHARD_REGIONS']:
+        return session['region']
+    return current_app.config['SHARD_DEFAULT_REGION']
+
+
+@contextmanager
+def use_region(region):
+    """Select a region for the statements in the block"""
+    token = current_region.set(region)
+    try:
+        yield region
+    finally:
+        current_region.reset(token)
+
+
+def each_region():
+    """Yield every region with it selected; yields None once when not sharded"""
+    if not is_sharded():
+        yield None
+        return
+    for region in regions():
+        with use_region(region):
+            yield region
+
+
+def scatter(query):
+    """Call query() in every region and return the results in region order"""
+    return [query() for _ in each_region()]
+
+
+def gather(query):
+    """Call query() in every region and concatenate the lists it returns"""
+    return [item for result in scatter(query) for item in result]
+
+
+def region_engine(region):
+    """Return the engine of a region's shard, or None when region is None
+
+    Statements executed with bind_arguments={'bind': region_engine(region)}
+    read that shard without selecting its region, e.g. while streaming.
+    """
+    return db.engines[shard_bind_key(region)] if region is not None else None
+
+
+def same_region(row_id, latitude, longitude, address):
+    """Whether a location is in the region a row id was allocated in"""
+    return region_of_id(row_id) == region_for(latitude, longitude, address)
+
+
+def allocate_ids(model, count):
+    """Reserve count ids for new rows of a model in the current region's shard
+
+    Returns None when not sharded, leaving ids to the database.
+    """
+    region = current_region.get()
+    if region is None or not count:
+        return None
+    connection = db.session.connection(bind_arguments={'mapper': model})
+    first = sync.allocate(connection, f'ids:{model.__tablename__}', count)
+    stride = current_app.config['SHARD_ID_STRIDE']
+    index = current_app.config['SHARD_REGIONS'][region]['index']
+    return [(first + i) * stride + index for i in range(count)]
+
+
+@db.event.listens_for(Session, 'before_flush')
+def _allocate_shard_ids(session, flush_context, instances):
+    """Give new sharded rows ids of their shard and keep spaces in their region"""
+    region = current_region.get()
+    if region is None:
+        return
+    for obj in list(session.new) + list(session.dirty):
+        if not isinstance(obj, ParkingSpace):
+            continue
+        state = inspect(obj)
+        moved = state.pending or any(state.attrs[key].history.has_changes()
+                                     for key in ('latitude', 'longitude', 'address'))
+        if moved and region_for(obj.latitude, obj.longitude, obj.address) != region:
+            raise ShardingError(f'Parking space {obj.title!r} is not in region {region!r}')
+    for model in ALLOCATED_ID_MODELS:
+        new = [obj for obj in session.new if isinstance(obj, model) and obj.id is None]
+        ids = allocate_ids(model, len(new))
+        for obj, obj_id in zip(new, ids or ()):
+            obj.id = obj_id
+
+
+def shard_metadata():
+    """Copy the sharded tables without their foreign keys to tables outside the shard"""
+    metadata = db.MetaData()
+    for name in sorted(SHARDED_TABLES):
+        table = db.metadata.tables[name].to_metadata(metadata)
+        for constraint in list(table.foreign_key_constraints):
+            if constraint.elements[0].target_fullname.split('.')[0] not in SHARDED_TABLES:
+                table.constraints.discard(constraint)
+                for key in constraint.elements:
+                    key.parent.foreign_keys.discard(key)
+                    table.foreign_keys.discard(key)
+    return metadata
+
+
+def create_shard_tables():
+    """Create the sharded tables in every region's shard"""
+    metadata = shard_metadata()
+    for region in regions():
+        metadata.create_all(db.engines[shard_bind_key(region)])
+
+
+@click.command('create-shards')
+@with_appcontext
+def create_shards_command():
+    """Create the parking space tables in the database of every region"""
+    if not is_sharded():
+        raise click.ClickException('SHARD_REGIONS is not configured.')
+    create_shard_tables()
+    click.echo(f"Created the tables of {len(regions())} shards.")
@@ -0,0 +1,345 @@
+"""Shared read-only snapshot of the active parking spaces.
+
+One process at a time rebuilds the snapshot every SNAPSHOT_REBUILD_INTERVAL
+seconds. Every process maps the newest snapshot file read-only, so all
+workers share one copy of the data through the page cache. Columns are
+read as numpy arrays straight from the mapping, and searches filter and
+rank them in memory. Only the few spaces finally shown are then loaded
+from the database. The map and the full spaces listing are served from
+the snapshot alone, with the snapshot's sync cursor, so clients pick up
+later changes through delta sync.
+
+Files in SNAPSHOT_DIR:
+
+    spaces-<generation>.snap  immutable snapshot generations
+    CURRENT                   name of the newest generation, replaced atomically
+    rebuild.lock              held by the process that is rebuilding
+
+A generation file holds a header (magic, row count, build time, sync
+cursor) followed by one little-endian column per field, each padded to
+8 bytes. Text fields follow as row offsets into a UTF-8 blob. A new generation is written under a temporary name and renamed
+into place before CURRENT is switched to it. Readers therefore never see
+a partial file, and a mapped generation is never modified.
+"""
+import logging
+import math
+import mmap
+import os
+import struct
+import threading
+import time
+from collections import namedtuple
+
+from flask import current_app
+
+from models.models import ParkingSpace, User, db
+from services import sync
+from services.background import PeriodicWorker, try_lock
+from services.fragments import primary_image_urls
+from services.geo import bounding_box, nearest_spaces, rank_nearest, spaces_by_rank
+from services.ratings import owner_rating_stats
+from services.startup import PRODUCTION, lazy_import
+
+np = lazy_import('numpy')
+
+logger = logging.getLogger(__name__)
+
+MAGIC = b'SPSNAP02'
+HEADER = struct.Struct('<8sQdq')  # magic, row count, built at (unix time), sync cursor
+COLUMNS = (
+    ('id', '<i8'),
+    ('latitude', '<f8'),
+    ('longitude', '<f8'),
+    ('price_per_hour', '<f8'),
+    ('owner_rating', '<f8'),  # NaN for owners without ratings
+    ('owner_total_ratings', '<i4'),
+    ('change_seq', '<i8'),  # -1 for spaces never stamped
+)
+TEXT_COLUMNS = ('title', 'address', 'owner_username', 'primary_image_url')
+
+# A space of the snapshot, with what the map and the spaces listing show of it
+SnapshotSpace = namedtuple('SnapshotSpace', [field for field, _ in COLUMNS] + list(TEXT_COLUMNS))
+
+POINTER = 'CURRENT'
+LOCK = 'rebuild.lock'
+
+# Generations kept on disk; older ones are removed after a rebuild
+KEEP_GENERATIONS = 2
+
+# How often a request checks whether another process published a new generation
+RELOAD_CHECK_SECONDS = 1.0
+
+# Candidates ranked per requested result, so spaces changed since the build can be left out
+NEAREST_OVERFETCH = 2
+
+
+def init_app(app):
+    """Attach a snapshot store to the application when snapshots are enabled"""
+    app.config.setdefault('SNAPSHOT_ENABLED', app.config.get('STARTUP_MODE') == PRODUCTION)
+    app.config.setdefault('SNAPSHOT_DIR', os.path.join(app.instance_path, 'snapshots'))
+    app.config.setdefault('SNAPSHOT_REBUILD_INTERVAL', 30.0)
+    if not app.config['SNAPSHOT_ENABLED']:
+        app.extensions['snapshot'] = None
+        return
+    app.extensions['snapshot'] = SnapshotStore(
+        app.config['SNAPSHOT_DIR'],
+        app.config['SNAPSHOT_REBUILD_INTERVAL'],
+        builder=lambda: _build_columns(app)
+    )
+
+
+def get_snapshot():
+    """Return the newest snapshot, or None when disabled or not built yet"""
+    store = current_app.extensions.get('snapshot')
+    return store.get() if store is not None else None
+
+
+def _build_columns(app):
+    """Read the active spaces and their owners' ratings into column arrays"""
+    with app.app_context():
+        # Read the cursor first so the snapshot never claims changes it lacks
+        cursor = sync.current_cursor()
+        listed = (
+            ParkingSpace.is_active == True,
+            ParkingSpace.latitude.isnot(None),
+            ParkingSpace.longitude.isnot(None)
+        )
+        rows = db.session.query(
+            ParkingSpace.id, ParkingSpace.latitude, ParkingSpace.longitude,
+            ParkingSpace.price_per_hour, ParkingSpace.owner_id, ParkingSpace.change_seq,
+            ParkingSpace.title, ParkingSpace.address
+        ).filter(*listed).order_by(ParkingSpace.id).all()
+        owner_ids = {row.owner_id for row in rows}
+        usernames = dict(
+            db.session.query(User.id, User.username).filter(User.id.in_(owner_ids)).all()
+        ) if owner_ids else {}
+        ratings = owner_rating_stats(owner_ids)
+        images = primary_image_urls(db.select(ParkingSpace.id).where(*listed))
+
+    count = len(rows)
+    columns = {
+        'id': np.fromiter((row.id for row in rows), dtype=np.int64, count=count),
+        'latitude': np.fromiter((row.latitude for row in rows), dtype=np.float64, count=count),
+        'longitude': np.fromiter((row.longitude for row in rows), dtype=np.float64, count=count),
+        'price_per_hour': np.fromiter((row.price_per_hour for row in rows), dtype=np.float64, count=count),
+        'owner_rating': np.fromiter((ratings.get(row.owner_id, (math.nan,))[0] for row in rows),
+                                    dtype=np.float64, count=count),
+        'owner_total_ratings': np.fromiter((ratings.get(row.owner_id, (None, 0))[1] for row in rows),
+                                           dtype=np.int32, count=count),
+        'change_seq': np.fromiter((-1 if row.change_seq is None else row.change_seq for row in rows),
+                                  dtype=np.int64, count=count),
+        'title': [row.title for row in rows],
+        'address': [row.address for row in rows],
+        'owner_username': [usernames.get(row.owner_id) for row in rows],
+        'primary_image_url': [images.get(row.id) for row in rows],
+    }
+    return columns, cursor
+
+
+def _write_padded(f, data):
+    f.write(data)
+    f.write(b'\0' * (-len(data) % 8))
+
+
+def write_snapshot(directory, columns, cursor):
+    """Write a new generation file and publish it; returns its file name"""
+    count = len(columns['id'])
+    name = f'spaces-{time.time_ns():020d}.snap'
+    path = os.path.join(directory, name)
+    with open(path + '.tmp', 'wb') as f:
+        f.write(HEADER.pack(MAGIC, count, time.time(), cursor))
+        for field, dtype in COLUMNS:
+            _write_padded(f, np.ascontiguousarray(columns[field], dtype=dtype).tobytes())
+        for field in TEXT_COLUMNS:
+            # None is stored as an empty string
+            encoded = [(value or '').encode('utf-8') for value in columns[field]]
+            offsets = np.zeros(count + 1, dtype='<i8')
+            np.cumsum([len(value) for value in encoded], out=offsets[1:])
+            _write_padded(f, offsets.tobytes())
+            _write_padded(f, b''.join(encoded))
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(path + '.tmp', path)
+    _replace(os.path.join(directory, POINTER), name.encode('ascii'))
+    return name
+
+
+def _replace(path, data, attempts=5):
+    """Atomically replace a small file with new contents"""
+    with open(path + '.tmp', 'wb') as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    for attempt in range(attempts):
+        try:
+            os.replace(path + '.tmp', path)
+            return
+        except PermissionError:
+            # Windows refuses while a reader has the file open; retry shortly
+            if attempt == attempts - 1:
+                raise
+            time.sleep(0.05)
+
+
+def _read_pointer(directory):
+    try:
+        with open(os.path.join(directory, POINTER), 'rb') as f:
+            return f.read().decode('ascii').strip() or None
+    except (FileNotFoundError, PermissionError):
+        return None
+
+
+class Snapshot:
+    """A read-only mapping of one snapshot generation
+
+    Columns are numpy arrays backed directly by the mapped file.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as f:
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, self.count, self.built_at, self.cursor = HEADER.unpack_from(self._map, 0)
+        if magic != MAGIC:
+            raise ValueError(f'{path} is not a parking space snapshot')
+        offset = HEADER.size
+        for field, dtype in COLUMNS:
+            column = np.frombuffer(self._map, dtype=dtype, count=self.count, offset=offset)
+            setattr(self, field, column)
+            offset += column.nbytes + (-column.nbytes % 8)
+        self._text = {}  # field -> (row offsets, start of the blob)
+        for field in TEXT_COLUMNS:
+            offsets = np.frombuffer(self._map, dtype='<i8', count=self.count + 1, offset=offset)
+            offset += offsets.nbytes
+            self._text[field] = (offsets, offset)
+            offset += int(offsets[-1]) + (-int(offsets[-1]) % 8)
+
+    def __len__(self):
+        return self.count
+
+    def text(self, field):
+        """Return a text column as a list of str, None where empty"""
+        offsets, start = self._text[field]
+        blob = self._map[start:start + int(offsets[-1])]
+        bounds = offsets.tolist()
+        return [blob[begin:end].decode('utf-8') or None for begin, end in zip(bounds, bounds[1:])]
+
+    def spaces(self):
+        """Return every space of the snapshot as a SnapshotSpace, in id order"""
+        columns = [getattr(self, field).tolist() for field, _ in COLUMNS]
+        columns += [self.text(field) for field in TEXT_COLUMNS]
+        spaces = []
+        for values in zip(*columns):
+            space = SnapshotSpace(*values)
+            spaces.append(space._replace(
+                owner_rating=None if math.isnan(space.owner_rating) else space.owner_rating,
+                change_seq=None if space.change_seq < 0 else space.change_seq,
+            ))
+        return spaces
+
+    def nearest(self, latitude, longitude, k, max_km, min_price=None, max_price=None):
+        """Return (ids, distances) of the k nearest spaces within max_km, closest first"""
+        south, west, north, east = bounding_box(latitude, longitude, max_km)
+        mask = (self.latitude >= south) & (self.latitude <= north)
+        if west >= -180 and east <= 180:
+            mask &= (self.longitude >= west) & (self.longitude <= east)
+        if min_price is not None:
+            mask &= self.price_per_hour >= min_price
+        if max_price is not None:
+            mask &= self.price_per_hour <= max_price
+        rows = np.flatnonzero(mask)
+        return rank_nearest(latitude, longitude, self.id[rows],
+                            self.latitude[rows], self.longitude[rows], k, max_km)
+
+
+class SnapshotStore:
+    """Keeps the newest snapshot generation mapped and rebuilds it when due"""
+
+    def __init__(self, directory, rebuild_interval=30.0, builder=None):
+        self.directory = directory
+        self.rebuild_interval = rebuild_interval
+        self.builder = builder
+        self._current = None
+        self._current_name = None
+        self._checked_at = 0.0
+        self._lock = threading.Lock()
+        self._worker = PeriodicWorker('snapshot-refresher', rebuild_interval, self.refresh)
+
+    def get(self):
+        """Return the newest published snapshot, or None before the first one"""
+        self._worker.start()
+        now = time.monotonic()
+        if now - self._checked_at >= RELOAD_CHECK_SECONDS:
+            self._checked_at = now
+            self.reload()
+        if self._current is None:
+            self._worker.wake()
+        return self._current
+
+    def reload(self):
+        """Map the newest generation if another one was published"""
+        name = _read_pointer(self.directory)
+        if name is None or name == self._current_name:
+            return
+        try:
+            snapshot = Snapshot(os.path.join(self.directory, name))
+        except (OSError, ValueError):
+            logger.exception('Failed to map snapshot %s', name)
+            return
+        with self._lock:
+            # Arrays of the previous generation keep its mapping alive while in use
+            self._current, self._current_name = snapshot, name
+
+    def is_due(self):
+        try:
+            age = time.time() - os.stat(os.path.join(self.directory, POINTER)).st_mtime
+        except FileNotFoundError:
+            return True
+        return age >= self.rebuild_interval
+
+    def refresh(self):
+        """Rebuild the snapshot if it is due and no other process is at it, then map the newest"""
+        os.makedirs(self.directory, exist_ok=True)
+        if self.is_due():
+            with try_lock(os.path.join(self.directory, LOCK)) as locked:
+                if locked and self.is_due():
+                    self.rebuild()
+        self.reload()
+
+    def rebuild(self):
+        """Build and publish a new generation, then remove old ones"""
+        os.makedirs(self.directory, exist_ok=True)
+        columns, cursor = self.builder()
+        name = write_snapshot(self.directory, columns, cursor)
+        generations = sorted(entry for entry in os.listdir(self.directory)
+                             if entry.startswith('spaces-') and entry.endswith('.snap'))
+        for old in generations[:-KEEP_GENERATIONS]:
+            try:
+                os.remove(os.path.join(self.directory, old))
+            except OSError:
+                pass  # Still mapped on Windows; removed after a later rebuild
+        return name
+
+    def stop(self):
+        self._worker.stop()
+
+
+def snapshot_nearest(snapshot, latitude, longitude, k, max_km, min_price=None, max_price=None):
+    """Return [(space, distance_km)] ranked from the snapshot
+
+    The ranked spaces are loaded by id and checked again, so spaces that
+    were deactivated or repriced since the snapshot was built are left out.
+    More candidates than k are ranked to make up for them; when too many
+    were left out the database search answers instead.
+    """
+    ids, distances = snapshot.nearest(latitude, longitude, k * NEAREST_OVERFETCH, max_km,
+                                      min_price, max_price)
+    price_filters = []
+    if min_price is not None:
+        price_filters.append(ParkingSpace.price_per_hour >= min_price)
+    if max_price is not None:
+        price_filters.append(ParkingSpace.price_per_hour <= max_price)
+    nearest = spaces_by_rank(ids, distances, [ParkingSpace.is_active == True, *price_filters])
+    if len(nearest) < min(k, len(ids)):
+        return nearest_spaces(latitude, longitude, k=k, max_km=max_km, filters=price_filters)
+    return nearest[:k]
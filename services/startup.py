@@ -0,0 +1,73 @@
+"""Startup modes, deferred imports and startup timings.
+
+In the default development mode create_app() creates the tables and the
+upload folder, as it always has. In production mode (STARTUP_MODE or the
+SMART_PARK_STARTUP_MODE environment variable set to 'production') the
+schema is left to init_db.py and no DDL or schema reflection runs while
+workers start.
+
+Heavy modules such as numpy are imported lazily so commands and tests that
+never compute prices or distances do not pay for them. A server that loads
+the application once before forking workers calls warm_up() to import them
+in the master, where the forked workers share them copy-on-write.
+"""
+import importlib
+import importlib.util
+import logging
+import sys
+import time
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+DEVELOPMENT = 'development'
+PRODUCTION = 'production'
+
+# Modules imported lazily by the services and loaded up front by warm_up()
+HEAVY_MODULES = ('numpy',)
+
+
+def lazy_import(name):
+    """Return a module that is only executed when one of its attributes is used"""
+    module = sys.modules.get(name)
+    if module is not None:
+        return module
+    spec = importlib.util.find_spec(name)
+    if spec is None:
+        raise ImportError(f'No module named {name!r}', name=name)
+    loader = importlib.util.LazyLoader(spec.loader)
+    spec.loader = loader
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    loader.exec_module(module)
+    return module
+
+
+def warm_up(app):
+    """Load the lazily imported modules now, e.g. in a preloading master process"""
+    timer = app.extensions['startup']
+    with timer.phase('warm_up'):
+        for name in HEAVY_MODULES:
+            # Any attribute access finishes loading a lazy module
+            getattr(importlib.import_module(name), '__file__', None)
+
+
+class StartupTimer:
+    """Records how long each phase of application startup took"""
+
+    def __init__(self, mode):
+        self.mode = mode
+        self.timings = {}
+
+    @contextmanager
+    def phase(self, name):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.timings[name] = self.timings.get(name, 0.0) + time.perf_counter() - started
+
+    def report(self):
+        """Return the timings as one log line, in milliseconds"""
+        phases = ', '.join(f'{name}={seconds * 1000:.1f}ms' for name, seconds in self.timings.items())
+        return f'{self.mode} startup: {phases}'
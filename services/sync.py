@@ -0,0 +1,150 @@
+"""Delta sync of parking spaces.
+
+Every write to a parking space takes the next value of the 'parking_spaces'
+counter as its change_seq, and every delete leaves a tombstone with one.
+The counter row stays locked until the writing transaction commits, so
+sequence numbers become visible in order and a client that remembers the
+highest one it has seen can ask for everything after it.
+"""
+from datetime import datetime, timedelta
+
+import click
+from flask.cli import with_appcontext
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import Session
+
+from models.models import ParkingSpace, SpaceTombstone, SyncCounter, db
+from services import sharding
+
+FEED = 'parking_spaces'
+
+# Highest change_seq whose tombstones have been pruned
+PRUNED_FEED = 'parking_spaces_pruned'
+
+DEFAULT_PAGE_SIZE = 500
+MAX_PAGE_SIZE = 5000
+
+
+class CursorExpired(Exception):
+    """The cursor is older than the pruned tombstones; a full reload is needed"""
+
+
+def init_app(app):
+    """Register the sync maintenance commands"""
+    app.cli.add_command(prune_tombstones_command)
+
+
+def _counter_value(connection, name, for_update=False):
+    query = db.select(SyncCounter.value).where(SyncCounter.name == name)
+    if for_update:
+        query = query.with_for_update()
+    return connection.execute(query).scalar()
+
+
+def _lock_counter(connection, name):
+    """Lock a counter row, creating it if needed, and return its value"""
+    current = _counter_value(connection, name, for_update=True)
+    if current is None:
+        try:
+            with connection.begin_nested():
+                connection.execute(db.insert(SyncCounter).values(name=name, value=0))
+        except IntegrityError:
+            pass  # Created concurrently
+        current = _counter_value(connection, name, for_update=True)
+    return current
+
+
+def allocate(connection, name, count):
+    """Reserve count consecutive values of a counter and return the first
+
+    The counter row stays locked until the surrounding transaction ends.
+    """
+    current = _lock_counter(connection, name)
+    connection.execute(
+        db.update(SyncCounter).where(SyncCounter.name == name).values(value=current + count)
+    )
+    return current + 1
+
+
+def current_cursor():
+    """Return the newest committed change_seq"""
+    return _counter_value(db.session.connection(), FEED) or 0
+
+
+@db.event.listens_for(Session, 'before_flush')
+def _stamp_changes(session, flush_context, instances):
+    """Give every written parking space a change_seq and tombstone deletions"""
+    changed = [obj for obj in session.new if isinstance(obj, ParkingSpace)]
+    changed += [obj for obj in session.dirty
+                if isinstance(obj, ParkingSpace) and session.is_modified(obj, include_collections=False)]
+    deleted = [obj for obj in session.deleted if isinstance(obj, ParkingSpace)]
+    if not changed and not deleted:
+        return
+
+    seq = allocate(session.connection(), FEED, len(changed) + len(deleted))
+    now = datetime.utcnow()
+    for space in changed:
+        space.change_seq = seq
+        space.updated_at = now
+        seq += 1
+    for space in deleted:
+        session.merge(SpaceTombstone(space_id=space.id, change_seq=seq, deleted_at=now))
+        seq += 1
+
+
+def changes_since(cursor, limit=DEFAULT_PAGE_SIZE):
+    """Return (spaces, deleted_ids, next_cursor, has_more) after a cursor
+
+    Spaces are the changed rows in change order. Deleted ids come from
+    tombstones; changed spaces that are no longer listed (inactive or
+    without coordinates) are reported by the caller as deletions too.
+    """
+    pruned = _counter_value(db.session.connection(), PRUNED_FEED) or 0
+    if cursor < pruned:
+        raise CursorExpired()
+
+    spaces = ParkingSpace.query.filter(ParkingSpace.change_seq > cursor) \
+        .order_by(ParkingSpace.change_seq).limit(limit + 1).all()
+    tombstones = SpaceTombstone.query.filter(SpaceTombstone.change_seq > cursor) \
+        .order_by(SpaceTombstone.change_seq).limit(limit + 1).all()
+
+    changes = sorted(
+        [(space.change_seq, space) for space in spaces] +
+        [(tombstone.change_seq, tombstone) for tombstone in tombstones],
+        key=lambda change: change[0]
+    )
+    has_more = len(changes) > limit
+    changes = changes[:limit]
+
+    next_cursor = changes[-1][0] if changes else max(cursor, current_cursor())
+    changed_spaces = [obj for _, obj in changes if isinstance(obj, ParkingSpace)]
+    deleted_ids = [obj.space_id for _, obj in changes if isinstance(obj, SpaceTombstone)]
+    return changed_spaces, deleted_ids, next_cursor, has_more
+
+
+def prune_tombstones(older_than_days):
+    """Delete old tombstones; cursors from before them must reload everything"""
+    cutoff = datetime.utcnow() - timedelta(days=older_than_days)
+    newest = db.session.query(db.func.max(SpaceTombstone.change_seq)) \
+        .filter(SpaceTombstone.deleted_at < cutoff).scalar()
+    if newest is None:
+        return 0
+
+    connection = db.session.connection()
+    if newest > _lock_counter(connection, PRUNED_FEED):
+        connection.execute(
+            db.update(SyncCounter).where(SyncCounter.name == PRUNED_FEED).values(value=newest)
+        )
+    deleted = SpaceTombstone.query.filter(SpaceTombstone.change_seq <= newest) \
+        .delete(synchronize_session=False)
+    db.session.commit()
+    return deleted
+
+
+@click.command('prune-tombstones')
+@click.option('--days', default=30, show_default=True, help='Keep tombstones younger than this.')
+@with_appcontext
+def prune_tombstones_command(days):
+    """Delete parking space tombstones older than the given number of days"""
+    pruned = sum(prune_tombstones(days) for _ in sharding.each_region())
+    click.echo(f'Pruned {pruned} tombstones.')
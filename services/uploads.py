@@ -0,0 +1,352 @@
+"""Chunked, resumable image uploads.
+
+A client first creates an upload with the file's name and size, then
+sends the bytes in chunks, each at the offset the server has reached so
+far. After a network failure it asks for that offset and continues from
+there. Chunks are written straight to a partial file on disk while the
+SHA-256 of the data is updated, so an upload never sits in memory and
+never holds a database transaction. Completing an upload checks its size,
+hash and image type and moves it into UPLOAD_FOLDER. Completed uploads
+are then attached to a parking space in one short transaction.
+
+Files in UPLOAD_PARTIAL_DIR, per upload:
+
+    <id>.json  owner, file name, size, expected hash and state
+    <id>.part  the bytes received so far
+    <id>.lock  held while a chunk is written
+
+The hash of the bytes received so far is kept in memory between chunks.
+When another worker or a restarted process receives the next chunk, it
+hashes the partial file again first.
+"""
+import hashlib
+import json
+import os
+import re
+import shutil
+import threading
+import time
+import uuid
+from collections import OrderedDict
+
+from flask import current_app, url_for
+from werkzeug.utils import secure_filename
+
+from models.models import ParkingImage, db
+from services.background import try_lock
+
+ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg', 'gif'}
+
+# Leading bytes of each allowed image type
+SIGNATURES = {
+    'png': (b'\x89PNG\r\n\x1a\n',),
+    'jpg': (b'\xff\xd8\xff',),
+    'jpeg': (b'\xff\xd8\xff',),
+    'gif': (b'GIF87a', b'GIF89a'),
+}
+
+BLOCK_SIZE = 64 * 1024
+
+# Hashers of uploads in progress kept in memory
+MAX_HASHERS = 1000
+
+UPLOAD_ID = re.compile(r'^[0-9a-f]{32}$')
+
+PARTIAL = 'partial'
+COMPLETE = 'complete'
+
+
+class UploadError(Exception):
+    """A request the upload cannot accept; status is the HTTP status to answer with"""
+
+    def __init__(self, message, status=400, offset=None):
+        super().__init__(message)
+        self.status = status
+        self.offset = offset
+
+
+def init_app(app):
+    """Attach an upload store to the application"""
+    app.config.setdefault('UPLOAD_PARTIAL_DIR', os.path.join(app.instance_path, 'uploads'))
+    app.config.setdefault('UPLOAD_MAX_FILE_SIZE', 16 * 1024 * 1024)
+    app.config.setdefault('UPLOAD_CHUNK_SIZE', 1024 * 1024)
+    app.config.setdefault('UPLOAD_EXPIRE_SECONDS', 24 * 3600)
+    app.extensions['uploads'] = UploadStore(
+        app.config['UPLOAD_PARTIAL_DIR'],
+        max_size=app.config['UPLOAD_MAX_FILE_SIZE'],
+        chunk_size=app.config['UPLOAD_CHUNK_SIZE'],
+        expire_seconds=app.config['UPLOAD_EXPIRE_SECONDS']
+    )
+
+
+def get_upload_store():
+    """Return the upload store of the current application"""
+    return current_app.extensions['uploads']
+
+
+def allowed_file(filename):
+    return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
+
+
+def parse_upload_ids(value):
+    """Split a comma-separated list of upload ids, ignoring anything else"""
+    return [part for part in (value or '').split(',') if UPLOAD_ID.match(part.strip())]
+
+
+class UploadStore:
+    """Partial and completed uploads in a directory"""
+
+    def __init__(self, directory, max_size=16 * 1024 * 1024, chunk_size=1024 * 1024, expire_seconds=86400):
+        self.directory = directory
+        self.max_size = max_size
+        self.chunk_size = chunk_size
+        self.expire_seconds = expire_seconds
+        self._hashers = OrderedDict()  # upload id -> (offset, sha256 object)
+        self._lock = threading.Lock()
+
+    def _path(self, upload_id, suffix):
+        if not UPLOAD_ID.match(upload_id):
+            raise UploadError('Upload not found', 404)
+        return os.path.join(self.directory, upload_id + suffix)
+
+    def _read_meta(self, upload_id, owner_id):
+        try:
+            with open(self._path(upload_id, '.json')) as f:
+                meta = json.load(f)
+        except FileNotFoundError:
+            raise UploadError('Upload not found', 404)
+        if meta['owner_id'] != owner_id:
+            raise UploadError('Upload not found', 404)
+        return meta
+
+    def _write_meta(self, upload_id, meta):
+        path = self._path(upload_id, '.json')
+        with open(path + '.tmp', 'w') as f:
+            json.dump(meta, f)
+        os.replace(path + '.tmp', path)
+
+    def _offset(self, upload_id):
+        try:
+            return os.path.getsize(self._path(upload_id, '.part'))
+        except FileNotFoundError:
+            return 0
+
+    def create(self, owner_id, filename, size, sha256=None):
+        """Start an upload and return its status"""
+        if not filename or not allowed_file(filename):
+            raise UploadError('Only JPG, PNG and GIF images can be uploaded')
+        if not isinstance(size, int) or size <= 0:
+            raise UploadError('size must be a positive number of bytes')
+        if size > self.max_size:
+            raise UploadError(f'Images can be at most {self.max_size} bytes', 413)
+        if sha256 is not None and not re.match(r'^[0-9a-f]{64}$', str(sha256)):
+            raise UploadError('sha256 must be 64 lowercase hex digits')
+
+        safe_name = secure_filename(filename)
+        if not allowed_file(safe_name):
+            safe_name = 'image.' + filename.rsplit('.', 1)[1].lower()
+
+        os.makedirs(self.directory, exist_ok=True)
+        self.prune()
+        upload_id = uuid.uuid4().hex
+        open(self._path(upload_id, '.part'), 'wb').close()
+        meta = {
+            'owner_id': owner_id,
+            'filename': safe_name,
+            'size': size,
+            'sha256': sha256,
+            'state': PARTIAL,
+            'created_at': time.time(),
+        }
+        self._write_meta(upload_id, meta)
+        return self.status(upload_id, owner_id)
+
+    def status(self, upload_id, owner_id):
+        """Return {id, offset, size, state, chunk_size} of an upload"""
+        meta = self._read_meta(upload_id, owner_id)
+        offset = meta['size'] if meta['state'] == COMPLETE else self._offset(upload_id)
+        return {'id': upload_id, 'offset': offset, 'size': meta['size'],
+                'state': meta['state'], 'chunk_size': self.chunk_size}
+
+    def _hasher(self, upload_id, offset):
+        """Return the SHA-256 of the first offset bytes, from memory or by reading them again"""
+        with self._lock:
+            cached = self._hashers.pop(upload_id, None)
+        if cached is not None and cached[0] == offset:
+            return cached[1]
+        hasher = hashlib.sha256()
+        with open(self._path(upload_id, '.part'), 'rb') as f:
+            remaining = offset
+            while remaining:
+                block = f.read(min(BLOCK_SIZE, remaining))
+                if not block:
+                    break
+                hasher.update(block)
+                remaining -= len(block)
+        return hasher
+
+    def _keep_hasher(self, upload_id, offset, hasher):
+        with self._lock:
+            self._hashers[upload_id] = (offset, hasher)
+            while len(self._hashers) > MAX_HASHERS:
+                self._hashers.popitem(last=False)
+
+    def append(self, upload_id, owner_id, offset, stream, length):
+        """Write a chunk of length bytes read from stream at offset; returns the new offset
+
+        The offset must be where the upload currently ends. Whatever part
+        of the chunk arrived before a failure is kept, so the client can
+        ask for the offset and resume.
+        """
+        meta = self._read_meta(upload_id, owner_id)
+        if meta['state'] != PARTIAL:
+            raise UploadError('Upload is already complete', 409, meta['size'])
+        if length is None:
+            raise UploadError('Content-Length is required', 411)
+        if length > self.chunk_size:
+            raise UploadError(f'Chunks can be at most {self.chunk_size} bytes', 413)
+
+        with try_lock(self._path(upload_id, '.lock')) as locked:
+            if not locked:
+                raise UploadError('Another chunk of this upload is being written', 409, self._offset(upload_id))
+            current = self._offset(upload_id)
+            if offset != current:
+                raise UploadError('Offset does not match the upload', 409, current)
+            if current + length > meta['size']:
+                raise UploadError('Chunk goes past the size of the upload', 413, current)
+
+            hasher = self._hasher(upload_id, current)
+            written = current
+            try:
+                with open(self._path(upload_id, '.part'), 'r+b') as f:
+                    f.seek(current)
+                    remaining = length
+                    while remaining:
+                        block = stream.read(min(BLOCK_SIZE, remaining))
+                        if not block:
+                            break
+                        f.write(block)
+                        hasher.update(block)
+                        written += len(block)
+                        remaining -= len(block)
+            finally:
+                # Only whole blocks count, so the hash matches the file after a failure
+                if os.path.getsize(self._path(upload_id, '.part')) != written:
+                    os.truncate(self._path(upload_id, '.part'), written)
+                self._keep_hasher(upload_id, written, hasher)
+        return written
+
+    def complete(self, upload_id, owner_id):
+        """Check a fully received upload and move it to UPLOAD_FOLDER; returns its status"""
+        meta = self._read_meta(upload_id, owner_id)
+        if meta['state'] == COMPLETE:
+            return dict(self.status(upload_id, owner_id), sha256=meta['sha256'], url=meta['url'])
+
+        with try_lock(self._path(upload_id, '.lock')) as locked:
+            if not locked:
+                raise UploadError('A chunk of this upload is still being written', 409, self._offset(upload_id))
+            offset = self._offset(upload_id)
+            if offset != meta['size']:
+                raise UploadError('Upload is not finished', 409, offset)
+            digest = self._hasher(upload_id, offset).hexdigest()
+            if meta['sha256'] is not None and meta['sha256'] != digest:
+                self.discard(upload_id, owner_id)
+                raise UploadError('Upload does not match its sha256, start again', 422)
+
+            extension = meta['filename'].rsplit('.', 1)[1].lower()
+            with open(self._path(upload_id, '.part'), 'rb') as f:
+                head = f.read(16)
+            if not head.startswith(SIGNATURES[extension]):
+                self.discard(upload_id, owner_id)
+                raise UploadError('File is not a valid image of its type', 415)
+
+            filename = f"{upload_id}_{meta['filename']}"
+            folder = current_app.config['UPLOAD_FOLDER']
+            os.makedirs(folder, exist_ok=True)
+            shutil.move(self._path(upload_id, '.part'), os.path.join(folder, filename))
+            meta.update(state=COMPLETE, sha256=digest,
+                        url=url_for('static', filename=f'uploads/{filename}'))
+            self._write_meta(upload_id, meta)
+        with self._lock:
+            self._hashers.pop(upload_id, None)
+        return dict(self.status(upload_id, owner_id), sha256=digest, url=meta['url'])
+
+    def completed_urls(self, upload_ids, owner_id):
+        """Return the image URLs of completed uploads of an owner, in order"""
+        urls = []
+        for upload_id in upload_ids:
+            meta = self._read_meta(upload_id, owner_id)
+            if meta['state'] != COMPLETE:
+                raise UploadError('Upload is not complete', 409)
+            urls.append(meta['url'])
+        return urls
+
+    def forget(self, upload_ids):
+        """Drop the records of uploads attached to a space; their images stay"""
+        for upload_id in upload_ids:
+            for suffix in ('.json', '.lock'):
+                try:
+                    os.remove(self._path(upload_id, suffix))
+                except FileNotFoundError:
+                    pass
+
+    def discard(self, upload_id, owner_id):
+        """Cancel an upload that was not attached and remove its data"""
+        meta = self._read_meta(upload_id, owner_id)
+        if meta['state'] == COMPLETE:
+            self._remove_image(meta['url'])
+        self._remove(upload_id)
+
+    def _remove(self, upload_id):
+        for suffix in ('.part', '.json', '.lock'):
+            try:
+                os.remove(self._path(upload_id, suffix))
+            except FileNotFoundError:
+                pass
+        with self._lock:
+            self._hashers.pop(upload_id, None)
+
+    def _remove_image(self, url):
+        filename = url.rsplit('/', 1)[-1]
+        try:
+            os.remove(os.path.join(current_app.config['UPLOAD_FOLDER'], filename))
+        except FileNotFoundError:
+            pass
+
+    def prune(self, now=None):
+        """Remove uploads that were never attached within expire_seconds"""
+        now = time.time() if now is None else now
+        try:
+            entries = os.listdir(self.directory)
+        except FileNotFoundError:
+            return
+        for entry in entries:
+            if not entry.endswith('.json'):
+                continue
+            upload_id = entry[:-5]
+            try:
+                with open(os.path.join(self.directory, entry)) as f:
+                    meta = json.load(f)
+            except (OSError, ValueError):
+                continue
+            if now - meta.get('created_at', now) > self.expire_seconds:
+                if meta.get('state') == COMPLETE:
+                    self._remove_image(meta['url'])
+                self._remove(upload_id)
+
+
+def attach_uploads(space, upload_ids):
+    """Add completed uploads of the space's owner to its images in one short transaction"""
+    store = get_upload_store()
+    urls = store.completed_urls(upload_ids, space.owner_id)
+    if not urls:
+        return []
+    has_primary = db.session.query(ParkingImage.id).filter_by(
+        parking_space_id=space.id, is_primary=True
+    ).first() is not None
+    images = [ParkingImage(image_url=url, is_primary=not has_primary and i == 0, parking_space_id=space.id)
+              for i, url in enumerate(urls)]
+    db.session.add_all(images)
+    db.session.commit()
+    store.forget(upload_ids)
+    return images
@@ -23,4 +23,124 @@ document.addEventListener('DOMContentLoaded', function() {
             }
         });
     });
-});
\ No newline at end of file
+});
+// Expand a ?format=compact spaces API payload into one object per space
+function decodeCompactSpaces(payload) {
+    const spaces = [];
+    for (let i = 0; i < payload.count; i++) {
+        const owner = payload.owner[i];
+        const space = {
+            id: payload.id[i],
+            title: payload.title[i],
+            address: payload.address[i],
+            latitude: payload.lat[i] === null ? null : payload.lat[i] / payload.coord_scale,
+            longitude: payload.lng[i] === null ? null : payload.lng[i] / payload.coord_scale,
+            price_per_hour: payload.price_per_hour[i],
+            owner_username: payload.owners.username[owner],
+            owner_rating: payload.owners.rating[owner],
+            owner_total_ratings: payload.owners.total_ratings[owner]
+        };
+        if (payload.distance_km) {
+            space.distance_km = payload.distance_km[i];
+        }
+        spaces.push(space);
+    }
+    return spaces;
+}
+
+// Upload one file in chunks, resuming from the server's offset after a failure
+async function uploadInChunks(createUrl, file, onProgress) {
+    let sha256 = null;
+    if (window.crypto && crypto.subtle) {
+        const digest = await crypto.subtle.digest('SHA-256', await file.arrayBuffer());
+        sha256 = Array.from(new Uint8Array(digest)).map(b => b.toString(16).padStart(2, '0')).join('');
+    }
+    let response = await fetch(createUrl, {
+        method: 'POST',
+        headers: {'Content-Type': 'application/json'},
+        body: JSON.stringify({filename: file.name, size: file.size, sha256: sha256})
+    });
+    let upload = await response.json();
+    if (!response.ok) {
+        throw new Error(upload.error);
+    }
+    const uploadUrl = createUrl + '/' + upload.id;
+
+    let failures = 0;
+    while (upload.offset < upload.size) {
+        try {
+            const chunk = file.slice(upload.offset, upload.offset + upload.chunk_size);
+            response = await fetch(uploadUrl, {
+                method: 'PATCH',
+                headers: {'Upload-Offset': String(upload.offset), 'Content-Type': 'application/offset+octet-stream'},
+                body: chunk
+            });
+            const result = await response.json();
+            if (response.ok) {
+                upload = result;
+                failures = 0;
+            } else if (result.offset !== undefined && response.status === 409) {
+                upload.offset = result.offset;
+            } else {
+                throw new Error(result.error);
+            }
+        } catch (e) {
+            if (++failures > 5) {
+                throw e;
+            }
+            // Wait, then continue from wherever the server got to
+            await new Promise(resolve => setTimeout(resolve, 1000 * failures));
+            response = await fetch(uploadUrl);
+            if (response.ok) {
+                upload = await response.json();
+            }
+        }
+        onProgress(upload.offset / upload.size);
+    }
+
+    response = await fetch(uploadUrl + '/complete', {method: 'POST'});
+    const completed = await response.json();
+    if (!response.ok) {
+        throw new Error(completed.error);
+    }
+    return completed.id;
+}
+
+// Forms with data-chunked-upload send their images in chunks before submitting
+document.addEventListener('DOMContentLoaded', function() {
+    document.querySelectorAll('form[data-chunked-upload]').forEach(form => {
+        const input = form.querySelector('input[type="file"]');
+        const ids = form.querySelector('input[name="upload_ids"]');
+        const progress = form.querySelector('[data-upload-progress]');
+        if (!input || !ids || !window.fetch) {
+            return;
+        }
+        form.addEventListener('submit', async function(e) {
+            if (!input.files.length) {
+                return;
+            }
+            e.preventDefault();
+            const files = Array.from(input.files);
+            const bar = progress && progress.querySelector('.progress-bar');
+            if (progress) {
+                progress.classList.remove('d-none');
+            }
+            try {
+                const uploaded = [];
+                for (let i = 0; i < files.length; i++) {
+                    uploaded.push(await uploadInChunks(form.dataset.chunkedUpload, files[i], function(done) {
+                        if (bar) {
+                            bar.style.width = ((i + done) / files.length * 100) + '%';
+                        }
+                    }));
+                }
+                ids.value = uploaded.join(',');
+                input.value = '';
+                // The form's submit button shadows form.submit
+                HTMLFormElement.prototype.submit.call(form);
+            } catch (error) {
+                alert('Error: Uploading the images failed. ' + error.message);
+            }
+        });
+    });
+});
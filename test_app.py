@@ -9,6 +9,16 @@ import os
 # Add the project directory to the Python path
 sys.path.insert(0, os.path.join(os.path.dirname(__file__), '.'))
 
+def create_test_app(**config):
+    """Create an app backed by an in-memory SQLite database"""
+    from app import create_app
+    return create_app({
+        'TESTING': True,
+        'SQLALCHEMY_DATABASE_URI': 'sqlite://',
+        'WTF_CSRF_ENABLED': False,
+        **config
+    })
+
 def test_imports():
     """Test that all modules can be imported"""
     try:
@@ -34,13 +44,1290 @@ def test_app_creation():
         print(f"✗ App creation failed: {e}")
         return False
 
+def test_price_grids():
+    """Test that busy hours are priced above quiet hours"""
+    try:
+        from services.pricing import compute_price_grids, SLOTS_PER_WEEK
+        # Two spaces in the same neighbourhood, the first booked every Monday 09:00-11:00
+        grids = compute_price_grids(
+            base_prices=[50.0, 40.0],
+            cell_ids=[1, 1],
+            booking_space_idx=[0] * 4,
+            booking_start_slots=[9] * 4,
+            booking_hours=[2] * 4,
+            weeks=4,
+            min_multiplier=0.5,
+        )
+        assert grids.shape == (2, SLOTS_PER_WEEK)
+        assert grids[0, 9] > grids[0, 12] > 0
+        assert grids[1, 9] > grids[1, 12]  # neighbourhood demand spills over
+        print("✓ Price grid computation successful")
+        return True
+    except Exception as e:
+        print(f"✗ Price grid computation failed: {e}")
+        return False
+
+def test_price_quotes():
+    """Test that quotes sum the hourly slots a booking covers and follow base price changes"""
+    try:
+        from datetime import datetime, time, timedelta
+        from models.models import db, User, ParkingSpace, Booking
+        from services.pricing import get_pricing_engine
+        app = create_test_app(PRICING_MIN_MULTIPLIER=0.5)
+        with app.app_context():
+            owner = User(username='owner', email='owner@example.com', password_hash='x')
+            db.session.add(owner)
+            db.session.flush()
+            # Neighbours within one pricing cell and a far away space
+            spaces = [ParkingSpace(title=f'Space {i}', address='A', price_per_hour=price, latitude=latitude,
+                                   longitude=73.8, owner_id=owner.id, availability_start=time(0),
+                                   availability_end=time(23, 59))
+                      for i, (price, latitude) in enumerate([(10.0, 18.501), (20.0, 18.502), (0.0, 19.5)])]
+            db.session.add_all(spaces)
+            db.session.flush()
+            # Monday 09:00-10:00 is booked every week of the lookback
+            monday = datetime.utcnow().replace(hour=9, minute=0, second=0, microsecond=0)
+            monday -= timedelta(days=monday.weekday())
+            db.session.add_all([Booking(start_time=monday - timedelta(weeks=week), total_price=10.0,
+                                        end_time=monday - timedelta(weeks=week) + timedelta(hours=1),
+                                        customer_id=owner.id, owner_id=owner.id, parking_space_id=spaces[0].id)
+                                for week in range(1, 8)])
+            db.session.commit()
+
+            engine = get_pricing_engine()
+            busy, quiet = monday + timedelta(weeks=1), monday + timedelta(weeks=1, hours=5)
+            busy_price = engine.quote(spaces[0], busy, busy + timedelta(hours=1))
+            quiet_price = engine.quote(spaces[0], quiet, quiet + timedelta(hours=1))
+            assert busy_price > 10.0 > quiet_price > 0
+            # Partial hours are charged pro rata, a window sums its slots
+            assert engine.quote(spaces[0], quiet, quiet + timedelta(minutes=30)) == round(quiet_price / 2, 2)
+            assert engine.quote(spaces[0], busy, quiet + timedelta(hours=1)) > 6 * quiet_price
+            # Demand spills over to the neighbour but not to the far away space
+            assert engine.quote(spaces[1], busy, busy + timedelta(hours=1)) > \
+                engine.quote(spaces[1], quiet, quiet + timedelta(hours=1))
+            assert engine.quote(spaces[2], busy, busy + timedelta(hours=1)) == 0.0
+
+            # Base price changes apply before the next rebuild, also from zero
+            spaces[0].price_per_hour = 20.0
+            spaces[2].price_per_hour = 5.0
+            assert engine.quote(spaces[0], quiet, quiet + timedelta(hours=1)) == round(quiet_price * 2, 2)
+            assert engine.quote(spaces[2], busy, busy + timedelta(hours=2)) == 10.0
+        print("✓ Price quotes successful")
+        return True
+    except Exception as e:
+        print(f"✗ Price quotes failed: {e!r}")
+        return False
+
+def test_recurring_bookings():
+    """Test that recurring bookings skip or reject dates that are taken"""
+    try:
+        from datetime import date, time, datetime
+        from models.models import db, User, ParkingSpace, Booking
+        from services.bookings import expand_occurrences, create_recurring_bookings, MAX_OCCURRENCES
+        app = create_test_app()
+        with app.app_context():
+            owner = User(username='owner', email='owner@example.com', password_hash='x')
+            customer = User(username='customer', email='customer@example.com', password_hash='x')
+            db.session.add_all([owner, customer])
+            db.session.flush()
+            space = ParkingSpace(title='Garage', address='Main Road', price_per_hour=20.0,
+                                 availability_start=time(6), availability_end=time(22), owner_id=owner.id)
+            db.session.add(space)
+            db.session.flush()
+            # Wednesday 2026-10-07 is already taken
+            db.session.add(Booking(start_time=datetime(2026, 10, 7, 8), end_time=datetime(2026, 10, 7, 10),
+                                   total_price=40.0, customer_id=customer.id, owner_id=owner.id,
+                                   parking_space_id=space.id))
+            db.session.commit()
+
+            # Mon/Wed/Fri for two weeks
+            occurrences = expand_occurrences(date(2026, 10, 5), date(2026, 10, 18), time(9), time(17), {0, 2, 4})
+            assert len(occurrences) == 6
+            # A range spanning decades stops just past the cap
+            assert len(expand_occurrences(date(2026, 1, 1), date(2076, 1, 1), time(9), time(17),
+                                          limit=MAX_OCCURRENCES + 1)) == MAX_OCCURRENCES + 1
+
+            results = create_recurring_bookings(space, customer.id, occurrences, all_or_nothing=True)
+            assert [r['status'] for r in results].count('conflict') == 1
+            assert Booking.query.count() == 1
+
+            results = create_recurring_bookings(space, customer.id, occurrences, all_or_nothing=False)
+            assert [r['status'] for r in results].count('booked') == 5
+            assert Booking.query.count() == 6
+            space_id, customer_id = space.id, customer.id
+
+        # A span is one booking across several days, refused when it overlaps
+        client = app.test_client()
+        with client.session_transaction() as session:
+            session['_user_id'] = str(customer_id)
+        form = {'pattern': 'span', 'start_time': '20:00', 'end_time': '08:00'}
+        response = client.post(f'/parking/space/{space_id}/book-recurring',
+                               data={**form, 'start_date': '2026-10-19', 'end_date': '2026-10-21'})
+        assert response.status_code == 302
+        response = client.post(f'/parking/space/{space_id}/book-recurring',
+                               data={**form, 'start_date': '2026-10-15', 'end_date': '2026-10-17'})
+        assert b'overlaps a booking' in response.data
+        response = client.post(f'/parking/space/{space_id}/book-recurring',
+                               data={'pattern': 'daily', 'start_time': '09:00', 'end_time': '17:00',
+                                     'start_date': '2026-10-19', 'end_date': '2076-10-19'})
+        assert f'at most {MAX_OCCURRENCES} dates'.encode() in response.data
+        with app.app_context():
+            span = Booking.query.filter(Booking.start_time == datetime(2026, 10, 19, 20)).one()
+            assert span.end_time == datetime(2026, 10, 21, 8) and Booking.query.count() == 7
+        print("✓ Recurring bookings successful")
+        return True
+    except Exception as e:
+        print(f"✗ Recurring bookings failed: {e}")
+        return False
+
+def test_nearest_ranking():
+    """Test that nearest spaces are ranked by great-circle distance"""
+    try:
+        from services.geo import rank_nearest, cells_within, cell_of
+        ids, distances = rank_nearest(18.5204, 73.8567, [1, 2, 3, 4],
+                                      [18.60, 18.5210, 18.53, 19.50],
+                                      [73.90, 73.8570, 73.86, 73.80],
+                                      k=2, max_km=50)
+        assert ids.tolist() == [2, 3]
+        assert distances[0] < distances[1] < 2
+        assert cell_of(18.53, 73.86) in cells_within(18.5204, 73.8567, 2)
+        print("✓ Nearest ranking successful")
+        return True
+    except Exception as e:
+        print(f"✗ Nearest ranking failed: {e}")
+        return False
+
+def test_location_buffer():
+    """Test that location pings are coalesced per user and flushed in one batch"""
+    try:
+        from services.locations import LocationBuffer
+        batches = []
+        buffer = LocationBuffer(max_users=2, flush_interval=60, writer=batches.append)
+        buffer.add(1, 18.50, 73.80)
+        buffer.add(1, 18.51, 73.81)
+        buffer.add(2, 18.60, 73.90)
+        buffer.add(3, 18.70, 74.00)  # evicts user 1, the oldest pending ping
+        assert len(buffer) == 2 and buffer.dropped == 1
+        assert buffer.flush() == 2
+        assert sorted(row['user_id'] for row in batches[0]) == [2, 3]
+        assert buffer.flush() == 0 and len(batches) == 1
+        buffer.shutdown()
+
+        # A failed batch goes back only as far as there is room
+        def failing(rows):
+            buffer.add(4, 18.80, 74.10)
+            buffer.add(5, 18.90, 74.20)
+            raise RuntimeError('database down')
+        buffer = LocationBuffer(max_users=2, flush_interval=60, writer=failing)
+        buffer.add(2, 18.60, 73.90)
+        buffer.add(3, 18.70, 74.00)
+        assert buffer.flush() == 0
+        assert len(buffer) == 2 and buffer.latest(2) is None and buffer.dropped == 2
+        buffer.writer = batches.append
+        buffer.shutdown()
+        print("✓ Location buffering successful")
+        return True
+    except Exception as e:
+        print(f"✗ Location buffering failed: {e}")
+        return False
+
+def test_event_broker():
+    """Test that space changes only reach subscribers whose viewport they touch"""
+    try:
+        from services.events import EventBroker
+        broker = EventBroker(max_pending=2)
+        pune = broker.subscribe((18.4, 73.7, 18.7, 74.0))
+        mumbai = broker.subscribe((18.9, 72.7, 19.3, 73.0))
+        everyone = broker.subscribe()
+        broker.publish({'type': 'upsert', 'data': {'id': 1}, 'points': [(18.52, 73.85)]})
+        assert [e['data']['id'] for e in pune.get(timeout=0)] == [1]
+        assert mumbai.get(timeout=0) == []
+        assert len(everyone.get(timeout=0)) == 1
+        for space_id in range(3):
+            broker.publish({'type': 'remove', 'data': {'id': space_id}, 'points': [(18.52, 73.85)]})
+        assert [e['type'] for e in pune.get(timeout=0)] == ['resync']
+        broker.unsubscribe(pune)
+        assert broker.subscriber_count() == 2
+        print("✓ Event broker successful")
+        return True
+    except Exception as e:
+        print(f"✗ Event broker failed: {e}")
+        return False
+
+def test_event_relay():
+    """Test that committed changes reach the streams of other processes through Redis"""
+    try:
+        import fakeredis
+    except ImportError:
+        print("- Event relay skipped, fakeredis is not installed")
+        return True
+    try:
+        from datetime import time
+        from models.models import db, User, ParkingSpace
+        from services.events import RedisRelay
+        server = fakeredis.FakeServer()
+        app = create_test_app()
+        other = create_test_app()
+        with app.app_context():
+            owner = User(username='owner', email='owner@example.com', password_hash='x')
+            db.session.add(owner)
+            db.session.commit()
+            owner_id = owner.id
+        # Two processes sharing one Redis; only the other one has a client connected
+        for flask_app in (app, other):
+            broker = flask_app.extensions['events']
+            broker.relay = RedisRelay(fakeredis.FakeRedis(server=server), broker)
+        subscription = other.extensions['events'].subscribe()
+        local = app.extensions['events']
+        with app.app_context():
+            db.session.add(ParkingSpace(title='Relayed', address='A', price_per_hour=10.0,
+                                        latitude=18.5, longitude=73.8, owner_id=owner_id,
+                                        availability_start=time(6), availability_end=time(22)))
+            db.session.commit()
+        events = subscription.get(timeout=2)
+        assert [e['data']['title'] for e in events] == ['Relayed']
+        assert local.subscriber_count() == 0
+
+        # The blocking workers of wsgi.py refuse the stream
+        app.config['STREAM_ENABLED'] = False
+        assert app.test_client().get('/parking/api/parking-spaces/stream').status_code == 503
+        print("✓ Event relay successful")
+        return True
+    except Exception as e:
+        print(f"✗ Event relay failed: {e!r}")
+        return False
+
+def test_delta_sync():
+    """Test that the since cursor returns only upserts and deletions after it"""
+    try:
+        from datetime import time
+        from models.models import db, User, ParkingSpace
+        app = create_test_app()
+        client = app.test_client()
+        with app.app_context():
+            owner = User(username='owner', email='owner@example.com', password_hash='x')
+            db.session.add(owner)
+            db.session.flush()
+            kept = ParkingSpace(title='Kept', address='A', price_per_hour=10.0, latitude=18.5, longitude=73.8,
+                                availability_start=time(6), availability_end=time(22), owner_id=owner.id)
+            removed = ParkingSpace(title='Removed', address='B', price_per_hour=10.0, latitude=18.6, longitude=73.9,
+                                   availability_start=time(6), availability_end=time(22), owner_id=owner.id)
+            db.session.add_all([kept, removed])
+            db.session.commit()
+
+            response = client.get('/parking/api/parking-spaces')
+            cursor = int(response.headers['X-Sync-Cursor'])
+            assert len(response.get_json()) == 2
+
+            kept.price_per_hour = 12.0
+            db.session.delete(removed)
+            db.session.commit()
+            removed_id = removed.id
+
+        changes = client.get(f'/parking/api/parking-spaces?since={cursor}').get_json()
+        assert [space['price_per_hour'] for space in changes['upserts']] == [12.0]
+        assert changes['deletions'] == [removed_id]
+        assert changes['cursor'] > cursor and not changes['has_more']
+
+        changes = client.get(f"/parking/api/parking-spaces?since={changes['cursor']}").get_json()
+        assert changes['upserts'] == [] and changes['deletions'] == []
+        print("✓ Delta sync successful")
+        return True
+    except Exception as e:
+        print(f"✗ Delta sync failed: {e}")
+        return False
+
+def test_compact_payloads():
+    """Test that the compact listing decodes to the default one and large responses are compressed"""
+    try:
+        import gzip
+        import json
+        from datetime import datetime, time
+        from models.models import db, User, ParkingSpace, Booking, Feedback
+        from services.payloads import decode_compact
+        app = create_test_app()
+        client = app.test_client()
+        with app.app_context():
+            owner = User(username='owner', email='owner@example.com', password_hash='x')
+            customer = User(username='customer', email='customer@example.com', password_hash='x')
+            db.session.add_all([owner, customer])
+            db.session.flush()
+            for i in range(20):
+                db.session.add(ParkingSpace(title=f'Space {i}', address='A', price_per_hour=10.0 + i,
+                                            latitude=18.5 + i / 1000, longitude=73.8, owner_id=owner.id,
+                                            availability_start=time(6), availability_end=time(22)))
+            db.session.flush()
+            booking = Booking(start_time=datetime(2024, 1, 1, 9), end_time=datetime(2024, 1, 1, 10),
+                              total_price=10.0, status='completed', customer_id=customer.id,
+                              owner_id=owner.id, parking_space_id=1)
+            db.session.add(booking)
+            db.session.flush()
+            db.session.add(Feedback(rating=4, booking_id=booking.id))
+            db.session.commit()
+
+        spaces = client.get('/parking/api/parking-spaces').get_json()
+        assert spaces[0]['owner_rating'] == 4.0 and spaces[0]['owner_total_ratings'] == 1
+        compact = client.get('/parking/api/parking-spaces?format=compact').get_json()
+        assert decode_compact(compact) == spaces
+
+        response = client.get('/parking/api/parking-spaces', headers={'Accept-Encoding': 'gzip'})
+        assert response.headers['Content-Encoding'] == 'gzip'
+        assert json.loads(gzip.decompress(response.get_data())) == spaces
+
+        # Flashed messages survive the session serializer with any JSON provider
+        assert client.get('/parking/my-spaces').status_code == 302
+        assert b'Please log in' in client.get('/auth/login').data
+        print("✓ Compact payloads successful")
+        return True
+    except Exception as e:
+        print(f"✗ Compact payloads failed: {e}")
+        return False
+
+def test_space_card_cache():
+    """Test that space cards are reused until the space, its images or the owner's rating change"""
+    try:
+        from datetime import datetime, time
+        from models.models import db, User, ParkingSpace, ParkingImage, Booking, Feedback
+        app = create_test_app()
+        client = app.test_client()
+        with app.app_context():
+            cache = app.extensions['fragments']
+            owner = User(username='owner', email='owner@example.com', password_hash='x')
+            db.session.add(owner)
+            db.session.flush()
+            space = ParkingSpace(title='Garage', description='Covered', address='A', price_per_hour=10.0,
+                                 latitude=18.5, longitude=73.8, owner_id=owner.id,
+                                 availability_start=time(6), availability_end=time(22))
+            db.session.add(space)
+            db.session.commit()
+
+            assert b'10.00' in client.get('/parking/spaces').data
+            client.get('/parking/spaces')
+            assert (cache.hits, cache.misses) == (1, 1)
+
+            space.price_per_hour = 15.0
+            db.session.commit()
+            assert b'15.00' in client.get('/parking/spaces').data
+
+            db.session.add(ParkingImage(image_url='/static/uploads/garage.jpg', parking_space_id=space.id))
+            db.session.commit()
+            assert b'garage.jpg' in client.get('/parking/spaces').data
+
+            booking = Booking(start_time=datetime(2024, 1, 1, 9), end_time=datetime(2024, 1, 1, 10),
+                              total_price=10.0, status='completed', customer_id=owner.id,
+                              owner_id=owner.id, parking_space_id=space.id)
+            db.session.add(booking)
+            db.session.flush()
+            db.session.add(Feedback(rating=5, booking_id=booking.id))
+            db.session.commit()
+            assert '★ 5.0 (1 ratings)' in client.get('/parking/spaces').get_data(as_text=True)
+            assert (cache.hits, cache.misses) == (1, 4)
+        print("✓ Space card cache successful")
+        return True
+    except Exception as e:
+        print(f"✗ Space card cache failed: {e}")
+        return False
+
+def test_production_startup():
+    """Test that production mode skips table creation and records startup timings"""
+    try:
+        from app import create_app
+        from models.models import db
+        app = create_app({
+            'STARTUP_MODE': 'production',
+            'SQLALCHEMY_DATABASE_URI': 'sqlite://'
+        })
+        timings = app.extensions['startup'].timings
+        assert 'create_tables' not in timings and 'blueprints' in timings
+        with app.app_context():
+            assert not db.inspect(db.engine).has_table('users')
+        print("✓ Production startup successful")
+        return True
+    except Exception as e:
+        print(f"✗ Production startup failed: {e}")
+        return False
+
+def test_space_snapshot():
+    """Test that near search ranks from the memory-mapped snapshot like the database search"""
+    try:
+        import tempfile
+        from datetime import time
+        from models.models import db, User, ParkingSpace
+        from services.snapshot import get_snapshot, snapshot_nearest
+        from services.geo import nearest_spaces
+        directory = tempfile.mkdtemp()
+        app = create_test_app(SNAPSHOT_ENABLED=True, SNAPSHOT_DIR=directory)
+        store = app.extensions['snapshot']
+        with app.app_context():
+            owner = User(username='owner', email='owner@example.com', password_hash='x')
+            db.session.add(owner)
+            db.session.flush()
+            for i in range(30):
+                db.session.add(ParkingSpace(title=f'Space {i}', address='A', price_per_hour=10.0 + i,
+                                            latitude=18.5 + i / 500, longitude=73.8 + i / 700,
+                                            owner_id=owner.id, availability_start=time(6),
+                                            availability_end=time(22)))
+            db.session.commit()
+            store.rebuild()
+            current = get_snapshot()
+            assert len(current) == 30 and not current.latitude.flags.writeable
+
+            from_snapshot = snapshot_nearest(current, 18.52, 73.81, 5, 10.0, max_price=30.0)
+            from_database = nearest_spaces(18.52, 73.81, k=5, max_km=10.0,
+                                           filters=[ParkingSpace.price_per_hour <= 30.0])
+            assert [(s.id, round(d, 6)) for s, d in from_snapshot] == \
+                [(s.id, round(d, 6)) for s, d in from_database]
+
+            # The full listing and the map are served from the snapshot alone
+            client = app.test_client()
+            from_snapshot_listing = client.get('/parking/api/parking-spaces')
+            assert from_snapshot_listing.headers['X-Sync-Cursor'] == str(current.cursor)
+            assert b'Space 29' in client.get('/parking/map').data
+            app.extensions['snapshot'] = None
+            assert client.get('/parking/api/parking-spaces').get_json() == from_snapshot_listing.get_json()
+            app.extensions['snapshot'] = store
+
+            # Spaces deactivated since the build are made up for from the extra candidates
+            ParkingSpace.query.get(from_snapshot[0][0].id).is_active = False
+            db.session.commit()
+            topped_up = snapshot_nearest(current, 18.52, 73.81, 5, 10.0, max_price=30.0)
+            assert len(topped_up) == 5 and from_snapshot[0][0].id not in [s.id for s, _ in topped_up]
+            # ...or by the database search when too many of them changed
+            for space, _ in snapshot_nearest(current, 18.52, 73.81, 5, 10.0, max_price=30.0):
+                space.is_active = False
+            db.session.commit()
+            expected = nearest_spaces(18.52, 73.81, k=5, max_km=10.0,
+                                      filters=[ParkingSpace.price_per_hour <= 30.0])
+            assert len(expected) == 5
+            assert snapshot_nearest(current, 18.52, 73.81, 5, 10.0, max_price=30.0) == expected
+
+            for _ in range(3):
+                store.rebuild()
+            store.reload()
+            assert len(get_snapshot()) == 24
+            assert len([f for f in os.listdir(directory) if f.endswith('.snap')]) == 2
+        store.stop()
+        print("✓ Space snapshot successful")
+        return True
+    except Exception as e:
+        print(f"✗ Space snapshot failed: {e}")
+        return False
+
+def test_async_api():
+    """Test that the async JSON endpoints answer like the Flask views"""
+    try:
+        import a2wsgi, aiosqlite, httpx, starlette
+    except ImportError:
+        print("- Async API skipped, requirements-asgi.txt is not installed")
+        return True
+    try:
+        import asyncio
+        import tempfile
+        from datetime import time
+        from models.models import db, User, ParkingSpace
+        from async_api import create_asgi_app
+        database = os.path.join(tempfile.mkdtemp(), 'async.db')
+        app = create_test_app(SQLALCHEMY_DATABASE_URI=f'sqlite:///{database}', SNAPSHOT_ENABLED=True,
+                              SNAPSHOT_DIR=tempfile.mkdtemp())
+        store = app.extensions['snapshot']
+        client = app.test_client()
+        with app.app_context():
+            owner = User(username='owner', email='owner@example.com', password_hash='x')
+            db.session.add(owner)
+            db.session.flush()
+            for i in range(5):
+                db.session.add(ParkingSpace(title=f'Space {i}', address='A', price_per_hour=10.0 + i,
+                                            latitude=18.5 + i / 100, longitude=73.8, owner_id=owner.id,
+                                            availability_start=time(6), availability_end=time(22)))
+            db.session.commit()
+            owner_id = owner.id
+            store.rebuild()
+        with client.session_transaction() as session:
+            session['_user_id'] = str(owner_id)
+        cookie = client.get_cookie('session').value
+
+        async def run():
+            asgi_app = create_asgi_app(app)
+            transport = httpx.ASGITransport(app=asgi_app)
+            async with httpx.AsyncClient(transport=transport, base_url='http://test') as http:
+                # From the database, then from the snapshot
+                for snapshot in (None, store):
+                    app.extensions['snapshot'] = snapshot
+                    for query in ('', '?format=compact', '?near=18.52,73.8&k=2', '?since=0'):
+                        expected = client.get(f'/parking/api/parking-spaces{query}')
+                        response = await http.get(f'/parking/api/parking-spaces{query}')
+                        assert response.json() == expected.get_json(), query
+                        assert response.headers.get('X-Sync-Cursor') == expected.headers.get('X-Sync-Cursor')
+                assert (await http.get('/parking/api/parking-spaces?near=91,0')).status_code == 400
+
+                response = await http.post('/parking/api/user-location', cookies={'session': cookie},
+                                           json={'latitude': 18.5, 'longitude': 73.8})
+                assert response.status_code == 202
+                # Without a session Flask-Login redirects to the login page
+                response = await http.post('/parking/api/user-location', json={'latitude': 1, 'longitude': 2})
+                assert response.status_code == 302
+                assert (await http.get('/')).status_code == 200
+
+                # The async handlers are shed like the Flask routes
+                shedder = app.extensions['load_shedder']
+                assert shedder.in_flight == 0
+                shedder.in_flight = shedder.max_in_flight
+                response = await http.get('/parking/api/parking-spaces')
+                assert response.status_code == 503 and response.headers['Retry-After'] == '1'
+                shedder.in_flight = 0
+                response = await http.get('/parking/api/parking-spaces', headers={'X-Request-Start': 't=1'})
+                assert response.status_code == 503 and shedder.in_flight == 0
+            await asgi_app.engine.dispose()
+
+        asyncio.run(run())
+        store.stop()
+        assert app.extensions['locations'].latest(owner_id)[:2] == (18.5, 73.8)
+        print("✓ Async API successful")
+        return True
+    except Exception as e:
+        print(f"✗ Async API failed: {e!r}")
+        return False
+
+def test_booking_archive():
+    """Test that old closed bookings move to the archive with their feedback and ratings"""
+    try:
+        from datetime import datetime, time, timedelta
+        from models.models import db, User, ParkingSpace, Booking, Feedback, ArchivedBooking
+        from services.archive import archive_bookings, booking_history
+        from services.ratings import owner_rating_stats
+        app = create_test_app()
+        with app.app_context():
+            owner = User(username='owner', email='owner@example.com', password_hash='x')
+            customer = User(username='customer', email='customer@example.com', password_hash='x')
+            db.session.add_all([owner, customer])
+            db.session.flush()
+            space = ParkingSpace(title='Old Space', address='A', price_per_hour=20.0, latitude=18.5,
+                                 longitude=73.8, owner_id=owner.id, availability_start=time(6),
+                                 availability_end=time(22))
+            db.session.add(space)
+            db.session.flush()
+            start = datetime.utcnow() - timedelta(days=200)
+            bookings = [Booking(start_time=start + timedelta(days=i), end_time=start + timedelta(days=i, hours=1),
+                                total_price=20.0, customer_id=customer.id, owner_id=owner.id,
+                                parking_space_id=space.id) for i in range(5)]
+            db.session.add_all(bookings)
+            db.session.flush()
+            for booking in bookings[:4]:
+                booking.status = 'completed'
+            assert bookings[0].closed_at is not None and bookings[4].closed_at is None
+            db.session.add_all([Feedback(rating=4, booking_id=bookings[0].id),
+                                Feedback(rating=2, booking_id=bookings[3].id)])
+            # Three of them closed long ago, the fourth recently
+            for booking in bookings[:3]:
+                booking.closed_at = booking.end_time
+            db.session.commit()
+            ids = [booking.id for booking in bookings]
+            assert owner_rating_stats([owner.id]) == {owner.id: (3.0, 2)}
+
+            assert archive_bookings(90, batch_size=2) == 3
+            assert Booking.query.count() == 2 and ArchivedBooking.query.count() == 3
+            assert owner_rating_stats([owner.id]) == {owner.id: (3.0, 2)}
+            assert owner.get_average_rating() == 3.0
+
+            history, has_more = booking_history(customer.id, page=1, per_page=2)
+            assert [b.id for b in history] == [ids[2], ids[1]] and has_more
+            history, has_more = booking_history(owner.id, received=True, page=2, per_page=2)
+            assert history[0].feedback.rating == 4 and history[0].space_title == 'Old Space' and not has_more
+            assert archive_bookings(90) == 0
+
+        client = app.test_client()
+        with app.app_context():
+            customer_id = User.query.filter_by(username='customer').one().id
+        with client.session_transaction() as session:
+            session['_user_id'] = str(customer_id)
+        response = client.get('/parking/my-bookings/history')
+        assert response.status_code == 200 and b'Old Space' in response.data
+        print("✓ Booking archive successful")
+        return True
+    except Exception as e:
+        print(f"✗ Booking archive failed: {e!r}")
+        return False
+
+def test_space_sorting():
+    """Test that the listing sorts by index-backed scores that follow new feedback and prices"""
+    try:
+        from datetime import datetime, time, timedelta
+        from models.models import db, User, ParkingSpace, Booking, Feedback
+        from services.ranking import sorted_spaces
+        app = create_test_app(SPACES_PER_PAGE=2)
+        with app.app_context():
+            owners = [User(username=f'owner{i}', email=f'owner{i}@example.com', password_hash='x')
+                      for i in range(3)]
+            db.session.add_all(owners)
+            db.session.flush()
+            spaces = [ParkingSpace(title=f'Space {i}', description='', address='A', price_per_hour=price, owner_id=owners[i].id,
+                                   latitude=18.5, longitude=73.8, availability_start=time(6),
+                                   availability_end=time(22), created_at=datetime(2024, 1, 1 + i))
+                      for i, price in enumerate([30.0, 10.0, 20.0])]
+            db.session.add_all(spaces)
+            db.session.commit()
+            # Without ratings every space starts from the prior, so the cheapest ranks first
+            assert spaces[0].rating_score == 3.5
+            assert [s.title for s in sorted_spaces([], 'recommended', per_page=3)[0]] == ['Space 1', 'Space 2', 'Space 0']
+            assert [s.title for s in sorted_spaces([], 'price', per_page=3)[0]] == ['Space 1', 'Space 2', 'Space 0']
+            assert [s.title for s in sorted_spaces([], 'newest', per_page=3)[0]] == ['Space 2', 'Space 1', 'Space 0']
+
+            # Five-star feedback lifts owner0 above the prior, one rating only a little
+            for rating in [5, 5, 5, 5, 5]:
+                booking = Booking(start_time=datetime.utcnow(), end_time=datetime.utcnow() + timedelta(hours=1),
+                                  total_price=30.0, status='completed', customer_id=owners[1].id,
+                                  owner_id=owners[0].id, parking_space_id=spaces[0].id)
+                db.session.add(booking)
+                db.session.flush()
+                db.session.add(Feedback(rating=rating, booking_id=booking.id))
+            db.session.commit()
+            db.session.refresh(spaces[0])
+            assert spaces[0].rating_score == 4.25
+            assert sorted_spaces([], 'rating', per_page=3)[0][0].title == 'Space 0'
+
+            # Repricing rescores the space; pages are cut by the LIMIT
+            spaces[1].price_per_hour = 200.0
+            db.session.commit()
+            page, has_more = sorted_spaces([], 'recommended', per_page=2)
+            assert [s.title for s in page] == ['Space 0', 'Space 2'] and has_more
+            page, has_more = sorted_spaces([ParkingSpace.price_per_hour <= 100], 'price', per_page=2)
+            assert [s.title for s in page] == ['Space 2', 'Space 0'] and not has_more
+
+            # Pages continue from the edge of their neighbour, through ties and unscored spaces
+            for i in range(4):
+                db.session.add(ParkingSpace(title=f'Tie {i}', description='', address='A', price_per_hour=20.0,
+                                            owner_id=owners[2].id, latitude=18.5, longitude=73.8,
+                                            availability_start=time(6), availability_end=time(22)))
+            db.session.commit()
+            ParkingSpace.query.filter_by(title='Tie 3').update({'rank_score': None})
+            db.session.commit()
+            for sort in ('recommended', 'price'):
+                expected = [s.id for s in sorted_spaces([], sort, per_page=100)[0]]
+                pages, after = [], None
+                while True:
+                    page, has_more = sorted_spaces([], sort, per_page=2, after=after)
+                    pages.append([s.id for s in page])
+                    if not has_more:
+                        break
+                    after = page[-1].id
+                assert sum(pages, []) == expected, sort
+                page, has_more = sorted_spaces([], sort, per_page=2, before=pages[-1][0])
+                assert [s.id for s in page] == pages[-2] and has_more
+            assert expected[-1] == ParkingSpace.query.filter_by(title='Space 1').one().id
+            assert sorted_spaces([], 'recommended', per_page=100)[0][-1].title == 'Tie 3'
+            ParkingSpace.query.filter(ParkingSpace.title.startswith('Tie')).delete()
+            db.session.commit()
+
+        client = app.test_client()
+        response = client.get('/parking/spaces?sort=price').get_data(as_text=True)
+        assert response.index('Space 2') < response.index('Space 0') and 'Space 1' not in response
+        with app.app_context():
+            last_id = ParkingSpace.query.filter_by(title='Space 0').one().id
+        assert f'after={last_id}' in response and 'before=' not in response
+        response = client.get(f'/parking/spaces?sort=price&after={last_id}').get_data(as_text=True)
+        assert 'Space 1' in response and 'Space 0' not in response and 'before=' in response
+        assert client.get('/parking/spaces?sort=distance').status_code == 200
+        # Other orders near a location leave out the spaces far from it
+        with app.app_context():
+            far = ParkingSpace(title='Far Space', description='', address='B', price_per_hour=1.0,
+                               owner_id=User.query.filter_by(username='owner2').one().id, latitude=19.1, longitude=72.9,
+                               availability_start=time(6), availability_end=time(22))
+            db.session.add(far)
+            db.session.commit()
+        response = client.get('/parking/spaces?sort=price&near=18.5,73.8').get_data(as_text=True)
+        assert 'Far Space' not in response and response.index('Space 2') < response.index('Space 0')
+        assert 'Far Space' in client.get('/parking/spaces?sort=price').get_data(as_text=True)
+        print("✓ Space sorting successful")
+        return True
+    except Exception as e:
+        print(f"✗ Space sorting failed: {e!r}")
+        return False
+
+def test_rate_limiting():
+    """Test token buckets per route and client, and shedding of overloaded or stale requests"""
+    try:
+        import time
+        from services.ratelimit import MemoryBackend, LoadShedder, parse_limit, queue_seconds
+        assert parse_limit('120/minute') == (2.0, 120)
+        backend = MemoryBackend()
+        assert [backend.take('a', 1.0, 2, now=0.0) for _ in range(3)] == [0.0, 0.0, 1.0]
+        assert backend.take('a', 1.0, 2, now=1.0) == 0.0 and backend.take('b', 1.0, 2, now=1.0) == 0.0
+        assert queue_seconds('t=1000.5', now=1002.0) == 1.5
+        assert queue_seconds('t=1700000000500', now=1700000002.0) == 1.5
+        shedder = LoadShedder(1)
+        assert shedder.enter() and not shedder.enter()
+        shedder.leave()
+        assert shedder.enter()
+
+        app = create_test_app(WTF_CSRF_ENABLED=False, RATELIMIT_RULES={
+            'auth.login': {'limit': '2/minute', 'key': 'ip', 'methods': ('POST',)},
+            'parking.api_parking_spaces': {'limit': '3/minute'},
+        })
+        client = app.test_client()
+        form = {'email': 'nobody@example.com', 'password': 'wrong-password'}
+        assert [client.post('/auth/login', data=form).status_code for _ in range(3)] == [200, 200, 429]
+        assert client.get('/auth/login').status_code == 200
+        other = client.post('/auth/login', data=form, environ_base={'REMOTE_ADDR': '10.0.0.2'})
+        assert other.status_code == 200
+
+        responses = [client.get('/parking/api/parking-spaces') for _ in range(4)]
+        assert [r.status_code for r in responses] == [200, 200, 200, 429]
+        assert responses[-1].is_json and int(responses[-1].headers['Retry-After']) >= 1
+
+        stale = client.get('/', headers={'X-Request-Start': f't={time.time() - 60:.3f}'})
+        assert stale.status_code == 503 and stale.headers['Retry-After'] == '1'
+        app.extensions['load_shedder'].in_flight = app.config['LOAD_SHED_MAX_IN_FLIGHT']
+        assert client.get('/').status_code == 503
+        app.extensions['load_shedder'].in_flight = 0
+        assert client.get('/').status_code == 200 and app.extensions['load_shedder'].in_flight == 0
+        print("✓ Rate limiting successful")
+        return True
+    except Exception as e:
+        print(f"✗ Rate limiting failed: {e!r}")
+        return False
+
+def test_redis_rate_limiting():
+    """Test that the Redis token bucket script refills, bursts and delays like the memory backend"""
+    try:
+        import fakeredis, lupa
+    except ImportError:
+        print("- Redis rate limiting skipped, fakeredis[lua] is not installed")
+        return True
+    try:
+        import time
+        from services.ratelimit import MemoryBackend, RedisBackend
+        redis_backend = RedisBackend(fakeredis.FakeRedis())
+        memory = MemoryBackend()
+
+        # A burst of 2, then a wait of one token at 20 per second
+        waits = [redis_backend.take('a', 20.0, 2) for _ in range(3)]
+        expected = [memory.take('a', 20.0, 2, now=0.0) for _ in range(3)]
+        assert waits[:2] == expected[:2] == [0.0, 0.0]
+        assert abs(waits[2] - expected[2]) < 0.01
+        # Refilled after the wait, and keys are counted separately
+        time.sleep(0.1)
+        assert redis_backend.take('a', 20.0, 2) == memory.take('a', 20.0, 2, now=0.1) == 0.0
+        assert redis_backend.take('b', 20.0, 2) == 0.0
+
+        retry_after = {}
+        for name, backend in (('memory', MemoryBackend()), ('redis', RedisBackend(fakeredis.FakeRedis()))):
+            app = create_test_app(RATELIMIT_RULES={'parking.api_parking_spaces': {'limit': '3/minute'}})
+            app.extensions['ratelimit'].backend = backend
+            client = app.test_client()
+            responses = [client.get('/parking/api/parking-spaces') for _ in range(4)]
+            assert [r.status_code for r in responses] == [200, 200, 200, 429], name
+            retry_after[name] = responses[-1].headers['Retry-After']
+        assert retry_after['redis'] == retry_after['memory'] == '20'
+        print("✓ Redis rate limiting successful")
+        return True
+    except Exception as e:
+        print(f"✗ Redis rate limiting failed: {e!r}")
+        return False
+
+def test_chunked_uploads():
+    """Test that images upload in resumable chunks and attach to a space in their own transaction"""
+    try:
+        import hashlib
+        import tempfile
+        from datetime import time
+        from models.models import db, User, ParkingSpace, ParkingImage
+        upload_folder = tempfile.mkdtemp()
+        app = create_test_app(UPLOAD_FOLDER=upload_folder, UPLOAD_PARTIAL_DIR=tempfile.mkdtemp(),
+                              UPLOAD_CHUNK_SIZE=1000)
+        with app.app_context():
+            owner = User(username='owner', email='owner@example.com', password_hash='x')
+            other = User(username='other', email='other@example.com', password_hash='x')
+            db.session.add_all([owner, other])
+            db.session.flush()
+            space = ParkingSpace(title='Garage', address='A', price_per_hour=20.0, owner_id=owner.id,
+                                 availability_start=time(6), availability_end=time(22))
+            db.session.add(space)
+            db.session.commit()
+            owner_id, other_id, space_id = owner.id, other.id, space.id
+
+        image = b'\x89PNG\r\n\x1a\n' + bytes(range(256)) * 10
+        client = app.test_client()
+        with client.session_transaction() as session:
+            session['_user_id'] = str(owner_id)
+        response = client.post('/parking/api/uploads', json={
+            'filename': 'my garage.png', 'size': len(image), 'sha256': hashlib.sha256(image).hexdigest()
+        })
+        assert response.status_code == 201 and response.json['offset'] == 0
+        upload_url = f"/parking/api/uploads/{response.json['id']}"
+
+        def send(offset, data):
+            return client.patch(upload_url, data=data, headers={'Upload-Offset': str(offset)})
+
+        assert send(0, image[:1000]).json['offset'] == 1000
+        # A repeated or skipped chunk is refused with the offset to resume from
+        repeated = send(0, image[:1000])
+        assert repeated.status_code == 409 and repeated.json['offset'] == 1000
+        assert send(1000, image[1000:2001]).status_code == 413
+        assert client.post(upload_url + '/complete').status_code == 409
+        # A new store, as in another worker, hashes the partial file again
+        app.extensions['uploads']._hashers.clear()
+        assert client.get(upload_url).json['offset'] == 1000
+        assert send(1000, image[1000:2000]).json['offset'] == 2000
+        assert send(2000, image[2000:]).json['offset'] == len(image)
+        completed = client.post(upload_url + '/complete').json
+        assert completed['state'] == 'complete' and completed['sha256'] == hashlib.sha256(image).hexdigest()
+        assert completed['url'].endswith('_my_garage.png')
+        with open(os.path.join(upload_folder, completed['url'].rsplit('/', 1)[1]), 'rb') as f:
+            assert f.read() == image
+
+        not_image = client.post('/parking/api/uploads', json={'filename': 'fake.gif', 'size': 5}).json
+        send_url = f"/parking/api/uploads/{not_image['id']}"
+        client.patch(send_url, data=b'hello', headers={'Upload-Offset': '0'})
+        assert client.post(send_url + '/complete').status_code == 415
+        assert client.post('/parking/api/uploads', json={'filename': 'a.exe', 'size': 5}).status_code == 400
+
+        with client.session_transaction() as session:
+            session['_user_id'] = str(other_id)
+        assert client.get(upload_url).status_code == 404
+        with client.session_transaction() as session:
+            session['_user_id'] = str(owner_id)
+        attached = client.post(f'/parking/api/spaces/{space_id}/images', json={'upload_ids': [completed['id']]})
+        assert attached.status_code == 201 and attached.json[0]['is_primary']
+        assert client.get(upload_url).status_code == 404
+        with app.app_context():
+            assert ParkingImage.query.filter_by(parking_space_id=space_id).count() == 1
+        print("✓ Chunked uploads successful")
+        return True
+    except Exception as e:
+        print(f"✗ Chunked uploads failed: {e!r}")
+        return False
+
+def test_space_delete_cascade():
+    """Test that deleting a space leaves its rows to the database and queues its files for the reaper"""
+    try:
+        import tempfile
+        import time as clock
+        from datetime import datetime, time, timedelta
+        from sqlalchemy import event
+        from models.models import db, User, ParkingSpace, ParkingImage, ImageDeletion, Booking, Feedback, SpaceTombstone
+        from services.reaper import reap_deleted_images
+        upload_folder = tempfile.mkdtemp()
+        app = create_test_app(UPLOAD_FOLDER=upload_folder)
+        with app.app_context():
+            owner = User(username='owner', email='owner@example.com', password_hash='x')
+            db.session.add(owner)
+            db.session.flush()
+            space = ParkingSpace(title='Busy', address='A', price_per_hour=20.0, owner_id=owner.id,
+                                 availability_start=time(6), availability_end=time(22))
+            kept = ParkingSpace(title='Kept', address='A', price_per_hour=20.0, owner_id=owner.id,
+                                availability_start=time(6), availability_end=time(22))
+            db.session.add_all([space, kept])
+            db.session.flush()
+            for name, space_id in [('busy.png', space.id), ('kept.png', kept.id)]:
+                open(os.path.join(upload_folder, name), 'wb').close()
+                db.session.add(ParkingImage(image_url=f'/static/uploads/{name}', parking_space_id=space_id))
+            for i in range(20):
+                booking = Booking(start_time=datetime(2024, 1, 1) + timedelta(days=i),
+                                  end_time=datetime(2024, 1, 1, 1) + timedelta(days=i), total_price=20.0,
+                                  status='completed', customer_id=owner.id, owner_id=owner.id,
+                                  parking_space_id=space.id)
+                db.session.add(booking)
+                db.session.flush()
+                db.session.add(Feedback(rating=5, booking_id=booking.id))
+            db.session.commit()
+            owner_id, space_id = owner.id, space.id
+            # Files no image refers to, like those committed to the repository, are never touched
+            open(os.path.join(upload_folder, 'screenshot.png'), 'wb').close()
+            old = clock.time() - 30 * 24 * 3600
+            os.utime(os.path.join(upload_folder, 'screenshot.png'), (old, old))
+
+        client = app.test_client()
+        with client.session_transaction() as session:
+            session['_user_id'] = str(owner_id)
+        statements = []
+        with app.app_context():
+            engine = db.engine
+        record = lambda conn, cursor, statement, *args: statements.append(statement)
+        event.listen(engine, 'before_cursor_execute', record)
+        try:
+            assert client.post(f'/parking/delete-space/{space_id}').status_code == 302
+        finally:
+            event.remove(engine, 'before_cursor_execute', record)
+        assert not [s for s in statements if 'FROM bookings' in s or 'FROM feedbacks' in s
+                    or ('FROM parking_images' in s and not s.startswith('INSERT INTO image_deletions'))], statements
+
+        with app.app_context():
+            assert Booking.query.count() == 0 and Feedback.query.count() == 0
+            assert [image.image_url for image in ParkingImage.query.all()] == ['/static/uploads/kept.png']
+            assert db.session.get(SpaceTombstone, space_id) is not None
+            assert reap_deleted_images(dry_run=True) == ['busy.png']
+            assert os.path.exists(os.path.join(upload_folder, 'busy.png'))
+            # Removed at once, without waiting for the file to age
+            assert reap_deleted_images() == ['busy.png']
+            assert ImageDeletion.query.count() == 0 and reap_deleted_images() == []
+        assert sorted(os.listdir(upload_folder)) == ['kept.png', 'screenshot.png']
+        print("✓ Space delete cascade successful")
+        return True
+    except Exception as e:
+        print(f"✗ Space delete cascade failed: {e!r}")
+        return False
+
+def test_owner_settlement():
+    """Test that settling a month adds up each owner's completed bookings and resumes after a failure"""
+    try:
+        from datetime import datetime, time
+        from models.models import db, User, ParkingSpace, Booking, ArchivedBooking, Settlement, SettlementLine, SettlementRun
+        from services import settlement
+        from services.settlement import SettlementError, settle_period
+        app = create_test_app()
+        with app.app_context():
+            owners = [User(username=f'owner{i}', email=f'owner{i}@example.com', password_hash='x') for i in range(2)]
+            customer = User(username='customer', email='customer@example.com', password_hash='x')
+            db.session.add_all(owners + [customer])
+            db.session.flush()
+            spaces = [ParkingSpace(title=f'Space {i}', address='A', price_per_hour=10.0, latitude=18.5,
+                                   longitude=73.8, owner_id=owner.id, availability_start=time(6),
+                                   availability_end=time(22)) for i, owner in enumerate(owners)]
+            db.session.add_all(spaces)
+            db.session.flush()
+            start = datetime(2026, 9, 10, 9)
+
+            def booking(space, price, status, closed_at):
+                return Booking(start_time=start, end_time=start.replace(hour=10), total_price=price,
+                               status=status, closed_at=closed_at, customer_id=customer.id,
+                               owner_id=space.owner_id, parking_space_id=space.id)
+
+            db.session.add_all([booking(spaces[i % 2], 10.0 + i, 'completed', datetime(2026, 9, 1 + i)) for i in range(5)])
+            db.session.add_all([booking(spaces[0], 99.0, 'cancelled', datetime(2026, 9, 20)),
+                                booking(spaces[0], 99.0, 'completed', datetime(2026, 10, 1))])
+            db.session.add(ArchivedBooking(id=1000, start_time=start, end_time=start, total_price=5.0,
+                                           status='completed', closed_at=datetime(2026, 9, 30),
+                                           parking_space_id=spaces[1].id, space_title='Space 1',
+                                           customer_id=customer.id, owner_id=owners[1].id))
+            db.session.commit()
+            owner_ids = [owner.id for owner in owners]
+
+            try:
+                settle_period('2026-10', now=datetime(2026, 10, 15))
+                assert False, 'an unfinished month was settled'
+            except SettlementError:
+                pass
+
+            # Fail at the second checkpoint, after two bookings were saved
+            save_progress = settlement._save_progress
+            calls = []
+            def failing(*args, **kwargs):
+                calls.append(args)
+                if len(calls) == 2:
+                    raise RuntimeError('connection lost')
+                return save_progress(*args, **kwargs)
+            settlement._save_progress = failing
+            try:
+                settle_period('2026-09', checkpoint_rows=2, now=datetime(2026, 10, 15))
+                assert False, 'the failure was swallowed'
+            except RuntimeError:
+                pass
+            finally:
+                settlement._save_progress = save_progress
+            db.session.rollback()
+            run = db.session.get(SettlementRun, '2026-09')
+            assert run.status == 'running' and run.booking_count == 2
+
+            run = settle_period('2026-09', checkpoint_rows=2, now=datetime(2026, 10, 15))
+            assert run.status == 'complete' and run.booking_count == 6 and run.last_booking_id == 1000
+
+            def totals():
+                return {s.owner_id: (s.booking_count, s.gross_amount)
+                        for s in Settlement.query.filter_by(period='2026-09')}
+            expected = {owner_ids[0]: (3, 10.0 + 12.0 + 14.0), owner_ids[1]: (3, 11.0 + 13.0 + 5.0)}
+            assert totals() == expected, totals()
+            # Settled months are left alone unless restarted
+            assert settle_period('2026-09', now=datetime(2026, 10, 15)).booking_count == 6
+            assert settle_period('2026-09', restart=True, now=datetime(2026, 10, 15)).booking_count == 6
+            assert totals() == expected
+
+        client = app.test_client()
+        with client.session_transaction() as session:
+            session['_user_id'] = str(owner_ids[1])
+        response = client.get('/parking/statements')
+        assert response.status_code == 200 and b'2026-09' in response.data
+        lines = client.get('/parking/statements/2026-09.csv').get_data(as_text=True).splitlines()
+        assert lines[0].startswith('booking_id,') and len([l for l in lines if 'Space 1' in l]) == 3
+        assert lines[-1] == 'total,29.00'
+        assert client.get('/parking/statements/2026-08.csv').status_code == 404
+
+        # Statements list what was settled, even after the bookings are gone
+        with app.app_context():
+            db.session.execute(db.delete(Booking).where(Booking.owner_id == owner_ids[1]))
+            db.session.commit()
+        lines = client.get('/parking/statements/2026-09.csv').get_data(as_text=True).splitlines()
+        assert len([l for l in lines if 'Space 1' in l]) == 3 and lines[-1] == 'total,29.00'
+        # Lines that do not add up to the settlement are flagged
+        with app.app_context():
+            db.session.execute(db.delete(SettlementLine).where(SettlementLine.booking_id == 1000))
+            db.session.commit()
+        lines = client.get('/parking/statements/2026-09.csv').get_data(as_text=True).splitlines()
+        assert lines[-2] == 'total,29.00' and lines[-1].startswith('note,The lines above list 2 bookings for 24.00')
+        print("✓ Owner settlement successful")
+        return True
+    except Exception as e:
+        print(f"✗ Owner settlement failed: {e!r}")
+        return False
+
+def test_region_sharding():
+    """Test that spaces and bookings are routed to the SQLite shard of their region"""
+    try:
+        import os
+        import tempfile
+        from datetime import date, timedelta
+        from models.database import ShardingError
+        from datetime import datetime
+        from models.models import db, User, ParkingSpace, Booking, ArchivedBooking, ArchivedFeedback
+        from services.settlement import settle_period
+        from services.sharding import gather, use_region
+        shard_dir = tempfile.mkdtemp()
+        app = create_test_app(
+            SQLALCHEMY_BINDS={f'shard:{name}': f"sqlite:///{os.path.join(shard_dir, name + '.db')}"
+                              for name in ('pune', 'mumbai')},
+            SHARD_REGIONS={
+                'pune': {'index': 1, 'bbox': (18.40, 73.70, 18.70, 74.05)},
+                'mumbai': {'index': 2, 'bbox': (18.85, 72.75, 19.35, 73.10), 'cities': ['mumbai', 'bombay']},
+            },
+            RATELIMIT_ENABLED=False,
+        )
+        with app.app_context():
+            users = [User(username=name, email=f'{name}@example.com', password_hash='x', is_admin=name == 'admin')
+                     for name in ('owner', 'customer', 'admin')]
+            db.session.add_all(users)
+            db.session.commit()
+            owner_id, customer_id, admin_id = [user.id for user in users]
+
+        client = app.test_client()
+        with client.session_transaction() as session:
+            session['_user_id'] = str(owner_id)
+        form = {'description': '', 'price_per_hour': '20', 'availability_start': '06:00',
+                'availability_end': '22:00', 'is_active': 'y'}
+        assert client.post('/parking/add-space', data={**form, 'title': 'Pune Spot', 'address': 'FC Road',
+                                                       'latitude': '18.52', 'longitude': '73.85'}).status_code == 302
+        # Without coordinates the address decides
+        assert client.post('/parking/add-space', data={**form, 'title': 'Bombay Spot', 'address': 'Andheri, Bombay',
+                                                       'latitude': '0', 'longitude': '0'}).status_code == 302
+
+        with app.app_context():
+            try:
+                ParkingSpace.query.count()
+                assert False, 'a sharded table was read without a region'
+            except ShardingError:
+                pass
+            spaces = {space.title: space.id for space in gather(lambda: ParkingSpace.query.all())}
+            assert spaces['Pune Spot'] % 100 == 1 and spaces['Bombay Spot'] % 100 == 2, spaces
+            with use_region('mumbai'):
+                assert [space.title for space in ParkingSpace.query.all()] == ['Bombay Spot']
+            # The default database holds users only
+            assert db.session.execute(db.text('SELECT COUNT(*) FROM parking_spaces')).scalar() == 0
+
+        response = client.get('/parking/spaces?region=pune')
+        assert b'Pune Spot' in response.data and b'Bombay Spot' not in response.data
+        # The chosen region is remembered, the owner's own spaces cover every region
+        response = client.get('/parking/spaces')
+        assert b'Pune Spot' in response.data and b'Bombay Spot' not in response.data
+        response = client.get('/parking/my-spaces')
+        assert b'Pune Spot' in response.data and b'Bombay Spot' in response.data
+        # Near queries go to the region of their point
+        payload = client.get('/parking/api/parking-spaces?near=18.53,73.84').get_json()
+        assert [space['title'] for space in payload] == ['Pune Spot']
+        assert client.get('/parking/api/parking-spaces?near=19.1,72.9').get_json() == []
+
+        # Moving a space to another region is refused
+        response = client.post(f"/parking/edit-space/{spaces['Pune Spot']}", data={
+            **form, 'title': 'Pune Spot', 'address': 'FC Road', 'latitude': '19.1', 'longitude': '72.9'})
+        assert response.status_code == 200 and b'another region' in response.data
+
+        with client.session_transaction() as session:
+            session['_user_id'] = str(customer_id)
+        response = client.post(f"/parking/space/{spaces['Bombay Spot']}/book", data={
+            'date': (date.today() + timedelta(days=1)).isoformat(), 'start_time': '10:00', 'end_time': '12:00'})
+        assert response.status_code == 302
+        with app.app_context(), use_region('mumbai'):
+            booking = Booking.query.one()
+            assert booking.id % 100 == 2 and booking.parking_space_id == spaces['Bombay Spot']
+        assert client.get('/parking/space/1000').status_code == 404  # index 0 is no region
+        # The customer sees the Mumbai booking while Pune is selected
+        assert b'Bombay Spot' in client.get('/parking/my-bookings?region=pune').data
+
+        # History, ratings and statements of a user add up every region
+        with app.app_context():
+            for region, index, title, rating in (('pune', 1, 'Old Pune', 5), ('mumbai', 2, 'Old Bombay', 3)):
+                with use_region(region):
+                    db.session.add(ArchivedBooking(id=1000 + index, start_time=datetime(2026, 9, index, 9),
+                                                   end_time=datetime(2026, 9, index, 10), total_price=10.0 * index,
+                                                   status='completed', closed_at=datetime(2026, 9, index, 10),
+                                                   parking_space_id=spaces['Pune Spot'], space_title=title,
+                                                   customer_id=customer_id, owner_id=owner_id))
+                    db.session.add(ArchivedFeedback(id=1000 + index, rating=rating, booking_id=1000 + index,
+                                                    owner_id=owner_id))
+                    db.session.commit()
+                    settle_period('2026-09', now=datetime(2026, 10, 15))
+            assert db.session.get(User, owner_id).get_average_rating() == 4.0
+        response = client.get('/parking/my-bookings/history').get_data(as_text=True)
+        assert response.index('Old Bombay') < response.index('Old Pune') and '>owner<' in response
+        with client.session_transaction() as session:
+            session['_user_id'] = str(owner_id)
+        response = client.get('/parking/my-bookings/history?view=received').get_data(as_text=True)
+        assert 'Old Bombay' in response and 'Old Pune' in response and '>customer<' in response
+        assert b'4.0' in client.get('/parking/my-spaces').data
+        response = client.get('/parking/statements').get_data(as_text=True)
+        assert '2026-09' in response and '30.00' in response
+        lines = client.get('/parking/statements/2026-09.csv').get_data(as_text=True).splitlines()
+        assert [line.split(',')[1] for line in lines[1:3]] == ['Old Pune', 'Old Bombay']
+        assert lines[-2:] == ['bookings,2', 'total,30.00']
+
+        with client.session_transaction() as session:
+            session['_user_id'] = str(admin_id)
+        response = client.get('/admin/spaces')
+        assert b'Pune Spot' in response.data and b'Bombay Spot' in response.data
+        assert client.get('/admin/dashboard').status_code == 200
+        response = client.post(f"/admin/space/{spaces['Bombay Spot']}/deactivate")
+        assert response.status_code == 302
+        with app.app_context(), use_region('mumbai'):
+            assert not db.session.get(ParkingSpace, spaces['Bombay Spot']).is_active
+        print("✓ Region sharding successful")
+        return True
+    except Exception as e:
+        print(f"✗ Region sharding failed: {e!r}")
+        return False
+
+def test_audit_log():
+    """Test that admin actions and booking status changes are written to the audit log in batches"""
+    try:
+        from datetime import datetime, time, timedelta
+        from models.models import db, User, ParkingSpace, Booking, AuditEntry
+        import threading
+        import time as clock
+        from services.audit import AuditLog, get_audit_log, search_entries
+        app = create_test_app(AUDIT_FLUSH_INTERVAL=3600, RATELIMIT_ENABLED=False)
+        with app.app_context():
+            users = [User(username=name, email=f'{name}@example.com', password_hash='x', is_admin=name == 'admin')
+                     for name in ('owner', 'customer', 'admin')]
+            db.session.add_all(users)
+            db.session.flush()
+            space = ParkingSpace(title='Audited Spot', address='A', price_per_hour=10.0, latitude=18.5,
+                                 longitude=73.8, owner_id=users[0].id, availability_start=time(6),
+                                 availability_end=time(22))
+            db.session.add(space)
+            db.session.flush()
+            start = datetime.utcnow() + timedelta(days=1)
+            booking = Booking(start_time=start, end_time=start + timedelta(hours=1), total_price=10.0,
+                              customer_id=users[1].id, owner_id=users[0].id, parking_space_id=space.id)
+            db.session.add(booking)
+            db.session.commit()
+            owner_id, customer_id, admin_id = [user.id for user in users]
+            space_id, booking_id = space.id, booking.id
+
+        client = app.test_client()
+        with client.session_transaction() as session:
+            session['_user_id'] = str(admin_id)
+        assert client.post(f'/admin/user/{owner_id}/verify').status_code == 302
+        assert client.post(f'/admin/user/{customer_id}/make-admin').status_code == 302
+        assert client.post(f'/admin/space/{space_id}/deactivate').status_code == 302
+        with client.session_transaction() as session:
+            session['_user_id'] = str(owner_id)
+        assert client.post(f'/parking/booking/{booking_id}/confirm').status_code == 302
+
+        with app.app_context():
+            log = get_audit_log()
+            # Entries are queued until the flusher writes them
+            assert len(log) == 4 and AuditEntry.query.count() == 0
+            assert log.flush() == 4 and len(log) == 0
+            actions = {entry.action: entry for entry in AuditEntry.query.all()}
+            assert set(actions) == {'user.is_verified', 'user.is_admin', 'parking_space.is_active', 'booking.status'}
+            status = actions['booking.status']
+            assert (status.actor_id, status.target_id) == (owner_id, booking_id)
+            assert (status.before_value, status.after_value) == ('"pending"', '"confirmed"')
+            assert actions['parking_space.is_active'].after_value == 'false'
+
+            entries, has_more = search_entries(actor_id=admin_id)
+            assert len(entries) == 3 and not has_more
+            entries, has_more = search_entries(actor_id=admin_id, per_page=2)
+            assert len(entries) == 2 and has_more
+            entries, _ = search_entries(target_type='user', target_id=customer_id)
+            assert [entry.action for entry in entries] == ['user.is_admin']
+            assert search_entries(until=datetime.utcnow() - timedelta(days=1))[0] == []
+
+            # Entries are never changed
+            entry = AuditEntry.query.first()
+            entry.action = 'forged'
+            try:
+                db.session.commit()
+                assert False, 'an audit entry was updated'
+            except ValueError:
+                db.session.rollback()
+
+            # Changes that are rolled back are not audited
+            db.session.get(User, owner_id).is_verified = False
+            db.session.flush()
+            db.session.rollback()
+            assert len(log) == 0
+
+        with client.session_transaction() as session:
+            session['_user_id'] = str(admin_id)
+        response = client.get('/admin/audit?actor=admin&target_type=parking_space')
+        assert response.status_code == 200
+        assert b'parking_space.is_active' in response.data and b'user.is_admin' not in response.data
+        assert b'No user named' in client.get('/admin/audit?actor=nobody').data
+
+        # Viewing the log leaves queued entries to the flusher unless asked to write them
+        assert client.post(f'/admin/space/{space_id}/activate').status_code == 302
+        assert b'1 entries are still queued' in client.get('/admin/audit').data
+        with app.app_context():
+            assert AuditEntry.query.count() == 4
+        assert client.post('/admin/audit/flush').status_code == 302
+        with app.app_context():
+            assert AuditEntry.query.count() == 5 and len(get_audit_log()) == 0
+
+        # A full queue drops new entries instead of writing them in the request
+        batches = []
+        log = AuditLog(max_entries=2, flush_interval=3600,
+                       writer=lambda rows: batches.append((threading.current_thread().name, rows)))
+        log.add([{'action': 'a'}, {'action': 'b'}, {'action': 'c'}])
+        assert log.dropped == 1
+        # ...and wakes the flusher, which writes the rest on its own thread
+        deadline = clock.monotonic() + 5
+        while not batches and clock.monotonic() < deadline:
+            clock.sleep(0.01)
+        log.shutdown()
+        assert [(name, [entry['action'] for entry in rows]) for name, rows in batches] == \
+            [('audit-flusher', ['a', 'b'])]
+        print("✓ Audit log successful")
+        return True
+    except Exception as e:
+        print(f"✗ Audit log failed: {e!r}")
+        return False
+
 def main():
     """Run all tests"""
     print("Running Smart Park System tests...\n")
     
     tests = [
         test_imports,
-        test_app_creation
+        test_app_creation,
+        test_price_grids,
+        test_price_quotes,
+        test_recurring_bookings,
+        test_nearest_ranking,
+        test_location_buffer,
+        test_event_broker,
+        test_event_relay,
+        test_delta_sync,
+        test_compact_payloads,
+        test_space_card_cache,
+        test_production_startup,
+        test_space_snapshot,
+        test_async_api,
+        test_booking_archive,
+        test_space_sorting,
+        test_rate_limiting,
+        test_redis_rate_limiting,
+        test_chunked_uploads,
+        test_space_delete_cascade,
+        test_owner_settlement,
+        test_region_sharding,
+        test_audit_log
     ]
     
     passed = 0
@@ -0,0 +1,22 @@
+"""WSGI entry point for production servers.
+
+    gunicorn -c gunicorn.conf.py wsgi:app
+
+The application starts in production mode, so no tables are created;
+run init_db.py when deploying. Heavy modules are imported up front, which
+with preload_app happens once in the master before workers are forked.
+
+Each open live map stream would hold one of the blocking workers, so the
+stream is refused here. Route /parking/api/parking-spaces/stream to
+`uvicorn asgi:app` instead; maps without it poll for changes.
+"""
+import os
+
+os.environ.setdefault('SMART_PARK_STARTUP_MODE', 'production')
+
+from app import create_app
+from services.startup import warm_up
+
+app = create_app()
+app.config['STREAM_ENABLED'] = False
+warm_up(app)